@@ -0,0 +1,291 @@
+"""Micro-benchmarks for the render, display, publish and logging paths.
+
+Run from the repository root, no sensors or screen needed:
+
+    python3 bench/benchmarks.py
+    python3 bench/benchmarks.py --save   # store results as new baselines
+
+Results are compared with bench/baselines.json and the run fails when a
+benchmark is slower than its baseline times the regression threshold.
+Each one is compared as a ratio to a reference workload timed in the
+same run, so a slower or busier machine doesn't fail it. Calls that take
+under a microsecond, like cache hits, are only reported.
+"""
+
+import argparse
+import json
+import os.path
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+from PIL import Image
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from inc.display import image_to_rgb565, display_rgb565, DiffDisplay
+from inc.expressions import ExpressionCache
+from inc.hardware import MemoryDisplay
+from inc.history import HistoryPage
+from inc.mqtt import state_message
+from inc.persistence import LogWriter
+from inc.screen import Screen, BACKGROUNDS
+from inc.sensors import Reading
+from inc.store import Store
+
+BASELINES = os.path.join(dir_path, 'bench/baselines.json')
+
+# A run may be this much slower than its baseline before it fails
+DEFAULT_THRESHOLD = 1.5
+
+# Faster than this, timings are mostly noise and are not compared
+MIN_GATED_MS = 0.001
+
+
+def _calibrate(function, min_time):
+    """Calls of function taking about min_time"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - started >= min_time / 10:
+            break
+        number *= 2
+    return max(1, int(number * 10))
+
+
+def _mean_ms(function, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        function()
+    return (time.perf_counter() - started) / number * 1000
+
+
+_reference_pixels = np.arange(240 * 240, dtype=np.uint32)
+
+
+def reference():
+    """Fixed work, some Python and some NumPy like the benchmarks, that
+    every result is divided by"""
+    total = 0
+    for i in range(2000):
+        total += i * i % 7
+    return total + int((_reference_pixels * 3 >> 1).sum())
+
+
+def measure(function, repeat=7, number=None, min_time=0.2):
+    """Time per call in milliseconds, the best of `repeat` rounds, and its
+    ratio to the reference workload. Every round of the function is
+    followed by one of the reference, and the ratio is the median of the
+    rounds, so anything else slowing the machine down affects both."""
+    if number is None:
+        number = _calibrate(function, min_time)
+    reference_number = _calibrate(reference, min_time / 4)
+
+    best = None
+    ratios = []
+    for _ in range(repeat):
+        mean = _mean_ms(function, number)
+        ratios.append(mean / _mean_ms(reference, reference_number))
+        best = mean if best is None else min(best, mean)
+    return best, sorted(ratios)[len(ratios) // 2]
+
+
+def sample_reading(i=0):
+    return Reading(
+        timestamp=datetime.now(timezone.utc),
+        eCO2=600 + i % 500,
+        TVOC=50 + i % 200,
+        baseline_eCO2=0x8973,
+        baseline_TVOC=0x8AAE,
+        temperature=21.37,
+        humidity=44.8,
+        pressure=1013.2,
+        lux=123.45,
+        proximity=0)
+
+
+def write_sample_gif(path, frames=20, size=(200, 200)):
+    images = [Image.new('RGB', size, (i * 12 % 256, 80, 160)) for i in range(frames)]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=50, loop=0)
+
+
+def run(tmp):
+    results = {}
+    disp = MemoryDisplay()
+    screen = Screen(dir_path, disp.width, disp.height, cache_size=16)
+
+    # Frame build in the display branch, cold and from the frame cache,
+    # straight to RGB565 through the glyph atlases
+    counter = [0]
+
+    def render_miss():
+        counter[0] += 1
+        screen.render(BACKGROUNDS[counter[0] % 2], 400 + counter[0] % 100000, 87, 42, 21, 40)
+
+    results['screen.render_miss'] = measure(render_miss)
+    results['screen.render_hit'] = measure(
+        lambda: screen.render(BACKGROUNDS[0], 812, 90, 42, 21, 40))
+
+    # The same frame drawn with PIL and converted, as it was before the atlases
+    def image_convert():
+        counter[0] += 1
+        image_to_rgb565(screen.image(BACKGROUNDS[counter[0] % 2], 400 + counter[0] % 100000, 87, 42, 21, 40))
+
+    results['screen.image_convert'] = measure(image_convert)
+
+    # Conversion and push of a full frame
+    image = screen.image(BACKGROUNDS[0], 812, 90, 42, 21, 40)
+    results['display.rgb565_convert'] = measure(lambda: image_to_rgb565(image))
+    data = image_to_rgb565(image)
+    results['display.push_full_frame'] = measure(lambda: display_rgb565(disp, data))
+    results['display.display'] = measure(lambda: disp.display(image))
+
+    # Partial updates: a changed reading, and a frame with nothing new
+    panel = DiffDisplay(disp)
+    frame = screen.render(BACKGROUNDS[0], 812, 90, 42, 21, 40)
+    other = screen.render(BACKGROUNDS[0], 813, 90, 42, 21, 40)
+    flip = [frame, other]
+
+    def push_changed_frame():
+        flip.reverse()
+        panel.display_panel(flip[0])
+
+    results['display.diff_changed'] = measure(push_changed_frame)
+    results['display.diff_identical'] = measure(lambda: panel.display_panel(frame))
+
+    # History page: a new reading drawn into the newest column, and the
+    # page ready for the panel, against the info screen above
+    history = HistoryPage(disp.width, disp.height)
+    seconds = [1700000000]
+
+    def history_add():
+        seconds[0] += 1
+        history.add(seconds[0], [400 + seconds[0] % 1000, seconds[0] % 300])
+
+    results['history.add'] = measure(history_add)
+    results['history.render_convert'] = measure(lambda: image_to_rgb565(history.render([812, 90])))
+    history.panel([812, 90])
+    results['history.panel_hit'] = measure(lambda: history.panel([812, 90]))
+
+    # Expressions: decoding a GIF once, then pushing cached frames
+    os.makedirs(os.path.join(tmp, 'assets'), exist_ok=True)
+    write_sample_gif(os.path.join(tmp, 'assets/calcifer-bench.gif'))
+
+    def decode_expression():
+        ExpressionCache(tmp, disp.width, disp.height).get('bench')
+
+    results['expressions.decode'] = measure(decode_expression, repeat=3)
+
+    expression = ExpressionCache(tmp, disp.width, disp.height).get('bench')
+    frames = iter(())
+
+    def push_expression_frame():
+        nonlocal frames
+        data = next(frames, None)
+        if data is None:
+            frames = iter(expression.frames)
+            data = next(frames)
+        display_rgb565(disp, data)
+
+    results['expressions.push_frame'] = measure(push_expression_frame)
+
+    # MQTT state payload
+    reading = sample_reading()
+    results['mqtt.state_payload'] = measure(lambda: state_message(reading))
+
+    # Logging: queued appends, a batched flush, and a store insert
+    log_writer = LogWriter(flush_bytes=2 ** 30)
+    log_path = os.path.join(tmp, 'result.txt')
+    line = 'CO2: 812 ppm, VOC: 90 ppb, Lux: 123.5 lx | 21.4°C, 1013 hPa, 44.8% RH | 2026-10-18 10:00:00'
+    results['log.append'] = measure(lambda: log_writer.append(log_path, line))
+
+    def flush_batch():
+        for _ in range(100):
+            log_writer.append(log_path, line)
+        log_writer.flush()
+
+    results['log.flush_100_lines'] = measure(flush_batch, repeat=3)
+
+    store = Store(os.path.join(tmp, 'bench.sqlite'), commit_interval=None)
+    index = [0]
+
+    def store_add():
+        index[0] += 1
+        store.add(1700000000 + index[0], {'eco2': 812, 'tvoc': 90, 'temperature': 21.4,
+            'humidity': 44.8, 'pressure': 1013.2, 'lux': 123.5})
+
+    results['store.add_reading'] = measure(store_add)
+    store.close()
+
+    return results
+
+
+def load_baselines():
+    try:
+        with open(BASELINES) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(baselines):
+    with open(BASELINES, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def compare(results, baselines):
+    """Print results next to their baselines, return the regressions.
+    Both are compared as ratios to the reference workload."""
+    regressions = []
+
+    for name, (value, ratio) in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None or 'ratio' not in baseline:
+            print('{:28} {:10.4f} ms {:9.4f}x   (no baseline)'.format(name, value, ratio))
+            continue
+
+        if value < MIN_GATED_MS:
+            print('{:28} {:10.4f} ms {:9.4f}x   baseline {:.4f}x   (not compared, under 1 us)'.format(
+                name, value, ratio, baseline['ratio']))
+            continue
+
+        limit = baseline['ratio'] * baseline.get('threshold', DEFAULT_THRESHOLD)
+        status = 'OK' if ratio <= limit else 'REGRESSION'
+        print('{:28} {:10.4f} ms {:9.4f}x   baseline {:.4f}x, limit {:.4f}x   {}'.format(
+            name, value, ratio, baseline['ratio'], limit, status))
+        if ratio > limit:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', action='store_true', help='store the results as new baselines')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(tmp)
+
+    baselines = load_baselines()
+    regressions = compare(results, baselines.get('benchmarks', {}))
+
+    if args.save:
+        benchmarks = baselines.setdefault('benchmarks', {})
+        for name, (value, ratio) in results.items():
+            threshold = benchmarks.get(name, {}).get('threshold', DEFAULT_THRESHOLD)
+            benchmarks[name] = {'ms': round(value, 4), 'ratio': round(ratio, 5), 'threshold': threshold}
+        save_baselines(baselines)
+        print('Baselines saved to ' + BASELINES)
+    elif regressions:
+        print('Slower than baseline: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Local stand-in for the AirVisual API, to try the IQAir client offline.
+
+Serves nearest_city with whatever the checks ask of it, a good response,
+an API error, a broken body or one too slow to wait for, and checks how
+the client copes: the cache served at startup, stale data kept on
+failures, the quota respected and an unwritable cache survived:
+
+    python3 bench/fake_iqair.py
+    python3 bench/fake_iqair.py --external      # serve for a running Calcifair
+
+With --external, point Calcifair at it with `base_url: http://127.0.0.1:8082/v2`
+in the iqair section of config.yaml.
+
+Exits with an error when any check fails.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from inc.iqair import IQAirClient
+
+
+def nearest_city(aqi, ts):
+    ts = ts.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return {
+        'status': 'success',
+        'data': {
+            'city': 'Madrid',
+            'current': {
+                'weather': {'ts': ts, 'tp': 18, 'pr': 1016, 'hu': 55},
+                'pollution': {'ts': ts, 'aqius': aqi},
+            },
+        },
+    }
+
+
+class FakeAirVisual:
+    """nearest_city server answering in the current mode:
+    'ok', 'error', 'garbage' or 'slow'"""
+
+    def __init__(self, host='127.0.0.1', port=8082):
+        self.mode = 'ok'
+        self.aqi = 42
+        self.age = 0
+        self.delay = 3
+        self.requests = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.requests += 1
+                if not self.path.startswith('/v2/nearest_city'):
+                    self.send_error(404)
+                    return
+
+                if api.mode == 'slow':
+                    time.sleep(api.delay)
+                if api.mode == 'error':
+                    body = json.dumps({'status': 'fail', 'data': {'message': 'call_limit_reached'}})
+                elif api.mode == 'garbage':
+                    body = '<html>Bad gateway</html>'
+                else:
+                    ts = datetime.now(timezone.utc) - timedelta(seconds=api.age)
+                    body = json.dumps(nearest_city(api.aqi, ts))
+
+                body = body.encode()
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # The client gave up on a slow response
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}/v2'.format(host, self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-iqair', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def check(name, ok, detail=''):
+    print('{:40} {}{}'.format(name, 'OK' if ok else 'FAILED', ' ' + detail if detail else ''))
+    return ok
+
+
+def run_checks(api, directory):
+    cache_path = os.path.join(directory, 'iqair-cache.json')
+
+    def client(**kwargs):
+        return IQAirClient(40.4, -3.7, 'token', cache_path, base_url=api.url, **kwargs)
+
+    results = []
+
+    # First start, nothing cached: fetch and cache it
+    iqair = client()
+    results.append(check('nothing cached at first', iqair.current() is None))
+    results.append(check('refresh', iqair.refresh() and iqair.current()['aqi'] == 42))
+    results.append(check('response cached', os.path.exists(cache_path)))
+
+    # Restart: served from the cache with no request, fresh so not refreshed
+    requests = api.requests
+    api.aqi = 99
+    iqair = client()
+    results.append(check('cache served on startup',
+        iqair.current() is not None and iqair.current()['aqi'] == 42 and api.requests == requests))
+    results.append(check('fresh cache not refreshed', not iqair.refresh_if_stale() and api.requests == requests))
+
+    # Failures keep the data there was
+    for mode in ('error', 'garbage'):
+        api.mode = mode
+        results.append(check('{} response keeps the cache'.format(mode),
+            not iqair.refresh() and iqair.current()['aqi'] == 42))
+
+    api.mode = 'slow'
+    started = time.monotonic()
+    iqair = client(timeout=(1, 1))
+    failed = not iqair.refresh()
+    results.append(check('slow response times out', failed and time.monotonic() - started < api.delay,
+        '{:.1f}s'.format(time.monotonic() - started)))
+
+    # Stale data is refreshed, but only once per min_interval, even if
+    # what comes back is still old
+    api.mode = 'ok'
+    api.age = 7200
+    client().refresh()
+    iqair = client(min_interval=3600)
+    refreshed = iqair.refresh_if_stale()
+    requests = api.requests
+    results.append(check('stale cache refreshed', refreshed and iqair.current()['aqi'] == 99))
+    results.append(check('quota respected', not iqair.refresh_if_stale() and api.requests == requests))
+
+    # Cache can't be written: the data is still served, nothing left behind.
+    # A folder in its place makes the rename fail, even for root
+    os.remove(cache_path)
+    os.mkdir(cache_path)
+    api.age = 0
+    api.aqi = 120
+    refreshed = iqair.refresh()
+    leftovers = [name for name in os.listdir(directory) if name.startswith('.iqair-')]
+    results.append(check('unwritable cache survived',
+        refreshed and iqair.current()['aqi'] == 120 and not leftovers))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--external', action='store_true', help='serve for a running Calcifair until stopped')
+    args = parser.parse_args()
+
+    api = FakeAirVisual(port=args.port)
+    api.start()
+    print('Fake AirVisual API on {}'.format(api.url))
+
+    if args.external:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print('{} requests served'.format(api.requests))
+        api.stop()
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_checks(api, directory)
+    api.stop()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
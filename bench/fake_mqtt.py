@@ -0,0 +1,252 @@
+"""Broker outages against MqttPublisher, with a fake paho client.
+
+The fake client delivers to a list instead of a broker, and the broker
+can be taken down and brought back at will, even in the middle of a
+replay. Checks that messages are queued while it is away, that a full
+queue drops the oldest ones, that the rest are replayed in order, and
+that discovery is never dropped and only counts once acknowledged:
+
+    python3 bench/fake_mqtt.py
+    python3 bench/fake_mqtt.py --messages 10000 --queue 2880
+
+Exits with an error when any check fails.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from paho.mqtt import client as mqtt_client
+from inc.mqtt import MqttPublisher
+
+AVAILABILITY_TOPIC = 'homeassistant/sensor/calcifair/availability'
+
+
+class FakeMessageInfo:
+    """What paho's publish() returns, published once the broker acknowledges it"""
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+        self.published = False
+
+    def __getitem__(self, index):
+        return (self.rc, self.mid)[index]
+
+    def is_published(self):
+        return self.published
+
+
+class FakeClient:
+    """The part of paho's Client that MqttPublisher uses, with a broker
+    that is a list of (topic, payload, retain) messages"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.delivered = []
+        self.will = None
+        self.up = False
+        # Publishes that go through before the broker goes away by itself
+        self.fail_after = None
+        # Whether QoS 1 messages are acknowledged, the rest are kept in unacked
+        self.acks = True
+        self.unacked = []
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+
+        self._mid = 0
+        self._lock = threading.Lock()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, retain)
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.up = False
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self._lock:
+            if self.up and self.fail_after == 0:
+                self.fail_after = None
+                self.broker_down()
+            if not self.up:
+                return FakeMessageInfo(mqtt_client.MQTT_ERR_NO_CONN, None)
+            if self.fail_after is not None:
+                self.fail_after -= 1
+
+            self._mid += 1
+            info = FakeMessageInfo(mqtt_client.MQTT_ERR_SUCCESS, self._mid)
+            if qos == 0 or self.acks:
+                self.delivered.append((topic, payload, retain))
+                info.published = True
+            else:
+                self.unacked.append(info)
+
+        if self.on_publish and info.published:
+            self.on_publish(self, None, info.mid)
+        return info
+
+    def broker_up(self):
+        self.up = True
+        self.on_connect(self, None, {}, 0)
+
+    def broker_down(self):
+        self.up = False
+        # Never acknowledged, lost with the connection
+        self.unacked = []
+        if self.will:
+            self.delivered.append(self.will)
+        self.on_disconnect(self, None, 1)
+
+    def readings(self):
+        return [payload for topic, payload, retain in self.delivered if topic == 'state']
+
+    def retained(self, topic):
+        return [payload for t, payload, retain in self.delivered if t == topic and retain]
+
+
+def publisher(max_queue, batch_size):
+    clients = []
+
+    def factory(client_id):
+        clients.append(FakeClient(client_id))
+        return clients[-1]
+
+    mqtt = MqttPublisher('fake', 1883, 'calcifair', AVAILABILITY_TOPIC,
+        max_queue=max_queue, batch_size=batch_size, client_factory=factory)
+    mqtt.start()
+    return mqtt, clients[0]
+
+
+def wait_drained(mqtt, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while mqtt.queue_depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not mqtt.queue_depth()
+
+
+def check(name, ok, detail=''):
+    print('{:40} {}{}'.format(name, 'OK' if ok else 'FAILED', ' ' + detail if detail else ''))
+    return ok
+
+
+def wait_confirmed(mqtt, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while mqtt.unconfirmed() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not mqtt.unconfirmed()
+
+
+def check_discovery():
+    """Discovery sent during an outage that overflows the queue, then
+    to a broker that doesn't acknowledge it"""
+    mqtt, client = publisher(max_queue=10, batch_size=5)
+    results = []
+
+    mqtt.publish_confirmed('config', 'old')
+    mqtt.publish_confirmed('config', 'new')
+    for i in range(50):
+        mqtt.publish('state', str(i))
+    results.append(check('discovery kept through a full queue',
+        mqtt.dropped == 40 and mqtt.unconfirmed() == 1))
+
+    client.broker_up()
+    confirmed = wait_confirmed(mqtt) and wait_drained(mqtt)
+    results.append(check('discovery sent before the queue', confirmed
+        and client.retained('config') == ['new']
+        and client.delivered.index(('config', 'new', True)) < client.delivered.index(('state', '40', False))))
+
+    client.acks = False
+    mqtt.publish_confirmed('config', 'newer')
+    results.append(check('unconfirmed until acknowledged',
+        len(client.unacked) == 1 and mqtt.unconfirmed() == 1))
+
+    client.broker_down()
+    client.acks = True
+    client.broker_up()
+    results.append(check('sent again on reconnection',
+        wait_confirmed(mqtt) and client.retained('config') == ['new', 'newer']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000, help='published during the outage')
+    parser.add_argument('--queue', type=int, default=2880, help='queue size')
+    parser.add_argument('--batch', type=int, default=50, help='replay batch size')
+    args = parser.parse_args()
+
+    mqtt, client = publisher(args.queue, args.batch)
+    results = []
+
+    # Connected: straight to the broker, nothing queued
+    client.broker_up()
+    sent = mqtt.publish('state', 'live')
+    results.append(check('publish while connected', sent and client.readings() == ['live']))
+
+    # Outage longer than the queue holds: the oldest go
+    client.broker_down()
+    started = time.monotonic()
+    for i in range(args.messages):
+        mqtt.publish('state', str(i))
+    elapsed = time.monotonic() - started
+    dropped = max(args.messages - args.queue, 0)
+    results.append(check('queue while disconnected',
+        mqtt.queue_depth() == min(args.messages, args.queue),
+        '{} queued, {:.1f} us per publish'.format(mqtt.queue_depth(), elapsed / args.messages * 1e6)))
+    results.append(check('drop oldest when full', mqtt.dropped == dropped,
+        '{} dropped'.format(mqtt.dropped)))
+    results.append(check('last will on disconnect',
+        client.delivered[-1] == (AVAILABILITY_TOPIC, 'offline', True)))
+
+    # Broker back, but gone again halfway through the replay
+    client.fail_after = args.queue // 2
+    client.broker_up()
+    deadline = time.monotonic() + 10
+    while mqtt.connected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    halfway = len(client.readings())
+    client.broker_up()
+    drained = wait_drained(mqtt)
+
+    expected = ['live'] + [str(i) for i in range(dropped, args.messages)]
+    results.append(check('replay across a second outage', drained and halfway < len(expected),
+        '{} before it, {} after'.format(halfway - 1, len(client.readings()) - halfway)))
+    results.append(check('replay in order, no gaps or repeats', client.readings() == expected))
+    results.append(check('available again after replay',
+        (AVAILABILITY_TOPIC, 'online', True) in client.delivered[-len(expected):]))
+
+    # Queue empty again: new messages go straight out
+    sent = mqtt.publish('state', 'after')
+    results.append(check('publish after replay', sent and client.readings()[-1] == 'after'))
+
+    results.extend(check_discovery())
+
+    print(mqtt.stats())
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Local stand-in for the Telegram Bot API, to try the bot without Telegram.
+
+Serves the few Bot API methods the bot uses, then has several users send
+commands at once, round after round, and times how long each reply takes:
+
+    python3 bench/fake_telegram.py                  # against a bot on a synthetic store
+    python3 bench/fake_telegram.py --users 5 --rounds 20
+    python3 bench/fake_telegram.py --external       # against a running Calcifair
+
+With --external, point Calcifair at it with `base_url: http://127.0.0.1:8081`
+in the telegram section of config.yaml, and authorise users 1, 2, 3...
+"""
+
+import argparse
+import email
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+TOKEN = '123456:fake'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Calcifer', 'username': 'calcifair_bot'}
+
+COMMANDS = ['/status', '/chart co2 24h', '/chart voc 7d', '/status', '/chart temperature 6h']
+
+
+def parse_body(content_type, body):
+    """Parameters of a Bot API call, sent as JSON, a form or multipart"""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        message = email.message_from_bytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+            for part in message.get_payload()}
+    return dict(parse_qsl(body.decode()))
+
+
+class FakeBotApi:
+    """Bot API server keeping updates for the bot and the replies it sends"""
+
+    def __init__(self, host='127.0.0.1', port=8081, token=TOKEN):
+        self.token = token
+        self.updates = []
+        self.replies = {}
+        self.polls = 0
+
+        self._next_update = 1
+        self._condition = threading.Condition()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                params = parse_body(self.headers.get('Content-Type', ''), self.rfile.read(length))
+                prefix = '/bot{}/'.format(api.token)
+                if not self.path.startswith(prefix):
+                    self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+                method = self.path[len(prefix):]
+                handler = getattr(api, 'api_' + method.lower(), None)
+                if handler is None:
+                    self._reply(200, {'ok': True, 'result': True})
+                    return
+                self._reply(200, {'ok': True, 'result': handler(params)})
+
+            do_GET = do_POST
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def send(self, user, text):
+        """A message from a user, returns its chat id to wait for replies"""
+        command = text.split()[0]
+        with self._condition:
+            update_id = self._next_update
+            self._next_update += 1
+            self.updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user, 'type': 'private'},
+                    'from': {'id': user, 'is_bot': False, 'first_name': 'User {}'.format(user)},
+                    'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+                },
+            })
+            self._condition.notify_all()
+        return user
+
+    def wait_reply(self, chat, count, timeout=30):
+        """Wait until the chat has count replies, returns them"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self.replies.get(chat, [])) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No reply in chat {}'.format(chat))
+                self._condition.wait(remaining)
+            return self.replies[chat]
+
+    def wait_polling(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self.polls:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('The bot never asked for updates')
+                self._condition.wait(remaining)
+
+    def _message(self, params, extra):
+        chat = int(params['chat_id'])
+        with self._condition:
+            reply = dict(extra, message_id=self._next_update, date=int(time.time()),
+                chat={'id': chat, 'type': 'private'}, **{'from': BOT_USER})
+            self._next_update += 1
+            self.replies.setdefault(chat, []).append((time.monotonic(), reply))
+            self._condition.notify_all()
+        return reply
+
+    # Bot API methods
+
+    def api_getme(self, params):
+        return BOT_USER
+
+    def api_getupdates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            self.polls += 1
+            self._condition.notify_all()
+            # Updates before the offset are confirmed and can go
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def api_sendmessage(self, params):
+        return self._message(params, {'text': params.get('text', '')})
+
+    def api_sendphoto(self, params):
+        photo = params.get('photo') or b''
+        return self._message(params, {'photo': [
+            {'file_id': 'chart', 'file_unique_id': 'chart', 'width': 800, 'height': 400, 'file_size': len(photo)}]})
+
+
+def synthetic_bot(url, users):
+    """A bot on a store filled with a month of synthetic readings"""
+    import numpy as np
+    from inc.bot import ChartCache, TelegramBot
+    from inc.hardware import Clock, synthetic_sensors
+    from inc.sensors import SensorSampler
+    from inc.store import Store
+
+    tmp = tempfile.mkdtemp(prefix='calcifair-bot-')
+    store = Store(os.path.join(tmp, 'calcifair.sqlite'), commit_interval=None)
+    now = time.time()
+    clock = Clock(start=None, speed=1)
+    sampler = SensorSampler(*synthetic_sensors(clock, seed=1), clock=clock)
+    reading = sampler.sample()
+
+    # A reading every five minutes, good enough for charts
+    rng = np.random.default_rng(1)
+    for ts in np.arange(now - 30 * 86400, now, 300):
+        store.add(ts, {
+            'eco2': 600 + 300 * np.sin(ts / 43200 * np.pi) + rng.normal(0, 30),
+            'tvoc': 60 + 40 * np.sin(ts / 21600 * np.pi) + rng.normal(0, 5),
+            'temperature': 21 + 2 * np.sin(ts / 43200 * np.pi),
+            'humidity': 45 + 5 * np.cos(ts / 43200 * np.pi),
+        })
+    store.commit()
+
+    charts = ChartCache(store, lambda: now)
+    bot = TelegramBot(TOKEN, users, lambda: reading, lambda: None, charts, base_url=url)
+    bot.start()
+    return bot, charts
+
+
+def load(api, users, rounds):
+    """Every user sends a command at once, round after round, returns
+    the reply times in seconds"""
+    latencies = []
+    for round in range(rounds):
+        sent = {}
+        for user in users:
+            sent[user] = time.monotonic()
+            api.send(user, COMMANDS[(round + user) % len(COMMANDS)])
+        for user in users:
+            replied_at, reply = api.wait_reply(user, round + 1)[round]
+            latencies.append(replied_at - sent[user])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=3, help='users asking at once')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--external', action='store_true', help='wait for a running Calcifair instead')
+    args = parser.parse_args()
+
+    api = FakeBotApi(port=args.port)
+    api.start()
+    print('Fake Bot API on {}'.format(api.url))
+
+    users = list(range(1, args.users + 1))
+    if args.external:
+        print('Waiting for the bot, authorise users {}'.format(users))
+    else:
+        bot, charts = synthetic_bot(api.url, users)
+    api.wait_polling()
+
+    started = time.monotonic()
+    latencies = sorted(load(api, users, args.rounds))
+    elapsed = time.monotonic() - started
+
+    print('{} replies in {:.2f}s, median {:.0f} ms, max {:.0f} ms'.format(
+        len(latencies), elapsed, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+    if not args.external:
+        print('Charts rendered {}, served from cache {}'.format(charts.misses, charts.hits))
+
+    # Someone not authorised gets no answer at all
+    stranger = max(users) + 1000
+    api.send(stranger, '/status')
+    try:
+        api.wait_reply(stranger, 1, timeout=2)
+        print('Unauthorised user got a reply')
+        sys.exit(1)
+    except TimeoutError:
+        print('Unauthorised user ignored')
+
+    if not args.external:
+        bot.stop()
+        bot.join(10)
+    api.stop()
+
+
+if __name__ == '__main__':
+    main()
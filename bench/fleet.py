@@ -0,0 +1,196 @@
+"""Load generator for the fleet aggregator, simulating many Calcifair units.
+
+Each simulated unit reads every --interval seconds divided by --speed
+and, like a real one, only sends its state message when a value moved
+past its deadband or the heartbeat is due. Some units hold steady and
+only send the heartbeat, some go silent halfway and some have their
+baseline drift, so the aggregator has something to flag and something
+it shouldn't:
+
+    python3 bench/fleet.py --nodes 500 --speed 100              # to a local broker
+    python3 bench/fleet.py --nodes 500 --direct --seconds 10    # straight into an aggregator
+
+--direct skips the broker and feeds an in-process aggregator (with a
+temporary store) as fast as it takes them, to measure how many messages
+a second it keeps up with on one core, and exits with an error if it
+flagged the wrong units.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from inc.mqtt import state_message, unit_topic
+from inc.sensors import Reading
+from inc.aggregator import Aggregator
+from inc.filters import ReadingFilter
+from inc.store import Store
+
+
+class Node:
+    def __init__(self, index, seed=None):
+        self.name = 'RPi-{:06x}Mon{:06x}-calcifair'.format(index, index * 7919 % 0xffffff)
+        self.topic = 'homeassistant/{}/state'.format(unit_topic(self.name))
+        self.random = random.Random(seed)
+        self.eCO2 = self.random.uniform(450, 900)
+        self.baseline = [self.random.randint(34000, 36000), self.random.randint(34000, 36000)]
+        self.drifting = False
+        # Steady units read the same values every time
+        self.steady = False
+        self.filter = ReadingFilter()
+
+    def reading(self, timestamp):
+        if self.drifting:
+            self.baseline[0] += 200
+        if self.steady:
+            return Reading(timestamp, int(self.eCO2), 50, self.baseline[0], self.baseline[1],
+                21.0, 45.0, 1013.0, 120.0, 0)
+
+        self.eCO2 = min(3000, max(400, self.eCO2 + self.random.gauss(0, 15)))
+        return Reading(
+            timestamp=timestamp,
+            eCO2=int(self.eCO2),
+            TVOC=self.random.randint(0, 300),
+            baseline_eCO2=self.baseline[0],
+            baseline_TVOC=self.baseline[1],
+            temperature=self.random.uniform(18, 26),
+            humidity=self.random.uniform(30, 60),
+            pressure=self.random.uniform(990, 1030),
+            lux=self.random.uniform(0, 500),
+            proximity=0)
+
+    def message(self, timestamp, now):
+        """State message for a new reading, or None if there is nothing
+        to send yet. now is in simulated seconds, for the heartbeat"""
+        self.filter.update(self.reading(timestamp))
+        if not self.filter.publish_due(now):
+            return None
+        return state_message(self.filter.held(), self.name)
+
+
+def fleet(count, silent, drifting, steady, seed=1):
+    nodes = [Node(i, seed=seed + i) for i in range(count)]
+    for node in nodes[:int(count * drifting)]:
+        node.drifting = True
+    for node in nodes[int(count * drifting):int(count * (drifting + steady))]:
+        node.steady = True
+    # The last ones go silent halfway
+    silent_nodes = set(node.name for node in nodes[count - int(count * silent):])
+    return nodes, silent_nodes
+
+
+def direct(nodes, silent_nodes, seconds):
+    tmp = tempfile.mkdtemp(prefix='calcifair-fleet-')
+    store = Store(os.path.join(tmp, 'fleet.sqlite'), commit_interval=None)
+    aggregator = Aggregator(store, capacity=len(nodes), drift_ratio=0.02)
+    changes = []
+    aggregator.on_change = [lambda node, flag, now_set: changes.append((node, flag, now_set))]
+
+    # Simulated time moves a reading interval per round over the fleet
+    start = now = time.time()
+    handling = 0.0
+    flushing = 0.0
+    rounds = 0
+    started = time.monotonic()
+    while time.monotonic() - started < seconds:
+        halfway = time.monotonic() - started > seconds / 2
+        timestamp = datetime.fromtimestamp(now, timezone.utc)
+        messages = [(node.topic, node.message(timestamp, now - start)) for node in nodes
+            if not (halfway and node.name in silent_nodes)]
+        messages = [(topic, message) for topic, message in messages if message is not None]
+
+        t = time.perf_counter()
+        for topic, message in messages:
+            aggregator.handle(topic, message, now=now)
+        handling += time.perf_counter() - t
+
+        t = time.perf_counter()
+        aggregator.flush()
+        flushing += time.perf_counter() - t
+
+        aggregator.check(now)
+        now += 30
+        rounds += 1
+
+    summary = aggregator.summary()
+    print(summary)
+    print('{} rounds, handle {:.1f} us per message ({:.0f} messages/s), store {:.1f} us per message'.format(
+        rounds, handling / summary['received'] * 1e6, summary['received'] / handling,
+        flushing / max(summary['stored'], 1) * 1e6))
+    print('Expected {} silent and {} drifting'.format(
+        len(silent_nodes), sum(node.drifting for node in nodes)))
+
+    # Steady units only send the heartbeat, they shouldn't ever look silent
+    false_alarms = set(node for node, flag, now_set in changes if flag == 'silent') - silent_nodes
+    print('{} simulated hours, {} units wrongly flagged silent'.format(
+        round((now - start) / 3600, 1), len(false_alarms)))
+    return not false_alarms and summary['silent'] == len(silent_nodes)
+
+
+def broker(nodes, silent_nodes, host, port, interval, speed, seconds):
+    from paho.mqtt import client as mqtt_client
+
+    client = mqtt_client.Client()
+    client.connect(host, port)
+    client.loop_start()
+
+    period = interval / speed
+    started = time.monotonic()
+    # Spread the units over the period, like real ones started at random
+    next_send = {node.name: time.monotonic() + random.uniform(0, period) for node in nodes}
+    sent = 0
+    last_report = started
+
+    while time.monotonic() - started < seconds:
+        halfway = time.monotonic() - started > seconds / 2
+        now = time.monotonic()
+        for node in nodes:
+            if next_send[node.name] > now or (halfway and node.name in silent_nodes):
+                continue
+            next_send[node.name] += period
+            message = node.message(datetime.now(timezone.utc), (now - started) * speed)
+            if message is not None:
+                client.publish(node.topic, message)
+                sent += 1
+
+        if now - last_report >= 5:
+            print('{:.0f}s: {} messages sent, {:.0f}/s'.format(now - started, sent, sent / (now - started)))
+            last_report = now
+        time.sleep(min(0.01, period / 10))
+
+    client.loop_stop()
+    client.disconnect()
+    print('{} messages sent in {:.0f}s'.format(sent, time.monotonic() - started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=30, help='seconds between readings of a unit')
+    parser.add_argument('--speed', type=float, default=1, help='times faster than real time')
+    parser.add_argument('--seconds', type=float, default=60, help='how long to run')
+    parser.add_argument('--silent', type=float, default=0.05, help='share of units going silent')
+    parser.add_argument('--drifting', type=float, default=0.05, help='share of units drifting')
+    parser.add_argument('--steady', type=float, default=0.5, help='share of units only sending the heartbeat')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--direct', action='store_true', help='feed an aggregator in this process')
+    args = parser.parse_args()
+
+    nodes, silent_nodes = fleet(args.nodes, args.silent, args.drifting, args.steady)
+    if args.direct:
+        if not direct(nodes, silent_nodes, args.seconds):
+            sys.exit(1)
+    else:
+        broker(nodes, silent_nodes, args.host, args.port, args.interval, args.speed, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Accelerated soak run of the whole of Calcifair, headless.
+
+Copies Calcifair to a temporary folder, runs it with synthetic sensors,
+a memory display and a fast clock, and tracks its RSS and thread count:
+
+    python3 bench/soak.py                 # 24 simulated hours at 200x
+    python3 bench/soak.py --hours 2 --speed 100
+    python3 bench/soak.py --save          # store results as new baselines
+
+The run fails when RSS grows or the thread count goes past the limits in
+bench/baselines.json.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from bench.benchmarks import load_baselines, save_baselines
+
+
+def soak_config(speed):
+    return {
+        'iqair': {'token': 'soak', 'base_url': 'http://127.0.0.1:9/v2'},
+        'location': {'latitude': 40.4, 'longitude': -3.7},
+        'mqtt': {'port': 1883, 'username': None, 'password': None},
+        'hardware': {'sensors': 'synthetic', 'display': 'memory', 'speed': speed, 'seed': 1},
+    }
+
+
+def process_status(pid):
+    """RSS in MB and thread count of a process"""
+    status = {}
+    with open('/proc/{}/status'.format(pid)) as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return int(status['VmRSS'][0]) / 1024, int(status['Threads'][0])
+
+
+def soak(hours, speed, interval):
+    tmp = tempfile.mkdtemp(prefix='calcifair-soak-')
+    shutil.copy(os.path.join(dir_path, 'calcifair.py'), tmp)
+    shutil.copytree(os.path.join(dir_path, 'inc'), os.path.join(tmp, 'inc'))
+    shutil.copytree(os.path.join(dir_path, 'assets'), os.path.join(tmp, 'assets'))
+    os.makedirs(os.path.join(tmp, 'logs'))
+
+    with open(os.path.join(tmp, 'config.yaml'), 'w') as file:
+        yaml.dump(soak_config(speed), file)
+
+    duration = hours * 3600 / speed
+    output_path = os.path.join(tmp, 'logs/soak.txt')
+    samples = []
+
+    with open(output_path, 'w') as output:
+        process = subprocess.Popen([sys.executable, 'calcifair.py'],
+            cwd=tmp, stdout=output, stderr=subprocess.STDOUT)
+
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < duration:
+                time.sleep(interval)
+                if process.poll() is not None:
+                    # Keep the folder to look at the output
+                    raise RuntimeError('Calcifair exited with code {}, see {}'.format(
+                        process.returncode, output_path))
+                rss, threads = process_status(process.pid)
+                samples.append((time.monotonic() - started, rss, threads))
+                print('{:7.0f}s  simulated {:5.1f}h  RSS {:6.1f} MB  threads {}'.format(
+                    samples[-1][0], samples[-1][0] * speed / 3600, rss, threads))
+        finally:
+            process.terminate()
+            process.wait()
+
+    shutil.rmtree(tmp)
+    return samples
+
+
+def summarize(samples):
+    # Leave the first tenth out, while caches and imports settle
+    settled = samples[len(samples) // 10:] or samples
+    return {
+        'rss_start_mb': round(settled[0][1], 1),
+        'rss_end_mb': round(settled[-1][1], 1),
+        'rss_growth_mb': round(settled[-1][1] - settled[0][1], 1),
+        'rss_max_mb': round(max(sample[1] for sample in samples), 1),
+        'threads_max': max(sample[2] for sample in samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hours', type=float, default=24, help='simulated hours')
+    parser.add_argument('--speed', type=float, default=200, help='times faster than real time')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between samples')
+    parser.add_argument('--save', action='store_true', help='store the results as new baselines')
+    args = parser.parse_args()
+
+    summary = summarize(soak(args.hours, args.speed, args.interval))
+    print(summary)
+
+    baselines = load_baselines()
+    limits = baselines.get('soak', {})
+
+    if args.save:
+        baselines['soak'] = {
+            'rss_growth_mb': max(summary['rss_growth_mb'] * 2, 5.0),
+            # A thread per tick would go well past a couple of spare ones
+            'threads_max': summary['threads_max'] + 2,
+        }
+        save_baselines(baselines)
+        print('Soak limits saved')
+        return
+
+    failures = []
+    if 'rss_growth_mb' in limits and summary['rss_growth_mb'] > limits['rss_growth_mb']:
+        failures.append('RSS grew {} MB, limit {} MB'.format(summary['rss_growth_mb'], limits['rss_growth_mb']))
+    if 'threads_max' in limits and summary['threads_max'] > limits['threads_max']:
+        failures.append('{} threads, limit {}'.format(summary['threads_max'], limits['threads_max']))
+
+    if failures:
+        print('Soak run failed: ' + '; '.join(failures))
+        sys.exit(1)
+    print('Soak run passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Daily and weekly summaries across daylight saving time changes.
+
+Stores a reading a minute through the weeks around both changes of a
+year, each local day with its own CO2 value, and checks that the
+summaries split them at local midnight, before and after each change:
+
+    python3 bench/summaries.py
+    python3 bench/summaries.py --tz America/New_York --year 2025
+
+Exits with an error when any check fails.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, dir_path)
+
+from inc.analytics import DAY, WEEK, summarize
+from inc.store import Store
+
+
+def check(name, ok, detail=''):
+    print('{:40} {}{}'.format(name, 'OK' if ok else 'FAILED', ' ' + detail if detail else ''))
+    return ok
+
+
+def changes(year):
+    """Local days on which the UTC offset changes"""
+    days = []
+    day = date(year, 1, 1)
+    while day.year == year:
+        following = day + timedelta(days=1)
+        if time.localtime(local_midnight(day)).tm_gmtoff != time.localtime(local_midnight(following)).tm_gmtoff:
+            days.append(day)
+        day = following
+    return days
+
+
+def local_midnight(day):
+    return time.mktime(day.timetuple())
+
+
+def co2(day):
+    # Different every day, and over the medium limit so every minute counts
+    return 1000 + day.toordinal() % 100
+
+
+def record(store, first, last):
+    """A reading a minute from local midnight of first to that of last"""
+    ts = local_midnight(first)
+    end = local_midnight(last)
+    while ts < end:
+        day = datetime.fromtimestamp(ts).date()
+        store.add(ts, {'eco2': co2(day), 'tvoc': 50})
+        ts += 60
+    store.commit()
+
+
+def check_change(store, day):
+    results = []
+    first = day - timedelta(days=3)
+    summary = summarize(store, local_midnight(first), local_midnight(day + timedelta(days=3)), DAY)
+    days = [row['start'].astimezone() for row in summary]
+
+    results.append(check('{}: days start at local midnight'.format(day),
+        days == [datetime.fromtimestamp(local_midnight(first + timedelta(days=i))).astimezone()
+            for i in range(6)],
+        ', '.join(start.strftime('%d %H:%M') for start in days)))
+    results.append(check('{}: one value per day'.format(day),
+        [(row['eco2_mean'], row['eco2_max']) for row in summary]
+        == [(co2(start.date()), co2(start.date())) for start in days]))
+
+    # The last sample of the range has no time after it, so the last day
+    # is a minute short
+    hours = [row['hours_eco2_medium'] for row in summary[:-1]]
+    length = (local_midnight(day + timedelta(days=1)) - local_midnight(day)) / 3600
+    results.append(check('{}: {:.0f} hours in the day'.format(day, length),
+        hours == [24, 24, 24, length, 24], ' '.join('{:g}'.format(h) for h in hours)))
+
+    weeks = summarize(store, local_midnight(first), local_midnight(day + timedelta(days=3)), WEEK)
+    results.append(check('{}: weeks start on Monday midnight'.format(day),
+        all(row['start'].astimezone().strftime('%a %H:%M') == 'Mon 00:00' for row in weeks)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tz', default='Europe/Madrid', help='time zone with daylight saving time')
+    parser.add_argument('--year', type=int, default=2024)
+    args = parser.parse_args()
+
+    os.environ['TZ'] = args.tz
+    time.tzset()
+
+    days = changes(args.year)
+    if not check('daylight saving time changes', len(days) == 2, ', '.join(map(str, days))):
+        sys.exit(1)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = Store(os.path.join(directory, 'summaries.sqlite'), commit_interval=None)
+        for day in days:
+            record(store, day - timedelta(days=10), day + timedelta(days=10))
+            results.extend(check_change(store, day))
+        store.close()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,50 +10,33 @@ import time
 from time import gmtime, strftime
 import os.path
 from datetime import datetime, timedelta, timezone
-import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import json
-import requests
 import threading
-import board
-import busio
-import adafruit_sgp30
-from adafruit_bme280 import basic as adafruit_bme280
-from ltr559 import LTR559
-import ST7789
 from setproctitle import setproctitle
-import psutil
 from pprint import pprint
 import random
+import signal
+import atexit
 from inc.time import *
-from paho.mqtt import client as mqtt_client
+from inc.startup import StartupTimer
+from inc.instance import acquire_instance_lock
+from inc.tracing import tracer
 
+# Time to splash, first reading and first publish are measured from here
+startup = StartupTimer()
 
-def checkIfProcessRunning(processName):
-    '''
-    Check if there is any running process that contains the given name processName.
-    https://thispointer.com/python-check-if-a-process-is-running-by-name-and-find-its-process-id-pid/
-    '''
-    #Iterate over the all the running process
-    for proc in psutil.process_iter():
-        try:
-            # Check if process name contains the given name string.
-            if processName.lower() in proc.name().lower():
-                return True
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
-    return False
-
+dir_path = os.path.dirname(os.path.realpath(__file__))
 
-# Check if any chrome process was running or not.
-if checkIfProcessRunning('calcifair-main'):
+# Only one Calcifer at a time, the lock is released when the process exits
+instance_lock = acquire_instance_lock(os.path.join(dir_path, '.calcifair.lock'))
+if instance_lock is None:
     print("🔥 Calcifer is awake already")
     exit()
 
 setproctitle('calcifair-main')
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-
 # Load configuration file
 config = None
 file_config = os.path.join(dir_path, 'config.yaml')
@@ -63,44 +46,28 @@ with open(file_config) as file:
 
 # logging.basicConfig(filename='logs/python.txt')
 
-# Set up CO2 & VOC sensor
-i2c = busio.I2C(board.SCL, board.SDA, frequency=100000)
-sgp30 = adafruit_sgp30.Adafruit_SGP30(i2c)
-
-# Set up BME280 temperature, humidity and pressure sensor
-bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c, address=0x76)
-# Source: https://meteologix.com/al/model-charts/euro/comunidad-de-madrid/sea-level-pressure.html
-bme280.sea_level_pressure = 1020
-
-# Set up light and proximity sensor
-ltr559 = LTR559()
-
-# Set up screen
-disp = ST7789.ST7789(
-    port=0,
-    cs=ST7789.BG_SPI_CS_FRONT,  # BG_SPI_CSB_BACK or BG_SPI_CS_FRONT
-    dc=9,
-    backlight=19,               # 18 for back BG slot, 19 for front BG slot.
-    spi_speed_hz=80 * 1000 * 1000
-)
-WIDTH = disp.width
-HEIGHT = disp.height
+# Spans are recorded from here with --trace, or from a first SIGUSR2 on.
+# The next SIGUSR2 stops tracing and writes the trace to logs/
+tracing_config = config.get('tracing') or {}
+if '--trace' in sys.argv or tracing_config.get('enabled'):
+    tracer.start(tracing_config.get('capacity'))
+signal.signal(signal.SIGUSR2, lambda signum, frame: tracer.toggle(os.path.join(dir_path, 'logs')))
 
-# Air quality levels
-# From Hong Kong Indoor Air Quality Management Group
-# https://www.iaq.gov.hk/media/65346/new-iaq-guide_eng.pdf
+# Real devices by default, or simulated ones to run headless
+from inc.display import *
+from inc.hardware import create_clock, create_display, create_sensors
 
-# CO2 levels in ppm
-LIMIT_ECO2_BAD = 1000
-LIMIT_ECO2_MEDIUM = 800
+hardware_config = config.get('hardware') or {}
+clock, recording = create_clock(hardware_config)
 
-# VOC levels in ppb
-LIMIT_TVOC_BAD = 261
-LIMIT_TVOC_MEDIUM = 87
+# Set up screen first so the splash shows up as soon as possible
+with tracer.span('create_display'):
+    disp = create_display(hardware_config, DISPLAY_ROTATION, dir_path)
+WIDTH = disp.width
+HEIGHT = disp.height
 
-# AQI levels
-LIMIT_AQI_BAD = 100
-LIMIT_AQI_MEDIUM = 50
+# Frames go through here so only what changed is sent over SPI
+panel = DiffDisplay(disp, DISPLAY_ROTATION)
 
 def turn_off_display():
     disp.set_backlight(0)
@@ -111,88 +78,143 @@ def turn_on_display():
 
 
 # Initialize display.
-disp.begin()
-
+with tracer.span('splash'):
+    disp.begin()
 
-# Load emoji while starts
-image_path = os.path.join(dir_path, 'assets/emoji-fire.png')
-image = Image.open(image_path)
-disp.display(image)
+    # Load emoji while starts
+    image_path = os.path.join(dir_path, 'assets/emoji-fire.png')
+    image = Image.open(image_path)
+    panel.display(image)
+startup.mark('splash')
 
 # Calcifer says hi
 print("🔥 Calcifer is waking up, please wait...")
 # print("SGP30 serial #", [hex(i) for i in sgp30.serial])
 
+# Everything else is imported once the splash is on screen
+from inc.limits import *
+from inc.analytics import LEVELS, classify_air
+from inc.screen import Screen
+from inc.history import HistoryPage
+from inc.expressions import ExpressionCache
+from inc.animation import Animator
+from inc.sensors import SensorSampler
+from inc.filters import ReadingFilter
+from inc.proximity import ProximityWatcher
+from inc.store import Store
+from inc.persistence import LogWriter, StateFile
+from inc.scheduler import Scheduler
+from inc.metrics import Metrics, NULL_METRICS, rss_bytes
+from inc.checkpoint import Checkpoint, backfill
+
+# Latency histograms and counters, only collected when asked for in config
+metrics_config = config.get('metrics') or {}
+metrics = Metrics() if metrics_config.get('enabled') else NULL_METRICS
+metrics.describe('loop', "Main loop phases")
+metrics.describe('sensor_read', "I2C sensor reads")
+metrics.describe('display', "Frames sent to the panel over SPI")
+metrics.describe('mqtt_publish', "MQTT publish calls")
+metrics.describe('api_request', "External API requests")
 
-def calcifer_expressions(expression, seconds = 5):
-    image_path = None
-
-    try:
-        image_path = os.path.join(dir_path, 'assets/calcifer-' + expression + '.gif')
-        image = Image.open(image_path)
-
-        timeout = time.time() + 5 # 5 seconds from now
-        while True:
-            if time.time() > timeout:
-                break
-            
-            frame = 0
-
-            while frame < image.n_frames:
-                try:
-                    image.seek(frame)
-                    disp.display(image.resize((WIDTH, HEIGHT)))
-                    frame += 1
-                    time.sleep(0.05)
-                except EOFError:
-                    frame = 0
-    except:
-        print('Calcifer expression not found')
-
-
-def air_quality():
-    global sgp30
-    if sgp30:
-        if sgp30.eCO2 and sgp30.TVOC:
-            if sgp30.eCO2 > 1000 or sgp30.TVOC > 261:
-                sgp30.air_quality = "bad"
-            elif sgp30.eCO2 > 800 or sgp30.TVOC > 87:
-                sgp30.air_quality = "medium"
-            else:
-                sgp30.air_quality = "good"
-        else:
-            sgp30.air_quality = "unknown"
-
-
-screen_timeout = 0
 start_time = datetime.now(timezone.utc)
 
-# Initialise air quality sensor
-sgp30.iaq_init()
+# Runtime state lives apart from the config file, so that is never rewritten
+state = StateFile(os.path.join(dir_path, 'state.yaml'))
+state.load()
+
+# Load air quality sensor baseline, from the config file if not moved yet
+sgp30_baseline = state.get('sgp30_baseline') or config.get('sgp30_baseline') or {}
 
-# Load air quality sensor baseline from config file
 baseline_eCO2_restored, baseline_TVOC_restored, baseline_timestamp = None, None, None
-if config['sgp30_baseline']['timestamp'] is not None:
-    baseline_timestamp = config['sgp30_baseline']['timestamp']
+if sgp30_baseline.get('timestamp') is not None:
+    baseline_timestamp = sgp30_baseline['timestamp']
 
     # Ignore stored baseline if older than a week
     if datetime.now(timezone.utc) < baseline_timestamp + timedelta(days=7):
-        baseline_eCO2_restored = config['sgp30_baseline']['eCO2']
-        baseline_TVOC_restored = config['sgp30_baseline']['TVOC']
+        baseline_eCO2_restored = sgp30_baseline['eCO2']
+        baseline_TVOC_restored = sgp30_baseline['TVOC']
 
         print('Stored baseline is recent enough: 0x{:x} 0x{:x} | {}'.format(
             baseline_eCO2_restored,
             baseline_TVOC_restored,
             readable_log_time(baseline_timestamp)))
-
-        # Set baseline
-        sgp30.set_iaq_baseline(
-            baseline_eCO2_restored, baseline_TVOC_restored)
     else:
         print('Stored baseline is too old')
 
-# Calculate https://www.cactus2000.de/uk/unit/masshum.shtml
-# sgp30.set_iaq_humidity(7.5666)
+# Recent readings are checkpointed all the time, so a restart carries on
+# where the previous run left off instead of warming up from scratch
+checkpoint_config = config.get('checkpoint') or {}
+checkpoint = Checkpoint(checkpoint_config.get('path') or os.path.join(dir_path, 'logs/checkpoint.bin'))
+restored = checkpoint.restore()
+baseline_learning_left = 0
+
+if restored is not None and restored.reading.baseline_eCO2:
+    checkpoint_time = restored.reading.timestamp
+
+    # The baseline the sensor had a moment ago beats the hourly stored one
+    if (datetime.now(timezone.utc) < checkpoint_time + timedelta(days=7)
+            and (baseline_timestamp is None or checkpoint_time > baseline_timestamp)):
+        baseline_eCO2_restored = restored.reading.baseline_eCO2
+        baseline_TVOC_restored = restored.reading.baseline_TVOC
+        if restored.baseline_valid_at is not None:
+            # Still learning when the previous run stopped, carry on with what was left
+            baseline_learning_left = max(0, restored.baseline_valid_at - checkpoint_time.timestamp())
+        else:
+            baseline_learning_left = 12 * 3600
+
+        print('Checkpoint baseline: 0x{:x} 0x{:x} | {}'.format(
+            baseline_eCO2_restored,
+            baseline_TVOC_restored,
+            readable_log_time(checkpoint_time)))
+
+
+def init_sensors():
+    # Hardware libraries are slow to import, so they load in the background
+    with tracer.span('create_sensors'):
+        air, environment, light = create_sensors(hardware_config, clock, recording)
+
+    if baseline_eCO2_restored is not None and baseline_TVOC_restored is not None:
+        # Set baseline
+        air.set_baseline(baseline_eCO2_restored, baseline_TVOC_restored)
+
+    # Calculate https://www.cactus2000.de/uk/unit/masshum.shtml
+    # sgp30.set_iaq_humidity(7.5666)
+
+    return air, environment, light
+
+
+# Sensors and animations are set up while the network side starts
+startup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup')
+sensors_init = startup_pool.submit(init_sensors)
+
+# Load fonts and backgrounds for the info screen
+with tracer.span('load_screen'):
+    screen = Screen(dir_path, WIDTH, HEIGHT, rotation=DISPLAY_ROTATION)
+    history_config = config.get('history') or {}
+    history = HistoryPage(WIDTH, HEIGHT, minutes=history_config.get('minutes') or 30, rotation=DISPLAY_ROTATION)
+
+# Decode Calcifer expressions once, ready to be pushed to the screen
+expressions_cache = ExpressionCache(dir_path, WIDTH, HEIGHT)
+startup_pool.submit(expressions_cache.preload)
+
+
+# Expressions play on their own thread, the main loop keeps going meanwhile
+animator = Animator(panel, WIDTH, HEIGHT, DISPLAY_ROTATION, metrics=metrics)
+animator.start()
+
+
+def calcifer_expressions(expression, seconds = 5):
+    try:
+        animator.play(expressions_cache.get(expression), seconds, overlay=screen.readings_box)
+    except (OSError, EOFError):
+        print('Calcifer expression not found')
+
+
+def air_quality(reading):
+    if reading and reading.eCO2 and reading.TVOC:
+        return LEVELS[classify_air(reading.eCO2, reading.TVOC)]
+    return "unknown"
+
 
 try:
     result_log = os.path.join(dir_path, 'logs/sgp30-result.txt')
@@ -201,64 +223,89 @@ try:
 except:
     print('Error creating log files')
 
-baseline_log_counter = datetime.now(timezone.utc) + timedelta(minutes=10)
+# Log appends are batched and written from a background thread
+log_writer = LogWriter()
 
-# If there are not baseline values stored, wait 12 hours before saving every hour
-if baseline_eCO2_restored is None or baseline_TVOC_restored is None:
-    baseline_log_counter_valid = datetime.now(timezone.utc) + timedelta(hours=12)
-    print('Calcifer will store a valid baseline in 12 hours')
-else:
-    baseline_log_counter_valid = datetime.now(timezone.utc) + timedelta(hours=1)
-
-# External air quality provided by AirVisual (IQAir)
-# Based on US EPA National Ambient Air Quality Standards https://support.airvisual.com/en/articles/3029425-what-is-aqi
-# <50, Good; 51-100, Moderate (ventilation is discouraged); >101, Unhealthy
-
-iqair_query = 'https://api.airvisual.com/v2/nearest_city?lat={}&lon={}&key={}'.format(
-    config['location']['latitude'], config['location']['longitude'], config['iqair']['token'])
-iqair_result, iqair_current = None, {}
-
-print(iqair_query)
-
-def update_iqair_result():
-    global iqair_result, iqair_query, iqair_current
-    iqair_result = requests.get(iqair_query)
-    iqair_result = iqair_result.json()
-    
-    if iqair_result['status'] == 'success':
-        iqair_results_current = iqair_result['data']['current']
-
-        iqair_current['temp'] = iqair_results_current['weather']['tp']
-        iqair_current['pressure'] = iqair_results_current['weather']['pr']
-        iqair_current['humidity'] = iqair_results_current['weather']['hu']
-        iqair_current['weather_timestamp'] = dateutil.parser.parse(iqair_results_current['weather']['ts'])
-
-        iqair_current['aqi'] = iqair_results_current['pollution']['aqius']
-        iqair_current['pollution_timestamp'] = dateutil.parser.parse(
-        iqair_results_current['pollution']['ts'])
-
-        iqair_message = "Outdoors: {}°C, {} hPa, {}% RH, AQI {} | Data time: {} | Log time: {}".format(
-            iqair_current['temp'],
-            iqair_current['pressure'],
-            iqair_current['humidity'],
-            iqair_current['aqi'],
-            readable_log_time( iqair_current['pollution_timestamp'] ),
-            datetime.now().strftime(readable_time_format) )
-
-        print(iqair_message)
-        
-        # Log iqair results
-        with open(iqair_log, 'a') as file:
-            file.write(iqair_message + '\n')
-        
-        return
-    else:
-        print("AirVisual API error: {}".format(iqair_result['status']))
-        print(iqair_query)
+# Time-series store for readings, with minute and hour rollups
+store = Store(
+    os.path.join(dir_path, 'logs/calcifair.sqlite'),
+    retention_days=(config.get('store') or {}).get('retention_days'),
+    commit_interval=None)
+log_writer.on_flush.append(store.maintain)
+log_writer.start()
+
+# Readings the previous run took but never committed
+if restored is not None:
+    recovered = backfill(store, restored.recent)
+    if recovered:
+        print('Recovered {} readings from the checkpoint'.format(recovered))
+
+# History charts carry on from the readings stored before a restart
+with tracer.span('history.seed'):
+    history.seed(store, clock.timestamp())
+
+# pkill sends SIGTERM. The main loop stops at the end of its turn and
+# Calcifair exits normally from there, so pending writes are flushed.
+# Raising SystemExit from the handler instead could land anywhere,
+# even in the middle of the interpreter shutting down
+stopping = threading.Event()
+signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+atexit.register(log_writer.stop)
+
+
+def dump_trace():
+    if tracer.enabled:
+        tracer.toggle(os.path.join(dir_path, 'logs'))
+
+
+atexit.register(dump_trace)
+
+# External air quality provided by AirVisual (IQAir), served from a cache
+from inc.iqair import IQAirClient, IQAIR_URL
 
-    threading.Timer(1800.0, update_iqair_result).start()
+iqair = IQAirClient(
+    config['location']['latitude'],
+    config['location']['longitude'],
+    config['iqair']['token'],
+    os.path.join(dir_path, 'logs/iqair-cache.json'),
+    base_url=config['iqair'].get('base_url') or IQAIR_URL,
+    metrics=metrics)
 
-update_iqair_result()
+
+def on_iqair_update(iqair_current):
+    iqair_message = "Outdoors: {}°C, {} hPa, {}% RH, AQI {} | Data time: {} | Log time: {}".format(
+        iqair_current['temp'],
+        iqair_current['pressure'],
+        iqair_current['humidity'],
+        iqair_current['aqi'],
+        readable_log_time( iqair_current['pollution_timestamp'] ),
+        datetime.now().strftime(readable_time_format) )
+
+    print(iqair_message)
+
+    store.add(iqair_current['weather_timestamp'].timestamp(), {
+        'outdoor_temperature': iqair_current['temp'],
+        'outdoor_pressure': iqair_current['pressure'],
+        'outdoor_humidity': iqair_current['humidity'],
+    })
+    store.add(iqair_current['pollution_timestamp'].timestamp(), {
+        'outdoor_aqi': iqair_current['aqi'],
+    })
+
+    # Log iqair results
+    log_writer.append(iqair_log, iqair_message)
+
+
+iqair.on_update = on_iqair_update
+
+# Don't wait for the network, the cached data is shown meanwhile
+iqair.refresh_in_background()
+
+# Periodic jobs run from a single scheduler instead of chained timers.
+# Timeouts stay in real seconds, they are about how long the work takes
+scheduler = Scheduler()
+scheduler.every('iqair', clock.interval(300.0), iqair.refresh_if_stale, jitter=clock.interval(30.0), timeout=60.0)
+scheduler.start()
 
 # for MQTT
 
@@ -293,316 +340,329 @@ print('mac lt=[{}], rt=[{}], mac=[{}]'.format(
     mac_left, mac_right, mac_basic))
 uniqID = "RPi-{}Mon{}-calcifair".format(mac_left, mac_right)
 
-mqtt_connected = False  # global variable for the state of the connection
+from inc.mqtt import (LEGACY_TOPICS, MqttPublisher, compact_json, config_hash,
+    discovery_configs, state_message, unit_topic)
 
-mqtt_client_id = "homeassistant"
-mqtt_broker = local_ip
+mqtt_prefix = "homeassistant"
+# A broker shared by several units can be set, the local one by default.
+# Each unit connects and publishes as itself, so they don't clash there
+mqtt_broker = config['mqtt'].get('host') or local_ip
 mqtt_port = config['mqtt']['port']
 mqtt_username = config['mqtt']['username']
 mqtt_password = config['mqtt']['password']
+mqtt_client_id = uniqID
+mqtt_topic = unit_topic(uniqID)
+mqtt_availability_topic = f"{mqtt_prefix}/{mqtt_topic}/availability"
 
 
-def connect_mqtt():
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected to MQTT broker")
-        else:
-            print("Failed to connect to MQTT broker, return code %d\n", rc)
+def publish_mqtt(topic, msg, retain=False):
+    topic = mqtt_prefix + "/" + topic
 
-    client = mqtt_client.Client(mqtt_client_id)
-    client.username_pw_set(mqtt_username, mqtt_password)
-    client.on_connect = on_connect
-    client.connect(mqtt_broker, mqtt_port)
-    return client
+    msg = f"{msg}"
+    with metrics.timer('mqtt_publish'):
+        published = mqtt.publish(topic, msg, retain=retain)
+    if not published:
+        print(f"Message to topic {topic} queued")
+    return published
+
+
+# Messages are queued while the broker is unreachable and replayed later
+mqtt = MqttPublisher(
+    mqtt_broker,
+    mqtt_port,
+    mqtt_client_id,
+    mqtt_availability_topic,
+    username=mqtt_username,
+    password=mqtt_password,
+    max_queue=(config['mqtt'].get('queue_size') or 2880))
+mqtt.start()
+
+# Home Assistant discovery, one config per sensor in inc/registry.py. They
+# are retained, so they only go out again when something in them changes,
+# and are kept for the broker until it acknowledges them
+discovery = discovery_configs(mqtt_prefix, uniqID, mqtt_availability_topic)
+discovery_hash = config_hash(discovery, mqtt_broker, mqtt_port)
+discovery_pending = state.get('discovery_hash') != discovery_hash
+if discovery_pending:
+    for topic in LEGACY_TOPICS:
+        mqtt.publish_confirmed(f"{mqtt_prefix}/{topic}", "")
+    for topic, payload in discovery:
+        mqtt.publish_confirmed(f"{mqtt_prefix}/{topic}", compact_json(payload))
+else:
+    print("Home Assistant discovery unchanged, not published")
 
+# Sensors were set up in the background meanwhile
+with tracer.span('wait_sensors'):
+    air_sensor, environment_sensor, light_sensor = sensors_init.result()
 
-def publish_mqtt(topic, msg, retain=False):
-    global mqtt
+# From now on only the sampler reads the sensors
+# Readings are smoothed, spikes dropped and jitter held back before anyone sees them
+readings_filter = ReadingFilter(config.get('filters'), clock=clock)
+sampler = SensorSampler(air_sensor, environment_sensor, light_sensor, clock=clock,
+    metrics=metrics, filters=readings_filter)
 
-    topic = mqtt_client_id + "/" + topic
+# A recent enough snapshot is shown at once, while the SGP30 warms up
+if restored is not None and clock.now() - restored.reading.timestamp < timedelta(seconds=checkpoint_config.get('max_age') or 900):
+    sampler.seed(restored.reading)
+    print('Showing the readings from {}'.format(readable_log_time(restored.reading.timestamp)))
 
-    msg = f"{msg}"
-    result = mqtt.publish(topic, msg, retain=retain)
-
-    status = result[0]
-    if status != 0:
-        print(f"Failed to send message to topic {topic}")
-
-
-mqtt = connect_mqtt()
-mqtt.loop_start()
-
-# Configuration topics and payloads
-mqtt_eco2_config = {
-    "uniq_id": f"{uniqID}_co2",
-    "name": "CO2",
-    "device_class": "carbon_dioxide",
-    "state_topic": f"{mqtt_client_id}/sensor/calcifair/state",
-    "unit_of_measurement": "ppm",
-    "value_template": "{{ value_json.eco2 }}",
-    "dev": {
-        "identifiers": [uniqID],
-        "name": "Calcifair"
-    }
-}
-
-mqtt_tvoc_config = {
-    "uniq_id": f"{uniqID}_voc",
-    "name": "VOC",
-    "device_class": "volatile_organic_compounds",
-    "state_topic": f"{mqtt_client_id}/sensor/calcifair/state",
-    "unit_of_measurement": "ppb",
-    "value_template": "{{ value_json.tvoc }}",
-    "pl_avail": "online",
-    "pl_not_avail": "offline",
-    "dev": {
-        "identifiers": [uniqID],
-        "name": "Calcifair"
-    }
-}
-
-mqtt_lux_config = {
-    "uniq_id": f"{uniqID}_lux",
-    "name": "Light",
-    "device_class": "illuminance",
-    "state_topic": f"{mqtt_client_id}/sensor/calcifair/state",
-    "unit_of_measurement": "lx",
-    "value_template": "{{ value_json.lux }}",
-    "pl_avail": "online",
-    "pl_not_avail": "offline",
-    "dev": {
-        "identifiers": [uniqID],
-        "name": "Calcifair"
-    }
-}
-
-mqtt_temperature_config = {
-    "uniq_id": f"{uniqID}_temperature",
-    "name": "Temperature",
-    "device_class": "temperature",
-    "state_topic": f"{mqtt_client_id}/sensor/calcifair/state",
-    "unit_of_measurement": "°C",
-    "value_template": "{{ value_json.temperature }}",
-    "pl_avail": "online",
-    "pl_not_avail": "offline",
-    "dev": {
-        "identifiers": [uniqID],
-        "name": "Calcifair"
-    }
-}
-
-mqtt_humidity_config = {
-    "uniq_id": f"{uniqID}_humidity",
-    "name": "Humidity",
-    "device_class": "humidity",
-    "state_topic": f"{mqtt_client_id}/sensor/calcifair/state",
-    "unit_of_measurement": "%",
-    "value_template": "{{ value_json.humidity }}",
-    "pl_avail": "online",
-    "pl_not_avail": "offline",
-    "dev": {
-        "identifiers": [uniqID],
-        "name": "Calcifair"
-    }
-}
+sampler.start()
+sampler.wait()
+startup.mark('first_reading')
+
+# Proximity is watched on its own, polling fast only when someone is around
+proximity = ProximityWatcher(light_sensor, sampler.lock, clock=clock)
+proximity.start()
+
+
+def latest_timestamp():
+    reading = sampler.latest()
+    return reading.timestamp.timestamp() if reading else clock.timestamp()
+
+
+# Telegram bot, answering from the latest snapshot and the store
+telegram_config = config.get('telegram') or {}
+if telegram_config.get('token') and telegram_config.get('users'):
+    from inc.bot import ChartCache, TelegramBot, TELEGRAM_URL
+
+    telegram_bot = TelegramBot(
+        telegram_config['token'],
+        telegram_config['users'],
+        lambda: readings_filter.held() or sampler.latest(),
+        iqair.current,
+        ChartCache(store, latest_timestamp),
+        base_url=telegram_config.get('base_url') or TELEGRAM_URL)
+    telegram_bot.start()
+
+baseline_log_counter = clock.now() + timedelta(minutes=10)
+
+# If there are not baseline values stored, wait 12 hours before saving every hour
+if baseline_eCO2_restored is None or baseline_TVOC_restored is None:
+    baseline_log_counter_valid = clock.now() + timedelta(hours=12)
+    print('Calcifer will store a valid baseline in 12 hours')
+elif baseline_learning_left > 0:
+    baseline_log_counter_valid = clock.now() + timedelta(seconds=baseline_learning_left)
+    print('Calcifer will store a valid baseline in {:.1f} hours'.format(baseline_learning_left / 3600))
+else:
+    baseline_log_counter_valid = clock.now() + timedelta(hours=1)
+
+# A restart before then carries on with the learning time left
+if baseline_eCO2_restored is None or baseline_learning_left > 0:
+    checkpoint.set_baseline_valid_at(baseline_log_counter_valid.timestamp())
+else:
+    checkpoint.set_baseline_valid_at(clock.timestamp())
+atexit.register(checkpoint.sync)
 
-publish_mqtt("sensor/calcifair/eco2/config", json.dumps(mqtt_eco2_config), retain=True)
-publish_mqtt("sensor/calcifair/tvoc/config", json.dumps(mqtt_tvoc_config), retain=True)
-publish_mqtt("sensor/calcifair/lux/config", json.dumps(mqtt_lux_config), retain=True)
-publish_mqtt("sensor/calcifair/temperature/config", json.dumps(mqtt_temperature_config), retain=True)
-publish_mqtt("sensor/calcifair/humidity/config", json.dumps(mqtt_humidity_config), retain=True)
 
 def send_to_mqtt():
-    global bme280, sgp30, ltr559
-
-    state = {
-        "timestamp": datetime.now().isoformat(),
-        "eco2": sgp30.eCO2,
-        "tvoc": sgp30.TVOC,
-        "temperature": "{:0.1f}".format(bme280.temperature),
-        "humidity": "{:0.0f}".format(bme280.humidity),
-        "baseline_eco2": sgp30.baseline_eCO2,
-        "baseline_tvoc": sgp30.baseline_TVOC,
-        "lux": "{:0.1f}".format( ltr559.get_lux() )
-    }
-    
-    publish_mqtt("sensor/calcifair/state", json.dumps(state))
+    global discovery_pending
+
+    # Discovery is only taken as done once the broker has acknowledged all of it
+    if discovery_pending and not mqtt.unconfirmed():
+        state.set('discovery_hash', discovery_hash)
+        discovery_pending = False
+
+    reading = readings_filter.held()
+
+    # Not while the SGP30 warms up, its values would be the previous run's
+    if sampler.is_seeded(sampler.latest()):
+        return
+
+    # Only when something moved past its deadband, or for the heartbeat
+    if not readings_filter.publish_due():
+        return
+
+    if reading is not None:
+        if publish_mqtt(f"{mqtt_topic}/state", state_message(reading, uniqID)):
+            startup.mark('first_publish')
 
     # print(result_human)
-    print("Readings published via MQTT")
+    if mqtt.queue_depth():
+        print("Readings queued for MQTT: {queue_depth} queued, {dropped} dropped".format(**mqtt.stats()))
+    else:
+        print("Readings published via MQTT")
+
 
-    threading.Timer(30.0, send_to_mqtt).start()
+# Start sending data to MQTT after 30 seconds
+scheduler.every('mqtt', clock.interval(30.0), send_to_mqtt, timeout=10.0)
 
 
-def send_to_mqtt_run():
-    global aio, bme280, sgp30, ltr559
-    # Start sending data to MQTT after 3 min
-    threading.Timer(30.0, send_to_mqtt).start()
+def iqair_age():
+    if iqair.last_success is None:
+        return None
+    return round(time.time() - iqair.last_success, 1)
 
 
-send_to_mqtt_run()
+if metrics is not NULL_METRICS:
+    # Counters and gauges are read from each part only when collected
+    metrics.counter('mqtt_published_total', "MQTT messages published", lambda: mqtt.published)
+    metrics.counter('mqtt_failed_total', "MQTT publishes that failed", lambda: mqtt.failed)
+    metrics.counter('mqtt_dropped_total', "MQTT messages dropped from a full queue", lambda: mqtt.dropped)
+    metrics.counter('api_requests_total', "AirVisual API requests", lambda: iqair.requests)
+    metrics.counter('api_errors_total', "AirVisual API requests that failed", lambda: iqair.errors)
+    metrics.counter('sensor_errors_total', "Sensor passes that failed", lambda: sampler.errors)
+    metrics.counter('proximity_errors_total', "Proximity reads that failed", lambda: proximity.errors)
+    metrics.counter('display_bytes_total', "Bytes sent to the panel", lambda: panel.bytes_sent)
+    metrics.counter('late_frames_total', "Expression frames shown late", lambda: animator.late_frames)
+    metrics.gauge('threads', "Running threads", threading.active_count)
+    metrics.gauge('rss_bytes', "Resident memory", rss_bytes)
+    metrics.gauge('mqtt_queue_depth', "MQTT messages waiting for the broker", mqtt.queue_depth)
+    metrics.gauge('iqair_age_seconds', "Seconds since the last good AirVisual update", iqair_age)
+
+    if metrics_config.get('port'):
+        try:
+            metrics.serve(metrics_config.get('host') or '127.0.0.1', metrics_config['port'])
+        except OSError as e:
+            print("Metrics server failed to start: {}".format(e))
+
+    if metrics_config.get('mqtt_interval'):
+        scheduler.every('metrics', float(metrics_config['mqtt_interval']),
+            lambda: publish_mqtt(f"{mqtt_topic}/metrics", json.dumps(metrics.snapshot()), retain=True),
+            timeout=10.0)
 
 # Wait while sensor warms up
-warmup_counter = datetime.now(timezone.utc) + timedelta(seconds=30)
-while datetime.now(timezone.utc) < warmup_counter:
-    if sgp30.eCO2 > 400 and sgp30.TVOC > 0:
+warmup_counter = clock.now() + timedelta(seconds=30)
+while clock.now() < warmup_counter:
+    reading = sampler.latest()
+    if reading and reading.eCO2 > 400 and reading.TVOC > 0:
         break
-    time.sleep(1)
+    clock.sleep(1)
 
 checking_good = False
 checking_good_count = 0
 checking_bad = False
 checking_bad_count = 0
 background_img = None
-proximity_count = 0
+expression_shown = False
+# The info screen and the history page take turns while the screen is on
+history_page_seconds = history_config.get('page_seconds', 5)
+showing_history = False
+page_shown_at = clock.timestamp()
+# The seeded snapshot is in the store already
+stored_reading = restored.reading if restored is not None else None
 
-while True:
-    air_quality()
+while not stopping.is_set():
+    loop_started = time.perf_counter()
+    reading = sampler.wait()
+    quality = air_quality(reading)
 
-    # Get proximity
-    ltr559.update_sensor()
-    lux = ltr559.get_lux()
-    prox = ltr559.get_proximity()
-    # print("Lux: {:06.2f}, Proximity: {:04d}".format(lux, prox))
+    # print("Lux: {:06.2f}, Proximity: {:04d}".format(reading.lux, reading.proximity))
 
     # Get air quality
     # https://mkaz.blog/code/python-string-format-cookbook/
     result_human = 'CO2: {} ppm, VOC: {} ppb, Lux: {:.1f} lx | {:.1f}°C, {:.0f} hPa, {:.1f}% RH | {}'.format(
-        sgp30.eCO2,
-        sgp30.TVOC,
-        lux,
-        bme280.temperature,
-        bme280.pressure,
-        bme280.humidity,
-        datetime.now().strftime(readable_time_format))
+        reading.eCO2,
+        reading.TVOC,
+        reading.lux,
+        reading.temperature,
+        reading.pressure,
+        reading.humidity,
+        reading.timestamp.astimezone().strftime(readable_time_format))
 
     # Log baseline
     baseline_human = 'CO2: {0} 0x{0:x}, VOC: {1} 0x{1:x} | {2}'.format(
-        sgp30.baseline_eCO2,
-        sgp30.baseline_TVOC,
-        datetime.now().strftime(readable_time_format))
+        reading.baseline_eCO2,
+        reading.baseline_TVOC,
+        reading.timestamp.astimezone().strftime(readable_time_format))
+
+    # The sampler may not have a new reading every time around the loop,
+    # e.g. when it comes back early on a wake. Readings with the values of
+    # the previous run standing in for the warming up SGP30 are only shown
+    new_reading = reading is not stored_reading and not sampler.is_seeded(reading)
+    if new_reading:
+        with metrics.timer('loop', phase='store'), tracer.span('store'):
+            store.add_reading(reading)
+        checkpoint.add(reading)
+        history.add_reading(reading)
+        stored_reading = reading
+
+    baseline_values = {
+        'baseline_eco2': reading.baseline_eCO2,
+        'baseline_tvoc': reading.baseline_TVOC,
+    }
 
-    if datetime.now(timezone.utc) > baseline_log_counter:
-        with open(result_log, 'a') as file:
-            file.write(result_human + '\n')
+    if new_reading and clock.now() > baseline_log_counter:
+        log_writer.append(result_log, result_human)
 
-    if datetime.now(timezone.utc) > baseline_log_counter_valid:
-        baseline_log_counter_valid = datetime.now(timezone.utc) + timedelta(hours=1)
+    if clock.now() > baseline_log_counter_valid:
+        baseline_log_counter_valid = clock.now() + timedelta(hours=1)
         print("Valid baseline: " + baseline_human)
-        with open(baseline_log, 'a') as file:
-            file.write("Valid: " + baseline_human + '\n')
+        log_writer.append(baseline_log, "Valid: " + baseline_human)
+        store.add(reading.timestamp.timestamp(), baseline_values)
 
         # Store new valid baseline
-        config['sgp30_baseline']['eCO2'] = sgp30.baseline_eCO2
-        config['sgp30_baseline']['TVOC'] = sgp30.baseline_TVOC
-        config['sgp30_baseline']['timestamp'] = datetime.now(timezone.utc)
-
-        with open(file_config, 'w') as file:
-            yaml.dump(config, file)
-            print('Baseline updated on config file')
+        state.set('sgp30_baseline', {
+            'eCO2': reading.baseline_eCO2,
+            'TVOC': reading.baseline_TVOC,
+            'timestamp': clock.now(),
+        })
+        print('Baseline updated on state file')
 
-    elif datetime.now(timezone.utc) > baseline_log_counter:
-        baseline_log_counter = datetime.now(timezone.utc) + timedelta(minutes=10)
+    elif clock.now() > baseline_log_counter:
+        baseline_log_counter = clock.now() + timedelta(minutes=10)
 
         print("Baseline: " + baseline_human)
-        with open(baseline_log, 'a') as file:
-            file.write(baseline_human + '\n')
-
-    # Screen alerts
-    if prox >= 5:
-        screen_timeout = 10  # seconds the screen will stay on
-        proximity_count += 1
-    else:
-        proximity_count = 0
-
-    # What to show if screen on over 3 seconds
-    if proximity_count >= 3:
+        log_writer.append(baseline_log, baseline_human)
+        store.add(reading.timestamp.timestamp(), baseline_values)
+
+    # What to show if screen on over 3 seconds, once per approach
+    if not proximity.near:
+        expression_shown = False
+    elif proximity.near_for() >= 3 and not expression_shown:
+        expression_shown = True
         turn_on_display()
 
         expressions = ['idle', 'talks']
         expression = random.choice(expressions)
         calcifer_expressions(expression)
-        proximity_count == 0
 
     # What to show immediately
-    if prox >= 5 or screen_timeout > 0:
-        screen_timeout -= 1
-
+    if proximity.awake:
         turn_on_display()
 
-        color = (255, 255, 255)
-        background_color = (0, 0, 0)
-
         # Animated background
         if ( background_img == 'background.png' ):
             background_img = 'background-alt.png'
         else:
             background_img = 'background.png'
 
-        image_path = os.path.join(
-            dir_path, 'assets/', background_img)
-        img = Image.open(image_path)
-
-        draw = ImageDraw.Draw(img)
-
-        font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 30)
-        font_bold = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 30)
-        font_small = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 20)
-
-        draw.rectangle((0, 0, disp.width, 80), background_color)
-
-        draw.text((10, 10), 'CO2', font=font, fill=color)
-        if (sgp30.eCO2 <= 400):
-            draw.text((10, 45), '<400', font=font_bold, fill=color)
-        else:
-            draw.text((10, 45), str(sgp30.eCO2), font=font_bold, fill=color)
-        draw.text((10, 80), 'ppm', font=font, fill=color)
-
-        draw.text((125, 10), 'VOC', font=font, fill=color)
-        draw.text((125, 45), str(sgp30.TVOC), font=font_bold, fill=color)
-        draw.text((125, 80), 'ppb', font=font, fill=color)
-
-        # Rather accessible traffic lights from https://uxdesign.cc/beautiful-accessible-traffic-light-colors-b2b14a102a38
-        green = (125, 142, 40)
-        yellow = (252, 202, 67)
-        red = (171, 7, 48)
-
-        color_eCO2 = green
-        if (sgp30.eCO2 >= LIMIT_ECO2_BAD):
-            color_eCO2 = red
-        elif (sgp30.eCO2 >= LIMIT_ECO2_MEDIUM):
-            color_eCO2 = yellow
-
-        draw.text((10, 120), '●', font=font, fill=color_eCO2)
-
-        color_TVOC = green
-        if (sgp30.TVOC >= LIMIT_TVOC_BAD):
-            color_TVOC = red
-        elif (sgp30.TVOC >= LIMIT_TVOC_MEDIUM):
-            color_TVOC = yellow
-
-        color_AQI = green
-        if (iqair_current['aqi'] >= LIMIT_AQI_BAD):
-            color_AQI = red
-        elif (iqair_current['aqi'] >= LIMIT_AQI_MEDIUM):
-            color_AQI = yellow
-        
-        draw.text((125, 120), '●', font=font, fill=color_TVOC)
-
-        draw.text((125, 160), '■', font=font_small, fill=color_AQI)
-        draw.text((148, 160), 'AQI ' + str(iqair_current['aqi']), font=font_small, fill=color)
-
-        draw.text((125, 185), str(
-            iqair_current['temp']) + '°C', font=font_small, fill=color)
-        draw.text((125, 210), str(iqair_current['humidity']) + '% RH', font=font_small, fill=color)
-
-        disp.display(img)
+        # Pages only turn while no expression plays, the readings over it come from the info screen
+        if animator.playing:
+            showing_history = False
+        elif history_page_seconds and clock.timestamp() - page_shown_at >= history_page_seconds:
+            showing_history = not showing_history
+            page_shown_at = clock.timestamp()
+
+        # Held values, so the digits don't flicker with every bit of jitter
+        shown = readings_filter.held() or reading
+        outdoor = iqair.current() or {}
+        with metrics.timer('loop', phase='render'), tracer.span('render'):
+            if showing_history:
+                frame = history.panel([shown.eCO2, shown.TVOC])
+            else:
+                frame = screen.render(
+                    background_img,
+                    shown.eCO2,
+                    shown.TVOC,
+                    outdoor.get('aqi'),
+                    outdoor.get('temp'),
+                    outdoor.get('humidity'))
+
+        with metrics.timer('loop', phase='show'), tracer.span('show'):
+            animator.show_frame(frame)
     else:
+        animator.stop_expression()
         turn_off_display()
+        # The info screen comes first when the screen turns on again
+        showing_history = False
+        page_shown_at = clock.timestamp()
+
 
+    metrics.observe('loop', time.perf_counter() - loop_started, phase='total')
+    tracer.complete('loop', loop_started)
 
     # print(result_human)
-    time.sleep(1.0)
+    # Come back early if someone gets close, so the screen turns on at once
+    proximity.wait_for_wake(clock.interval(1.0))
+
+print("Stopping Calcifair")
@@ -0,0 +1,293 @@
+"""Aggregator for a fleet of Calcifair units.
+
+Subscribes to the state messages of every unit on a broker, keeps the
+latest state of each one, stores their readings in one shared store and
+flags units that went silent or whose SGP30 baseline drifted:
+
+    python3 -m inc.aggregator --host broker.local --store logs/fleet.sqlite
+"""
+
+import argparse
+import json
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import numpy as np
+from inc.filters import HEARTBEAT
+from inc.registry import MEASUREMENTS, SENSORS
+from inc.store import Store
+
+# State topics of every unit, see unit_topic() in inc/mqtt.py
+STATE_TOPIC = 'homeassistant/sensor/calcifair/+/state'
+
+# Units whose values hold steady only send the heartbeat, so they are
+# silent after missing a few of them
+SILENT_AFTER = 3 * HEARTBEAT
+
+# State message fields kept per unit, in this order
+FIELDS = [sensor.key for sensor in SENSORS]
+BASELINES = [FIELDS.index('baseline_eco2'), FIELDS.index('baseline_tvoc')]
+
+# Fields going to the store, as <unit>/<field>
+STORED_FIELDS = [sensor.key for sensor in MEASUREMENTS]
+
+
+def _number(value):
+    # Older units send some values as strings
+    return math.nan if value is None else float(value)
+
+
+class NodeIndex:
+    """Latest state of up to `capacity` units, one row each.
+
+    Values live in preallocated NumPy columns, so the index never grows
+    past its capacity and checks run over every unit at once. When full,
+    the unit silent the longest makes room for a new one.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.rows = {}
+        self.names = [None] * capacity
+
+        self.values = np.full((capacity, len(FIELDS)), np.nan, dtype=np.float32)
+        self.references = np.full((capacity, len(BASELINES)), np.nan, dtype=np.float32)
+        self.last_seen = np.zeros(capacity)
+        self.messages = np.zeros(capacity, dtype=np.uint32)
+        self.silent = np.zeros(capacity, dtype=bool)
+        self.drifting = np.zeros(capacity, dtype=bool)
+        self.used = np.zeros(capacity, dtype=bool)
+
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row(self, node):
+        row = self.rows.get(node)
+        if row is not None:
+            return row
+
+        if len(self.rows) < self.capacity:
+            row = len(self.rows)
+        else:
+            row = int(np.argmin(self.last_seen))
+            del self.rows[self.names[row]]
+            self.evicted += 1
+
+        self.rows[node] = row
+        self.names[row] = node
+        self.values[row] = np.nan
+        self.references[row] = np.nan
+        self.messages[row] = 0
+        self.silent[row] = False
+        self.drifting[row] = False
+        self.used[row] = True
+        return row
+
+    def update(self, node, seen, values):
+        row = self._row(node)
+        self.values[row] = values
+        self.last_seen[row] = seen
+        self.messages[row] += 1
+
+        # The first baseline seen is what later ones are compared with
+        references = self.references[row]
+        if np.isnan(references[0]):
+            references[:] = self.values[row, BASELINES]
+
+    def state(self, node):
+        row = self.rows.get(node)
+        if row is None:
+            return None
+        state = {field: None if math.isnan(value) else float(value)
+            for field, value in zip(FIELDS, self.values[row])}
+        state.update(last_seen=float(self.last_seen[row]), messages=int(self.messages[row]),
+            silent=bool(self.silent[row]), drifting=bool(self.drifting[row]))
+        return state
+
+    def check(self, now, silent_after, drift_ratio):
+        """Update the silent and drifting flags, returns the units whose
+        flags changed as (unit, flag, now set) tuples"""
+        silent = self.used & (now - self.last_seen > silent_after)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change = np.abs(self.values[:, BASELINES] / self.references - 1)
+        drifting = self.used & (change > drift_ratio).any(axis=1)
+
+        changes = []
+        for flag, current, previous in [('silent', silent, self.silent), ('drifting', drifting, self.drifting)]:
+            for row in np.flatnonzero(current != previous):
+                changes.append((self.names[row], flag, bool(current[row])))
+            previous[:] = current
+        return changes
+
+
+class Aggregator:
+    """Keeps up with state messages from the whole fleet.
+
+    handle() is all that runs per message, on the MQTT network thread:
+    it parses the JSON, updates the index and queues the readings. A
+    thread of its own writes the queue to the store in one transaction
+    every flush_interval seconds and checks for silent and drifting units.
+    If the store can't keep up, the oldest queued readings are dropped.
+    """
+
+    def __init__(self, store=None, capacity=1024, silent_after=SILENT_AFTER, drift_ratio=0.1,
+                 flush_interval=5.0, max_pending=100000):
+        self.store = store
+        self.index = NodeIndex(capacity)
+        self.silent_after = silent_after
+        self.drift_ratio = drift_ratio
+        self.flush_interval = flush_interval
+
+        # Called from the aggregator thread with (unit, flag, now set)
+        self.on_change = [self._print_change]
+
+        self.received = 0
+        self.invalid = 0
+        self.stored = 0
+        self.dropped = 0
+
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='aggregator', daemon=True)
+        self.client = None
+
+    def handle(self, topic, payload, now=None):
+        now = time.time() if now is None else now
+        try:
+            state = json.loads(payload)
+            node = state.get('node') or topic
+            values = [_number(state.get(field)) for field in FIELDS]
+            timestamp = state.get('timestamp')
+            ts = datetime.fromisoformat(timestamp).timestamp() if timestamp else now
+        except (ValueError, TypeError, AttributeError):
+            self.invalid += 1
+            return
+
+        with self._lock:
+            self.index.update(node, now, values)
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append((node, ts, values))
+        self.received += 1
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = deque(maxlen=pending.maxlen)
+
+        if self.store is None or not pending:
+            return
+
+        for node, ts, values in pending:
+            self.store.add(ts, {'{}/{}'.format(node, field): value
+                for field, value in zip(FIELDS, values)
+                if field in STORED_FIELDS and not math.isnan(value)})
+        self.store.commit()
+        self.stored += len(pending)
+
+    def check(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            changes = self.index.check(now, self.silent_after, self.drift_ratio)
+        for change in changes:
+            for callback in self.on_change:
+                callback(*change)
+        return changes
+
+    def summary(self):
+        with self._lock:
+            index = self.index
+            return {
+                'nodes': len(index),
+                'silent': int(index.silent.sum()),
+                'drifting': int(index.drifting.sum()),
+                'received': self.received,
+                'invalid': self.invalid,
+                'stored': self.stored,
+                'dropped': self.dropped,
+                'evicted': index.evicted,
+            }
+
+    def _print_change(self, node, flag, now_set):
+        if flag == 'silent':
+            print("{} {}".format(node, "went silent" if now_set else "is back"))
+        else:
+            print("{} {}".format(node, "baseline drifted" if now_set else "baseline back in range"))
+
+    def connect(self, host, port=1883, topic=STATE_TOPIC, username=None, password=None):
+        from paho.mqtt import client as mqtt_client
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                client.subscribe(topic)
+                print("Subscribed to {} on {}:{}".format(topic, host, port))
+            else:
+                print("Failed to connect to MQTT broker, return code {}".format(rc))
+
+        self.client = mqtt_client.Client()
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = on_connect
+        self.client.on_message = lambda client, userdata, message: self.handle(message.topic, message.payload)
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.check()
+            except Exception as e:
+                print("Aggregator failed: {}".format(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='MQTT broker')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--topic', default=STATE_TOPIC, help='state topic, wildcards allowed')
+    parser.add_argument('--store', help='shared store for every unit, e.g. logs/fleet.sqlite')
+    parser.add_argument('--capacity', type=int, default=1024, help='most units kept at once')
+    parser.add_argument('--silent-after', type=float, default=SILENT_AFTER, help='seconds without messages')
+    parser.add_argument('--drift', type=float, default=0.1, help='baseline change from the first one seen')
+    parser.add_argument('--report', type=float, default=30.0, help='seconds between summaries')
+    args = parser.parse_args()
+
+    store = Store(args.store, commit_interval=None) if args.store else None
+    aggregator = Aggregator(store, capacity=args.capacity, silent_after=args.silent_after, drift_ratio=args.drift)
+    aggregator.start()
+    aggregator.connect(args.host, args.port, args.topic, args.username, args.password)
+
+    try:
+        while True:
+            time.sleep(args.report)
+            print("{nodes} units, {silent} silent, {drifting} drifting | "
+                "{received} received, {stored} stored, {dropped} dropped, {invalid} invalid".format(
+                    **aggregator.summary()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        aggregator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""Air quality history analytics over the readings store.
+
+Everything works on whole NumPy arrays of timestamps (Unix seconds,
+sorted) and values, so long histories are processed in one go. Daily and
+weekly summaries can be printed from the command line:
+
+    python3 -m inc.analytics daily
+    python3 -m inc.analytics weekly --periods 8
+"""
+
+import argparse
+import os.path
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from inc.limits import *
+from inc.logparse import local_to_utc
+
+LEVELS = ['good', 'medium', 'bad']
+GOOD, MEDIUM, BAD = range(len(LEVELS))
+
+DAY = 86400
+WEEK = 7 * DAY
+PERIODS = {'daily': DAY, 'weekly': WEEK}
+
+# 1970-01-01 was a Thursday, weeks start on Monday
+WEEK_SHIFT = 3 * DAY
+
+VentilationEvent = namedtuple('VentilationEvent', ['start', 'end', 'peak', 'trough'])
+
+
+def classify(values, limit_medium, limit_bad):
+    """Level of each value: GOOD, MEDIUM from limit_medium, BAD from
+    limit_bad, the same as the traffic lights"""
+    return level(np.asarray(values), limit_medium, limit_bad).astype('int8')
+
+
+def classify_air(eCO2, TVOC):
+    """Indoor air level, the worst of the eCO2 and TVOC levels"""
+    return np.maximum(
+        classify(eCO2, LIMIT_ECO2_MEDIUM, LIMIT_ECO2_BAD),
+        classify(TVOC, LIMIT_TVOC_MEDIUM, LIMIT_TVOC_BAD))
+
+
+def load(store, metric, start, end, resolution=None):
+    """Timestamps and values of a metric, rollups as their means"""
+    rows = store.query(metric, start, end, resolution=resolution)
+    if not rows:
+        return np.empty(0), np.empty(0)
+    data = np.array(rows, dtype='float64')
+    return data[:, 0], data[:, 1]
+
+
+def align(ts, other_ts, other_values, max_age=None):
+    """Last value of another series at each of ts, NaN if none or too old"""
+    index = np.searchsorted(other_ts, ts, side='right') - 1
+    aligned = np.full(len(ts), np.nan)
+    valid = index >= 0
+    if max_age is not None:
+        valid &= ts - other_ts[np.maximum(index, 0)] <= max_age
+    aligned[valid] = other_values[index[valid]]
+    return aligned
+
+
+def local_offsets(ts):
+    """Seconds to add to each UTC timestamp to get the local time then,
+    daylight saving time included"""
+    ts = np.asarray(ts, dtype='float64')
+    # Local time offsets only change on the hour, so ask once per hour
+    hours, inverse = np.unique(ts // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in hours.tolist()], dtype='float64')
+    return offsets[inverse.reshape(-1)].reshape(ts.shape)
+
+
+def period_index(ts, period=DAY, offset=0):
+    """Number of the day or week each timestamp falls in, offset seconds
+    from UTC, or in local time if offset is None"""
+    ts = np.asarray(ts)
+    if offset is None:
+        offset = local_offsets(ts)
+    shift = offset + (WEEK_SHIFT if period == WEEK else 0)
+    return ((ts + shift) // period).astype('int64')
+
+
+def period_start(index, period=DAY, offset=0):
+    """Unix time each period starts, the inverse of period_index()"""
+    start = np.asarray(index) * period - (WEEK_SHIFT if period == WEEK else 0)
+    if offset is None:
+        return local_to_utc(start.reshape(-1)).reshape(start.shape)
+    return start - offset
+
+
+def durations(ts, max_gap=None):
+    """Seconds each sample stands for, until the next one.
+
+    Samples before a gap longer than max_gap count as max_gap only. By
+    default that is three times the usual interval.
+    """
+    if len(ts) < 2:
+        return np.zeros(len(ts))
+    dt = np.diff(ts)
+    if max_gap is None:
+        max_gap = 3 * np.median(dt)
+    return np.append(np.minimum(dt, max_gap), 0)
+
+
+def rolling_mean(ts, values, window):
+    """Mean over the trailing window seconds at each sample"""
+    sums = np.concatenate(([0.0], np.cumsum(values, dtype='float64')))
+    first = np.searchsorted(ts, np.asarray(ts) - window, side='right')
+    counts = np.arange(1, len(ts) + 1) - first
+    return (sums[1:] - sums[first]) / counts
+
+
+def rolling_percentile(values, window, q, chunk=65536):
+    """q-th percentile over the trailing window samples, NaN until there are enough"""
+    values = np.asarray(values, dtype='float64')
+    result = np.full(len(values), np.nan)
+    if len(values) < window:
+        return result
+
+    # Chunked so memory stays bounded on long histories
+    windows = sliding_window_view(values, window)
+    for start in range(0, len(windows), chunk):
+        block = windows[start:start + chunk]
+        result[window - 1 + start:window - 1 + start + len(block)] = np.percentile(block, q, axis=1)
+    return result
+
+
+def _groups(index):
+    """Period numbers and where each starts, timestamps being sorted"""
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(index)) + 1)) if len(index) else np.empty(0, 'int64')
+    return index[starts], starts
+
+
+def period_stats(ts, values, period=DAY, offset=0):
+    """Mean, min and max of each period, with the period numbers"""
+    periods, starts = _groups(period_index(ts, period, offset))
+    if not len(periods):
+        return periods, {'mean': np.empty(0), 'min': np.empty(0), 'max': np.empty(0)}
+    counts = np.diff(np.append(starts, len(ts)))
+    return periods, {
+        'mean': np.add.reduceat(values, starts) / counts,
+        'min': np.minimum.reduceat(values, starts),
+        'max': np.maximum.reduceat(values, starts),
+    }
+
+
+def period_percentiles(ts, values, q, period=DAY, offset=0):
+    """Percentiles q (a list) of each period, one row per period"""
+    periods, starts = _groups(period_index(ts, period, offset))
+    ends = np.append(starts[1:], len(ts))
+    # A partition per period is linear, cheaper than sorting it all
+    result = np.array([np.percentile(values[start:end], q) for start, end in zip(starts, ends)])
+    return periods, result.reshape(len(periods), len(q))
+
+
+def _seconds_by_period(ts, weights, period, offset):
+    periods, starts = _groups(period_index(ts, period, offset))
+    if not len(periods):
+        return periods, np.empty(0)
+    return periods, np.add.reduceat(weights, starts)
+
+
+def time_above(ts, values, threshold, period=DAY, offset=0, max_gap=None):
+    """Seconds at or over threshold in each period, with the period numbers"""
+    weights = durations(ts, max_gap) * (np.asarray(values) >= threshold)
+    return _seconds_by_period(ts, weights, period, offset)
+
+
+def time_in(ts, mask, period=DAY, offset=0, max_gap=None):
+    """Seconds where mask is set in each period, with the period numbers"""
+    return _seconds_by_period(ts, durations(ts, max_gap) * mask, period, offset)
+
+
+def ventilation_events(ts, eCO2, drop=200, window=900, step=60):
+    """Sharp eCO2 drops, like opening the windows.
+
+    An event is a fall of at least drop ppm within window seconds,
+    looked for on step-second means. Returns VentilationEvents from the
+    peak to the lowest point after it.
+    """
+    if len(ts) == 0:
+        return []
+
+    start = ts[0]
+    bucket = ((ts - start) // step).astype('int64')
+    counts = np.bincount(bucket)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(bucket, weights=eCO2) / counts
+
+    lag = max(1, int(window // step))
+    if len(means) <= lag:
+        return []
+    with np.errstate(invalid='ignore'):
+        falling = means[lag:] - means[:-lag] <= -drop
+
+    edges = np.diff(falling.astype('int8'), prepend=0, append=0)
+    events = []
+    for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        # A falling stretch covers from its first start to its last end.
+        # The drop starts at the last time the peak is seen.
+        stretch = means[first:last + lag]
+        peak = first + len(stretch) - 1 - np.nanargmax(stretch[::-1])
+        trough = peak + np.nanargmin(means[peak:last + lag])
+        events.append(VentilationEvent(
+            start=float(start + peak * step),
+            end=float(start + trough * step),
+            peak=float(means[peak]),
+            trough=float(means[trough])))
+    return events
+
+
+def compare_outdoor(ts, indoor, outdoor_ts, outdoor, max_age=3 * 3600):
+    """Outdoor values next to the indoor ones, and indoor minus outdoor.
+
+    Outdoor data comes once an hour at best, so each indoor sample gets
+    the last outdoor value unless it is older than max_age seconds.
+    """
+    aligned = align(ts, outdoor_ts, outdoor, max_age)
+    return aligned, indoor - aligned
+
+
+def _by_period(periods, index, values, default=np.nan):
+    # Other series may have data in periods without eCO2 readings
+    result = np.full(len(periods), default, dtype='float64')
+    found = np.isin(index, periods)
+    result[np.searchsorted(periods, index[found])] = np.asarray(values)[found]
+    return result
+
+
+def summarize(store, start, end, period=DAY, resolution=None, offset=None):
+    """One dict of figures per period between Unix times start and end,
+    periods being local days or weeks unless offset (from UTC) is given"""
+    series = {metric: load(store, metric, start, end, resolution) for metric in [
+        'eco2', 'tvoc', 'temperature', 'humidity',
+        'outdoor_temperature', 'outdoor_humidity', 'outdoor_aqi']}
+
+    ts, eCO2 = series['eco2']
+    if not len(ts):
+        return []
+    periods = np.unique(period_index(ts, period, offset))
+
+    def stat(metric, name):
+        metric_ts, values = series[metric]
+        if not len(metric_ts):
+            return np.full(len(periods), np.nan)
+        index, stats = period_stats(metric_ts, values, period, offset)
+        return _by_period(periods, index, stats[name])
+
+    def percentile(metric, q):
+        index, values = period_percentiles(*series[metric], [q], period, offset)
+        return _by_period(periods, index, values[:, 0])
+
+    def hours_above(metric, threshold):
+        index, seconds = time_above(*series[metric], threshold, period, offset)
+        return _by_period(periods, index, seconds / 3600, 0)
+
+    tvoc_ts, TVOC = series['tvoc']
+    level = classify_air(eCO2, align(ts, tvoc_ts, TVOC))
+
+    # Worth opening the windows: indoor air is not good and outdoor air is
+    aqi_ts, aqi = series['outdoor_aqi']
+    outdoor_aqi = align(ts, aqi_ts, aqi, max_age=3 * 3600) if len(aqi_ts) else np.full(len(ts), np.nan)
+    index, seconds = time_in(ts, (level > GOOD) & (outdoor_aqi <= LIMIT_AQI_MEDIUM), period, offset)
+    hours_worth_ventilating = _by_period(periods, index, seconds / 3600, 0)
+    index, seconds = time_in(ts, level == BAD, period, offset)
+    hours_bad = _by_period(periods, index, seconds / 3600, 0)
+
+    ventilations = np.zeros(len(periods))
+    events = ventilation_events(ts, eCO2)
+    if events:
+        index, counts = np.unique(period_index([event.start for event in events], period, offset), return_counts=True)
+        ventilations = _by_period(periods, index, counts, 0)
+
+    columns = {
+        'eco2_mean': stat('eco2', 'mean'),
+        'eco2_p95': percentile('eco2', 95),
+        'eco2_max': stat('eco2', 'max'),
+        'tvoc_mean': stat('tvoc', 'mean'),
+        'tvoc_p95': percentile('tvoc', 95),
+        'hours_eco2_medium': hours_above('eco2', LIMIT_ECO2_MEDIUM),
+        'hours_eco2_bad': hours_above('eco2', LIMIT_ECO2_BAD),
+        'hours_tvoc_bad': hours_above('tvoc', LIMIT_TVOC_BAD),
+        'hours_bad': hours_bad,
+        'hours_worth_ventilating': hours_worth_ventilating,
+        'ventilations': ventilations,
+        'temperature_mean': stat('temperature', 'mean'),
+        'outdoor_temperature_mean': stat('outdoor_temperature', 'mean'),
+        'humidity_mean': stat('humidity', 'mean'),
+        'outdoor_humidity_mean': stat('outdoor_humidity', 'mean'),
+        'outdoor_aqi_mean': stat('outdoor_aqi', 'mean'),
+    }
+
+    summary = []
+    for i, index in enumerate(periods):
+        row = {'start': datetime.fromtimestamp(float(period_start(index, period, offset)), timezone.utc)}
+        row.update({name: float(values[i]) for name, values in columns.items()})
+        summary.append(row)
+    return summary
+
+
+# Column title, summary key and format of the printed table
+TABLE = [
+    ('CO2 avg', 'eco2_mean', '{:.0f}'),
+    ('CO2 p95', 'eco2_p95', '{:.0f}'),
+    ('CO2 max', 'eco2_max', '{:.0f}'),
+    ('VOC avg', 'tvoc_mean', '{:.0f}'),
+    ('VOC p95', 'tvoc_p95', '{:.0f}'),
+    ('h CO2≥{}'.format(LIMIT_ECO2_MEDIUM), 'hours_eco2_medium', '{:.1f}'),
+    ('h CO2≥{}'.format(LIMIT_ECO2_BAD), 'hours_eco2_bad', '{:.1f}'),
+    ('h VOC≥{}'.format(LIMIT_TVOC_BAD), 'hours_tvoc_bad', '{:.1f}'),
+    ('h bad', 'hours_bad', '{:.1f}'),
+    ('h to vent', 'hours_worth_ventilating', '{:.1f}'),
+    ('Vents', 'ventilations', '{:.0f}'),
+    ('In °C', 'temperature_mean', '{:.1f}'),
+    ('Out °C', 'outdoor_temperature_mean', '{:.1f}'),
+    ('In %RH', 'humidity_mean', '{:.0f}'),
+    ('Out %RH', 'outdoor_humidity_mean', '{:.0f}'),
+    ('AQI', 'outdoor_aqi_mean', '{:.0f}'),
+]
+
+
+def print_summary(summary):
+    header = ['Period'] + [title for title, key, fmt in TABLE]
+    rows = [[row['start'].astimezone().strftime('%Y-%m-%d')] +
+        ['-' if np.isnan(row[key]) else fmt.format(row[key]) for title, key, fmt in TABLE]
+        for row in summary]
+
+    widths = [max(len(line[i]) for line in [header] + rows) for i in range(len(header))]
+    for line in [header] + rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def main():
+    dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    parser = argparse.ArgumentParser(description='Daily or weekly air quality summaries')
+    parser.add_argument('period', choices=sorted(PERIODS), help='length of each summary')
+    parser.add_argument('--periods', type=int, default=7, help='how many days or weeks back')
+    parser.add_argument('--db', default=os.path.join(dir_path, 'logs/calcifair.sqlite'), help='readings store')
+    parser.add_argument('--resolution', choices=['raw', 'minute', 'hour'], help='defaults to the best one kept')
+    args = parser.parse_args()
+
+    from inc.store import Store
+
+    period = PERIODS[args.period]
+    end = time.time()
+    # Start at the beginning of the first local period
+    start = float(period_start(period_index(end, period, None) - args.periods + 1, period, None))
+
+    store = Store(args.db)
+    started = time.perf_counter()
+    summary = summarize(store, start, end, period, args.resolution)
+    store.close()
+
+    if not summary:
+        print('No readings stored in that time')
+        return
+    print_summary(summary)
+    print('Summarized in {:.2f}s'.format(time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
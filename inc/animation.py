@@ -0,0 +1,145 @@
+import threading
+import time
+import numpy as np
+from inc.display import *
+from inc.metrics import NULL_METRICS
+from inc.tracing import tracer
+
+
+class Animator(threading.Thread):
+    """Puts frames on the panel without holding up the main loop.
+
+    This is the only thing writing to the panel once it runs. The main
+    loop hands it the info screen with show(), and play() starts an
+    expression that loops for the given seconds at the GIF frame rate
+    while the caller carries on. Parts of the info screen can be laid over
+    the expression, so the readings stay on screen while Calcifer plays.
+    Panel writes are timed into `metrics` when given.
+    """
+
+    def __init__(self, panel, width, height, rotation=DISPLAY_ROTATION, metrics=None):
+        super().__init__(name='animator', daemon=True)
+        self.panel = panel
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.metrics = metrics or NULL_METRICS
+
+        self.played = 0
+        self.late_frames = 0
+
+        self._screen = None
+        self._screen_changed = False
+        self._expression = None
+        self._overlay = None
+        self._masks = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    @property
+    def playing(self):
+        return self._expression is not None
+
+    def show(self, image):
+        """Set the info screen, shown whenever no expression is playing.
+
+        image is a PIL image or an RGB array, converted before returning.
+        """
+        self.show_frame(image_to_panel(image, self.rotation))
+
+    def show_frame(self, frame):
+        """Same as show() for a frame already in panel space, e.g. from
+        Screen.render(). It is shown as it is, so don't change it after."""
+        with self._lock:
+            self._screen = frame
+            self._screen_changed = True
+        self._wake.set()
+
+    def play(self, expression, seconds=5, overlay=None):
+        """Loop an expression for the given seconds, replacing any playing one.
+
+        overlay is a (x0, y0, x1, y1) box of the info screen drawn on top.
+        """
+        with self._lock:
+            self._expression = (expression, time.monotonic() + seconds)
+            self._overlay = self._mask(overlay) if overlay else None
+        self._wake.set()
+
+    def stop_expression(self):
+        with self._lock:
+            if self._expression is not None:
+                self._expression = None
+                self._screen_changed = True
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def _mask(self, box):
+        # Boxes are in screen coordinates, frames in panel space
+        if box not in self._masks:
+            x0, y0, x1, y1 = box
+            mask = np.zeros((self.height, self.width), dtype=bool)
+            mask[y0:y1, x0:x1] = True
+            self._masks[box] = np.rot90(mask, self.rotation // 90)
+        return self._masks[box]
+
+    def _show_screen(self):
+        with self._lock:
+            frame = self._screen if self._screen_changed else None
+            self._screen_changed = False
+        if frame is not None:
+            with self.metrics.timer('display', content='screen'), tracer.span('display'):
+                self.panel.display_panel(frame)
+
+    def _play(self, expression, timeout):
+        next_frame = time.monotonic()
+
+        while time.monotonic() < timeout:
+            for data, duration in zip(expression.frames, expression.durations):
+                with self._lock:
+                    if self._expression is None or self._expression[0] is not expression:
+                        # Stopped, or replaced by another expression
+                        return
+                    screen, overlay = self._screen, self._overlay
+
+                frame = np.frombuffer(data, dtype='>u2').reshape(self.panel.disp.height, self.panel.disp.width)
+                if overlay is not None and screen is not None:
+                    frame = np.where(overlay, screen, frame)
+                with self.metrics.timer('display', content='expression'):
+                    self.panel.display_panel(frame)
+
+                # Schedule from the previous deadline so SPI time doesn't add up
+                next_frame += duration
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    if self._stopping.wait(delay):
+                        return
+                elif delay < -duration:
+                    self.late_frames += 1
+                    next_frame = time.monotonic()
+
+                if time.monotonic() >= timeout:
+                    break
+
+        self.played += 1
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.wait()
+            self._wake.clear()
+
+            with self._lock:
+                playing = self._expression
+
+            if playing is not None:
+                with tracer.span('expression'):
+                    self._play(*playing)
+                with self._lock:
+                    if self._expression is playing:
+                        self._expression = None
+                        self._screen_changed = True
+
+            self._show_screen()
@@ -0,0 +1,298 @@
+import asyncio
+import io
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, filters
+from inc.analytics import LEVELS, classify_air
+from inc.limits import *
+from inc.registry import MEASUREMENTS, sensor_id
+from inc.screen import FONT_REGULAR
+from inc.time import readable_log_time
+
+TELEGRAM_URL = 'https://api.telegram.org'
+
+# Chart windows by name, in seconds
+WINDOWS = {
+    '6h': 6 * 3600,
+    '24h': 24 * 3600,
+    '7d': 7 * 86400,
+    '30d': 30 * 86400,
+}
+
+# Charts by name: store metric, title, unit and limits for the bands.
+# One per sensor in the registry, plus the outdoor AQI
+CHARTS = {
+    sensor_id(sensor): (sensor.key, sensor.name, sensor.unit) + (sensor.limits or (None, None))
+    for sensor in MEASUREMENTS}
+CHARTS['aqi'] = ('outdoor_aqi', 'Outdoor AQI', 'AQI', LIMIT_AQI_MEDIUM, LIMIT_AQI_BAD)
+
+CHART_WIDTH = 800
+CHART_HEIGHT = 400
+CHART_MARGIN = 50
+
+COLOR_CHART_BACKGROUND = (255, 255, 255)
+COLOR_CHART_TEXT = (60, 60, 60)
+COLOR_CHART_LINE = (40, 40, 40)
+COLOR_CHART_RANGE = (200, 200, 200)
+
+HELP = """Ask Calcifer about the air:
+/status - air indoors and outdoors now
+/chart co2 24h - history over 6h, 24h, 7d or 30d of any of {}""".format(', '.join(CHARTS))
+
+
+def _tint(color, amount=0.8):
+    """Colour mixed with white, for the limit bands"""
+    return tuple(int(c + (255 - c) * amount) for c in color)
+
+
+class ChartCache:
+    """History charts as PNGs, rendered once per window and kept until
+    new data would change them.
+
+    A chart is only rendered again once the latest reading has moved on
+    by at least one pixel of its window, so asking for the same chart
+    over and over costs nothing.
+    """
+
+    def __init__(self, store, latest, size=32):
+        self.store = store
+        self.latest = latest
+        self.size = size
+        self.font = ImageFont.truetype(FONT_REGULAR, 16)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._charts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, chart, window):
+        """Cache key of a chart, which changes as new data arrives"""
+        pixel = WINDOWS[window] / (CHART_WIDTH - 2 * CHART_MARGIN)
+        return chart, window, int(self.latest() // pixel)
+
+    def cached(self, key):
+        with self._lock:
+            png = self._charts.get(key)
+            if png is not None:
+                self._charts.move_to_end(key)
+                self.hits += 1
+            return png
+
+    def render(self, key):
+        chart, window, version = key
+        end = self.latest()
+        png = self._draw(chart, end - WINDOWS[window], end, window)
+
+        with self._lock:
+            self.misses += 1
+            # Older versions of the same chart are stale now
+            for stale in [k for k in self._charts if k[:2] == key[:2]]:
+                del self._charts[stale]
+            self._charts[key] = png
+            while len(self._charts) > self.size:
+                self._charts.popitem(last=False)
+        return png
+
+    def _draw(self, chart, start, end, window):
+        metric, title, unit, limit_medium, limit_bad = CHARTS[chart]
+        rows = np.array(self.store.query(metric, start, end), dtype='float64')
+
+        image = Image.new('RGB', (CHART_WIDTH, CHART_HEIGHT), COLOR_CHART_BACKGROUND)
+        draw = ImageDraw.Draw(image)
+        draw.text((CHART_MARGIN, 15), '{} ({}), last {}'.format(title, unit, window),
+            font=self.font, fill=COLOR_CHART_TEXT)
+
+        left, top = CHART_MARGIN, CHART_MARGIN
+        right, bottom = CHART_WIDTH - CHART_MARGIN, CHART_HEIGHT - CHART_MARGIN
+
+        if not len(rows):
+            draw.text((left, top), 'No data yet', font=self.font, fill=COLOR_CHART_TEXT)
+        else:
+            ts, mean = rows[:, 0], rows[:, 1]
+            low, high = (rows[:, 2], rows[:, 3]) if rows.shape[1] == 4 else (mean, mean)
+
+            bottom_value, top_value = np.nanmin(low), np.nanmax(high)
+            if limit_bad is not None:
+                top_value = max(top_value, limit_bad * 1.1)
+            if top_value == bottom_value:
+                top_value += 1
+
+            def x(t):
+                return left + (t - start) / (end - start) * (right - left)
+
+            def y(value):
+                return bottom - (value - bottom_value) / (top_value - bottom_value) * (bottom - top)
+
+            # Limit bands behind the data
+            if limit_bad is not None:
+                for lower, upper, color in [
+                        (bottom_value, limit_medium, COLOR_GREEN),
+                        (limit_medium, limit_bad, COLOR_YELLOW),
+                        (limit_bad, top_value, COLOR_RED)]:
+                    if upper > bottom_value:
+                        draw.rectangle((left, y(min(upper, top_value)), right, y(max(lower, bottom_value))),
+                            fill=_tint(color))
+
+            xs = x(ts)
+            if rows.shape[1] == 4:
+                for xi, lo, hi in zip(xs, y(low), y(high)):
+                    draw.line((xi, lo, xi, hi), fill=COLOR_CHART_RANGE)
+            draw.line(list(zip(xs, y(mean))), fill=COLOR_CHART_LINE, width=2)
+
+            for value in (bottom_value, top_value):
+                draw.text((5, y(value) - 8), '{:.0f}'.format(value), font=self.font, fill=COLOR_CHART_TEXT)
+
+        for t, anchor in [(start, 'la'), (end, 'ra')]:
+            label = datetime.fromtimestamp(t).strftime('%d/%m %H:%M')
+            draw.text((left if anchor == 'la' else right, bottom + 10), label,
+                font=self.font, fill=COLOR_CHART_TEXT, anchor=anchor)
+
+        output = io.BytesIO()
+        image.save(output, format='PNG', optimize=False)
+        return output.getvalue()
+
+
+def status_text(reading, outdoor):
+    """Reply to /status from the latest reading and IQAir data"""
+    if reading is None:
+        lines = ['🔥 Calcifer is still waking up']
+    else:
+        lines = ['🏠 Indoors: CO2 {} ppm, VOC {} ppb, {}'.format(
+            reading.eCO2, reading.TVOC, LEVELS[classify_air(reading.eCO2, reading.TVOC)])]
+        if reading.temperature is not None:
+            lines.append('🌡 {:.1f}°C, {:.0f}% RH, {:.0f} hPa'.format(
+                reading.temperature, reading.humidity, reading.pressure))
+
+    if outdoor:
+        lines.append('🌳 Outdoors: AQI {}, {}°C, {}% RH | {}'.format(
+            outdoor['aqi'], outdoor['temp'], outdoor['humidity'],
+            readable_log_time(outdoor['pollution_timestamp'])))
+    return '\n'.join(lines)
+
+
+class TelegramBot(threading.Thread):
+    """Telegram bot answering from what Calcifair already knows.
+
+    Runs an asyncio loop of its own, so it never holds up the main loop,
+    and never reads a sensor: /status comes from the latest snapshot and
+    /chart from the store, through the chart cache. Updates are handled
+    concurrently, and charts render in worker threads, with everyone
+    asking for the same chart at once waiting on a single render. Only
+    the given user IDs get an answer. base_url points the bot at another
+    Bot API server, e.g. a local one for tests.
+    """
+
+    def __init__(self, token, users, snapshot, outdoor, charts, base_url=TELEGRAM_URL, retry=60.0):
+        super().__init__(name='telegram-bot', daemon=True)
+        self.token = token
+        self.users = [int(user) for user in users]
+        self.snapshot = snapshot
+        self.outdoor = outdoor
+        self.charts = charts
+        self.base_url = base_url.rstrip('/')
+        self.retry = retry
+
+        self.replies = 0
+        self.errors = 0
+
+        self._loop = None
+        self._stopping = None
+        self._rendering = {}
+        self._started = threading.Event()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def wait_started(self, timeout=None):
+        return self._started.wait(timeout)
+
+    def _application(self):
+        application = (Application.builder()
+            .token(self.token)
+            .base_url(self.base_url + '/bot')
+            .base_file_url(self.base_url + '/file/bot')
+            .concurrent_updates(True)
+            .build())
+
+        authorised = filters.User(user_id=self.users)
+        application.add_handler(CommandHandler(['start', 'help'], self._help, filters=authorised))
+        application.add_handler(CommandHandler('status', self._status, filters=authorised))
+        application.add_handler(CommandHandler('chart', self._chart, filters=authorised))
+        application.add_error_handler(self._error)
+        return application
+
+    async def _help(self, update, context):
+        await update.effective_message.reply_text(HELP)
+        self.replies += 1
+
+    async def _status(self, update, context):
+        await update.effective_message.reply_text(status_text(self.snapshot(), self.outdoor()))
+        self.replies += 1
+
+    async def _chart(self, update, context):
+        chart = context.args[0].lower() if context.args else 'co2'
+        window = context.args[1].lower() if len(context.args) > 1 else '24h'
+        if chart not in CHARTS or window not in WINDOWS:
+            await update.effective_message.reply_text(HELP)
+            self.replies += 1
+            return
+
+        png = await self._chart_png(chart, window)
+        await update.effective_message.reply_photo(png)
+        self.replies += 1
+
+    async def _chart_png(self, chart, window):
+        key = self.charts.key(chart, window)
+        png = self.charts.cached(key)
+        if png is not None:
+            return png
+
+        rendering = self._rendering.get(key)
+        if rendering is None:
+            rendering = self._rendering[key] = asyncio.ensure_future(asyncio.to_thread(self.charts.render, key))
+            rendering.add_done_callback(lambda future: self._rendering.pop(key, None))
+        return await rendering
+
+    def _polling_error(self, error):
+        # Retried on its own, one line is enough while the network is down
+        self.errors += 1
+        print("Telegram polling failed: {}".format(error))
+
+    async def _error(self, update, context):
+        self.errors += 1
+        print("Telegram bot error: {}".format(context.error))
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+
+        while not self._stopping.is_set():
+            application = self._application()
+            try:
+                async with application:
+                    await application.start()
+                    await application.updater.start_polling(
+                        drop_pending_updates=True, error_callback=self._polling_error)
+                    print("Telegram bot started")
+                    self._started.set()
+
+                    await self._stopping.wait()
+
+                    await application.updater.stop()
+                    await application.stop()
+            except TelegramError as e:
+                self.errors += 1
+                print("Telegram bot failed to start: {}".format(e))
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.retry)
+                except asyncio.TimeoutError:
+                    pass
+
+    def run(self):
+        asyncio.run(self._serve())
@@ -0,0 +1,150 @@
+import math
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+from inc.sensors import Reading
+from inc.store import READING_METRICS
+
+MAGIC = b'CALCIFCP'
+VERSION = 1
+
+# Enough readings at 1 Hz to cover what the store may not have committed
+CAPACITY = 900
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('capacity', '<u4'),
+    # Equal unless the process died halfway through an update
+    ('seq_begin', '<u8'),
+    ('head', '<u8'),
+    ('baseline_valid_at', '<f8'),
+    ('seq_end', '<u8'),
+])
+
+ROW_DTYPE = np.dtype([(field, '<f8') for field in Reading._fields])
+
+Restored = namedtuple('Restored', ['reading', 'baseline_valid_at', 'recent'])
+
+
+def _to_row(reading):
+    values = []
+    for field in Reading._fields:
+        value = getattr(reading, field)
+        if field == 'timestamp':
+            value = value.timestamp()
+        values.append(math.nan if value is None else value)
+    return tuple(values)
+
+
+def _to_reading(row):
+    values = {}
+    for field in Reading._fields:
+        value = float(row[field])
+        if field == 'timestamp':
+            value = datetime.fromtimestamp(value, timezone.utc)
+        elif math.isnan(value):
+            value = None
+        elif field in ('eCO2', 'TVOC', 'baseline_eCO2', 'baseline_TVOC', 'proximity'):
+            value = int(value)
+        values[field] = value
+    return Reading(**values)
+
+
+class Checkpoint:
+    """Recent readings kept in a small memory-mapped file for warm restarts.
+
+    Every reading goes into a ring buffer in the file, the newest one
+    doubling as the last snapshot along with the SGP30 baselines it
+    carries. Writes land in the page cache, so they survive the process
+    being killed and reach the disk with the kernel's own writeback.
+    Nothing is parsed on restart, restore() reads the arrays straight back.
+    """
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.size = HEADER_DTYPE.itemsize + ROW_DTYPE.itemsize * capacity
+
+        fresh = not self._valid()
+        if fresh:
+            with open(path, 'wb') as file:
+                file.truncate(self.size)
+
+        self._map = np.memmap(path, dtype=np.uint8, mode='r+', shape=(self.size,))
+        self._header = self._map[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        self._rows = self._map[HEADER_DTYPE.itemsize:].view(ROW_DTYPE)
+
+        if fresh:
+            self._header['magic'] = MAGIC
+            self._header['version'] = VERSION
+            self._header['capacity'] = capacity
+
+    def _valid(self):
+        try:
+            if os.path.getsize(self.path) != self.size:
+                return False
+            header = np.fromfile(self.path, dtype=HEADER_DTYPE, count=1)[0]
+        except (OSError, IndexError):
+            return False
+        return header['magic'] == MAGIC and header['version'] == VERSION and header['capacity'] == self.capacity
+
+    def restore(self):
+        """What the previous run left, or None if it left nothing"""
+        header = self._header[0].copy()
+        head = int(header['head'])
+        if head == 0:
+            return None
+
+        count = min(head, self.capacity)
+        indices = np.arange(head - count, head) % self.capacity
+        if header['seq_begin'] != header['seq_end']:
+            # Killed while writing: the slot being written may be torn
+            indices = indices[1:] if count == self.capacity else indices
+            baseline_valid_at = None
+        else:
+            baseline_valid_at = float(header['baseline_valid_at']) or None
+
+        recent = self._rows[indices].copy()
+        return Restored(_to_reading(recent[-1]), baseline_valid_at, recent)
+
+    def add(self, reading):
+        header = self._header
+        header['seq_begin'] += 1
+        head = int(header['head'][0])
+        self._rows[head % self.capacity] = _to_row(reading)
+        header['head'] = head + 1
+        header['seq_end'] = header['seq_begin']
+
+    def set_baseline_valid_at(self, timestamp):
+        """Unix time from which the SGP30 baseline counts as learned"""
+        header = self._header
+        header['seq_begin'] += 1
+        header['baseline_valid_at'] = timestamp
+        header['seq_end'] = header['seq_begin']
+
+    def sync(self):
+        """Write the file to disk now instead of waiting for the kernel"""
+        self._map.flush()
+
+
+def backfill(store, recent):
+    """Add readings the store lost uncommitted, returns how many"""
+    if not len(recent):
+        return 0
+
+    start, end = recent['timestamp'][0], recent['timestamp'][-1]
+    stored = {ts for ts, value in store.query('eco2', start, end + 1, resolution='raw')}
+
+    added = 0
+    for row in recent:
+        ts = int(row['timestamp'])
+        if ts in stored:
+            continue
+        stored.add(ts)
+        store.add(row['timestamp'], {
+            name: None if math.isnan(row[field]) else float(row[field])
+            for name, field in READING_METRICS.items()})
+        added += 1
+    return added
@@ -0,0 +1,130 @@
+import numpy as np
+
+# Same as the ST7789 library default, but passed explicitly so frames can be
+# converted ahead of time with the orientation the panel expects
+DISPLAY_ROTATION = 90
+
+SPI_CHUNK_SIZE = 4096
+
+
+def image_to_panel(image, rotation=DISPLAY_ROTATION):
+    """Convert a PIL image, or an RGB array of one, to a (rows, columns)
+    RGB565 array in panel space"""
+    pixels = image if isinstance(image, np.ndarray) else np.asarray(image.convert('RGB'))
+    pb = np.rot90(pixels, rotation // 90).astype('uint16')
+    return ((pb[..., 0] & 0xF8) << 8) | ((pb[..., 1] & 0xFC) << 3) | (pb[..., 2] >> 3)
+
+
+def image_to_rgb565(image, rotation=DISPLAY_ROTATION):
+    """Convert a PIL image to the big-endian RGB565 bytes sent to the panel"""
+    return image_to_panel(image, rotation).astype('>u2').tobytes()
+
+
+def display_rgb565(disp, data):
+    """Push a full frame already converted with image_to_rgb565()"""
+    disp.set_window()
+    for i in range(0, len(data), SPI_CHUNK_SIZE):
+        disp.data(data[i:i + SPI_CHUNK_SIZE])
+
+
+def _spans(changed, gap):
+    """(start, end) index pairs of the True runs, joining runs less than gap apart"""
+    indexes = np.flatnonzero(changed)
+    if not len(indexes):
+        return []
+
+    breaks = np.flatnonzero(np.diff(indexes) > gap)
+    starts = np.concatenate(([indexes[0]], indexes[breaks + 1]))
+    ends = np.concatenate((indexes[breaks], [indexes[-1]]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+class DiffDisplay:
+    """Sends the panel only what changed since the last frame.
+
+    The new frame is compared with the last one sent, and the changed
+    pixels are grouped into a few rectangles that are written through the
+    ST7789 column and row address window. Identical frames send nothing,
+    and a full frame is sent when most of it changed anyway.
+    """
+
+    def __init__(self, disp, rotation=DISPLAY_ROTATION, gap=8, full_frame_ratio=0.6):
+        self.disp = disp
+        self.rotation = rotation
+        # Changes closer than this many pixels are sent in the same window
+        self.gap = gap
+        self.full_frame_ratio = full_frame_ratio
+
+        self.frames = 0
+        self.skipped = 0
+        self.full_frames = 0
+        self.rectangles = 0
+        self.bytes_sent = 0
+        self.last_bytes = 0
+
+        self._last = None
+
+    def invalidate(self):
+        """Send the next frame in full, e.g. after drawing on disp directly"""
+        self._last = None
+
+    def display(self, image):
+        self.display_panel(image_to_panel(image, self.rotation))
+
+    def display_rgb565(self, data):
+        """Show a frame already converted with image_to_rgb565()"""
+        frame = np.frombuffer(data, dtype='>u2').reshape(self.disp.height, self.disp.width)
+        self.display_panel(frame)
+
+    def display_panel(self, frame):
+        self.frames += 1
+        last, self._last = self._last, frame
+
+        if last is None or last.shape != frame.shape:
+            self._send_full(frame)
+            return
+
+        changed = frame != last
+        row_spans = _spans(changed.any(axis=1), self.gap)
+        if not row_spans:
+            self.skipped += 1
+            self.last_bytes = 0
+            return
+
+        rectangles = []
+        for y0, y1 in row_spans:
+            for x0, x1 in _spans(changed[y0:y1 + 1].any(axis=0), self.gap):
+                rectangles.append((x0, y0, x1, y1))
+
+        area = sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, y0, x1, y1 in rectangles)
+        if area > frame.size * self.full_frame_ratio:
+            self._send_full(frame)
+            return
+
+        self.last_bytes = 0
+        for x0, y0, x1, y1 in rectangles:
+            self._send(frame[y0:y1 + 1, x0:x1 + 1], x0, y0, x1, y1)
+        self.rectangles += len(rectangles)
+
+    def _send_full(self, frame):
+        self.full_frames += 1
+        self.last_bytes = 0
+        self._send(frame, 0, 0, frame.shape[1] - 1, frame.shape[0] - 1)
+
+    def _send(self, block, x0, y0, x1, y1):
+        data = block.astype('>u2').tobytes()
+        self.disp.set_window(x0, y0, x1, y1)
+        for i in range(0, len(data), SPI_CHUNK_SIZE):
+            self.disp.data(data[i:i + SPI_CHUNK_SIZE])
+        self.last_bytes += len(data)
+        self.bytes_sent += len(data)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'full_frames': self.full_frames,
+            'rectangles': self.rectangles,
+            'bytes_sent': self.bytes_sent,
+            'last_bytes': self.last_bytes,
+        }
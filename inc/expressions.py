@@ -0,0 +1,83 @@
+import glob
+import os.path
+import threading
+from collections import OrderedDict
+from PIL import Image
+from inc.display import *
+from inc.tracing import tracer
+
+# Used when a GIF frame has no duration, same as the old fixed delay
+DEFAULT_FRAME_DURATION = 0.05
+
+
+class Expression:
+    """An animation decoded into display-ready RGB565 frames"""
+
+    def __init__(self, name, frames, durations):
+        self.name = name
+        self.frames = frames
+        self.durations = durations
+        self.size = sum(len(frame) for frame in frames)
+
+
+class ExpressionCache:
+    """Decoded Calcifer expressions, evicting the least recently played
+    ones when the cache goes over max_bytes.
+    """
+
+    def __init__(self, dir_path, width, height, max_bytes=32 * 1024 * 1024):
+        self.dir_path = dir_path
+        self.width = width
+        self.height = height
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._expressions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Names of the expressions found in the assets folder"""
+        paths = glob.glob(os.path.join(self.dir_path, 'assets/calcifer-*.gif'))
+        return sorted(os.path.basename(path)[len('calcifer-'):-len('.gif')] for path in paths)
+
+    def preload(self, expressions=None):
+        for expression in expressions or self.available():
+            try:
+                with tracer.span('expression.load', expression=expression):
+                    self.get(expression)
+            except (OSError, EOFError):
+                print('Calcifer expression not found: ' + expression)
+
+    def get(self, expression):
+        with self._lock:
+            if expression in self._expressions:
+                self._expressions.move_to_end(expression)
+                return self._expressions[expression]
+
+        decoded = self._decode(expression)
+
+        with self._lock:
+            if expression not in self._expressions:
+                self._expressions[expression] = decoded
+                self.size += decoded.size
+                self._evict()
+            return self._expressions[expression]
+
+    def _evict(self):
+        # Always keep the expression that was just added
+        while self.size > self.max_bytes and len(self._expressions) > 1:
+            name, evicted = self._expressions.popitem(last=False)
+            self.size -= evicted.size
+
+    def _decode(self, expression):
+        image_path = os.path.join(self.dir_path, 'assets/calcifer-' + expression + '.gif')
+        frames, durations = [], []
+
+        with Image.open(image_path) as image:
+            for frame in range(getattr(image, 'n_frames', 1)):
+                image.seek(frame)
+                resized = image.convert('RGB').resize((self.width, self.height))
+                frames.append(image_to_rgb565(resized))
+                durations.append(image.info.get('duration', 0) / 1000 or DEFAULT_FRAME_DURATION)
+
+        return Expression(expression, frames, durations)
+
@@ -0,0 +1,183 @@
+import bisect
+import time
+from collections import deque
+from inc.registry import MEASUREMENTS
+from inc.store import READING_METRICS
+
+# Per metric settings, by store metric name, from the sensor registry.
+# Any of them can be changed from the filters section of config.yaml
+DEFAULT_FILTERS = {
+    sensor.key: dict(sensor.filter or {}, decimals=sensor.precision) for sensor in MEASUREMENTS}
+
+# State messages are sent at least this often even if nothing changed
+HEARTBEAT = 300
+
+
+class Ema:
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self, value):
+        self.value = value
+
+
+class Median:
+    """Running median of the last `window` values"""
+
+    def __init__(self, window=5):
+        self.values = deque(maxlen=window)
+        self.ordered = []
+
+    def update(self, value):
+        if len(self.values) == self.values.maxlen:
+            del self.ordered[bisect.bisect_left(self.ordered, self.values[0])]
+        self.values.append(value)
+        bisect.insort(self.ordered, value)
+        return self.ordered[len(self.ordered) // 2]
+
+    def reset(self, value):
+        self.values.clear()
+        self.ordered = []
+        self.update(value)
+
+
+class Passthrough:
+    def update(self, value):
+        return value
+
+    def reset(self, value):
+        pass
+
+
+FILTERS = {
+    'ema': lambda settings: Ema(settings.get('alpha', 0.2)),
+    'median': lambda settings: Median(settings.get('window', 5)),
+    None: lambda settings: Passthrough(),
+}
+
+
+class MetricFilter:
+    """Smooths one metric, drops spikes and holds it within a deadband.
+
+    A value further than `spike` from the current one is dropped, unless
+    `spike_samples` of them come in a row, which is taken as a real step
+    and starts the filter again from there. `held` only follows `value`
+    once they are `deadband` apart, so jitter doesn't show.
+    """
+
+    def __init__(self, filter=None, spike=None, spike_samples=3, deadband=0, decimals=None, **settings):
+        self.filter = FILTERS[filter](settings)
+        self.spike = spike
+        self.spike_samples = spike_samples
+        self.deadband = deadband
+        self.decimals = decimals
+
+        self.value = None
+        self.held = None
+        self.spikes = 0
+        self._outliers = 0
+        self._restart = False
+
+    def restart(self):
+        """Start again from the next value, forgetting the ones before"""
+        self.value = None
+        self._outliers = 0
+        self._restart = True
+
+    def update(self, value):
+        if value is None:
+            return self.value
+
+        if self.spike is not None and self.value is not None and abs(value - self.value) > self.spike:
+            self._outliers += 1
+            if self._outliers < self.spike_samples:
+                self.spikes += 1
+                return self.value
+            self.filter.reset(value)
+        self._outliers = 0
+
+        if self._restart:
+            self._restart = False
+            self.filter.reset(value)
+        self.value = self._round(self.filter.update(value))
+        if self.held is None or abs(self.value - self.held) >= self.deadband:
+            self.held = self.value
+        return self.value
+
+    def _round(self, value):
+        if self.decimals is None:
+            return value
+        if self.decimals == 0:
+            return int(round(value))
+        return round(value, self.decimals)
+
+
+class ReadingFilter:
+    """Filter stage between the sensor reads and everything using them.
+
+    update() takes a raw Reading and returns it filtered, which is what
+    gets stored and logged. held() is the same Reading with the values
+    held within their deadbands, for the screen and MQTT, and
+    publish_due() tells whether any of them moved since the last message.
+    The heartbeat is in `clock` seconds when given, so it keeps up with a
+    simulated clock.
+    """
+
+    def __init__(self, config=None, heartbeat=HEARTBEAT, clock=None):
+        config = config or {}
+        self.heartbeat = config.get('heartbeat') or heartbeat
+        self.clock = clock
+        self.metrics = {}
+        for name, field in READING_METRICS.items():
+            settings = dict(DEFAULT_FILTERS.get(name, {}), **(config.get(name) or {}))
+            self.metrics[field] = MetricFilter(**settings)
+
+        self._held = None
+        self._published = None
+        self._published_at = None
+
+    def update(self, reading):
+        filtered = reading._replace(**{
+            field: metric.update(getattr(reading, field)) for field, metric in self.metrics.items()})
+        self._held = reading._replace(**{field: metric.held for field, metric in self.metrics.items()})
+        return filtered
+
+    def held(self):
+        """Latest Reading with the values held within their deadbands"""
+        return self._held
+
+    def restart(self, fields):
+        """Start the filters of some Reading fields again from their next
+        values, e.g. when the ones before were not real measurements"""
+        for field in fields:
+            if field in self.metrics:
+                self.metrics[field].restart()
+
+    def spikes(self):
+        return {field: metric.spikes for field, metric in self.metrics.items()}
+
+    def publish_due(self, now=None):
+        """Whether to send a state message now, either because a value
+        moved past its deadband or the heartbeat is due. Marks it as sent.
+        """
+        held = self._held
+        if held is None:
+            return False
+        if now is None:
+            now = self.clock.timestamp() if self.clock else time.monotonic()
+
+        values = tuple(getattr(held, field) for field in self.metrics)
+        if values == self._published and now - self._published_at < self.heartbeat:
+            return False
+
+        self._published = values
+        self._published_at = now
+        return True
@@ -0,0 +1,397 @@
+import atexit
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+from datetime import datetime, timezone
+from PIL import Image
+
+# Hardware backends. Each device has the same small interface in every
+# backend, so Calcifair can run on the Pi ('real'), headless with made up
+# values ('synthetic') or headless replaying a recorded store ('replay').
+#
+# Air quality sensor: measure() -> (eCO2, TVOC), get_baseline(),
+#     set_baseline(eCO2, TVOC)
+# Environment sensor: read() -> (temperature, humidity, pressure)
+# Light sensor: read() -> (lux, proximity)
+# Display: width, height, begin(), display(image), set_backlight(value),
+#     set_window(x0, y0, x1, y1), data(bytes)
+
+SENSOR_BACKENDS = ['real', 'synthetic', 'replay']
+DISPLAY_BACKENDS = ['real', 'memory', 'png']
+
+
+class Clock:
+    """Wall clock that can run faster than real time.
+
+    With speed 1 this is just the current time. Otherwise time starts at
+    `start` (now by default) and advances `speed` seconds per real second.
+    Intervals meant in simulated seconds go through sleep() or interval().
+    """
+
+    def __init__(self, speed=1, start=None):
+        self.speed = speed
+        self.realtime = speed == 1 and start is None
+        self.reset(start)
+
+    def reset(self, start=None):
+        """Start counting again from start"""
+        self.start = start or datetime.now(timezone.utc)
+        self._started = time.monotonic()
+
+    def now(self):
+        if self.realtime:
+            return datetime.now(timezone.utc)
+        return datetime.fromtimestamp(self.timestamp(), timezone.utc)
+
+    def timestamp(self):
+        if self.realtime:
+            return time.time()
+        return self.start.timestamp() + (time.monotonic() - self._started) * self.speed
+
+    def interval(self, seconds):
+        """Real seconds for the given simulated seconds"""
+        return seconds / self.speed
+
+    def sleep(self, seconds):
+        time.sleep(self.interval(seconds))
+
+
+# Real hardware
+
+class SGP30:
+    def __init__(self, i2c):
+        import adafruit_sgp30
+        self.sensor = adafruit_sgp30.Adafruit_SGP30(i2c)
+        self.sensor.iaq_init()
+
+    def measure(self):
+        # The eCO2 and TVOC properties each trigger a measurement
+        return tuple(self.sensor.iaq_measure())
+
+    def get_baseline(self):
+        return tuple(self.sensor.get_iaq_baseline())
+
+    def set_baseline(self, eCO2, TVOC):
+        self.sensor.set_iaq_baseline(eCO2, TVOC)
+
+
+class BME280:
+    def __init__(self, i2c):
+        from adafruit_bme280 import basic as adafruit_bme280
+        self.sensor = adafruit_bme280.Adafruit_BME280_I2C(i2c, address=0x76)
+        # Source: https://meteologix.com/al/model-charts/euro/comunidad-de-madrid/sea-level-pressure.html
+        self.sensor.sea_level_pressure = 1020
+
+    def read(self):
+        return self.sensor.temperature, self.sensor.humidity, self.sensor.pressure
+
+
+class LTR559:
+    def __init__(self):
+        from ltr559 import LTR559 as Sensor
+        self.sensor = Sensor()
+
+    def read(self):
+        self.sensor.update_sensor()
+        return self.sensor.get_lux(passive=True), self.sensor.get_proximity(passive=True)
+
+
+def real_sensors():
+    import board
+    import busio
+
+    i2c = busio.I2C(board.SCL, board.SDA, frequency=100000)
+    return SGP30(i2c), BME280(i2c), LTR559()
+
+
+def real_display(rotation):
+    import ST7789
+
+    return ST7789.ST7789(
+        port=0,
+        cs=ST7789.BG_SPI_CS_FRONT,  # BG_SPI_CSB_BACK or BG_SPI_CS_FRONT
+        dc=9,
+        backlight=19,               # 18 for back BG slot, 19 for front BG slot.
+        rotation=rotation,
+        spi_speed_hz=80 * 1000 * 1000
+    )
+
+
+# Synthetic sensors, following a daily cycle plus some noise
+
+class SyntheticAirQuality:
+    def __init__(self, clock, seed=None):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.baseline = (0x8973, 0x8AAE)
+        self.drift = 0
+
+    def measure(self):
+        hour = self.clock.now().hour + self.clock.now().minute / 60
+        # More people, more CO2 in the evening
+        self.drift = max(-200, min(400, self.drift + self.random.gauss(0, 5)))
+        eCO2 = 650 + 250 * math.sin((hour - 13) / 24 * 2 * math.pi) + self.drift
+        TVOC = max(0, eCO2 / 8 - 30 + self.random.gauss(0, 10))
+        return max(400, int(eCO2)), int(TVOC)
+
+    def get_baseline(self):
+        return self.baseline
+
+    def set_baseline(self, eCO2, TVOC):
+        self.baseline = (eCO2, TVOC)
+
+
+class SyntheticEnvironment:
+    def __init__(self, clock, seed=None):
+        self.clock = clock
+        self.random = random.Random(seed)
+
+    def read(self):
+        hour = self.clock.now().hour
+        temperature = 21 + 2 * math.sin((hour - 9) / 24 * 2 * math.pi) + self.random.gauss(0, 0.1)
+        humidity = 45 + self.random.gauss(0, 0.5)
+        pressure = 1013 + self.random.gauss(0, 0.3)
+        return temperature, humidity, pressure
+
+
+class SyntheticLight:
+    def __init__(self, clock, seed=None, approach_every=100):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.approach_every = approach_every
+        self.approach_at = self.clock.timestamp() + self.random.expovariate(1 / approach_every)
+        self.approach_until = 0
+
+    def read(self):
+        hour = self.clock.now().hour
+        lux = max(0.0, 300 * math.sin((hour - 7) / 14 * math.pi)) + self.random.uniform(0, 5)
+
+        # Now and then someone puts their hand close for a few seconds,
+        # however often the sensor is read
+        now = self.clock.timestamp()
+        if now >= self.approach_at:
+            self.approach_until = now + self.random.uniform(2, 8)
+            self.approach_at = self.approach_until + self.random.expovariate(1 / self.approach_every)
+        proximity = 100 if now <= self.approach_until else 0
+
+        return lux, proximity
+
+
+def synthetic_sensors(clock, seed=None):
+    return (SyntheticAirQuality(clock, seed),
+        SyntheticEnvironment(clock, seed),
+        SyntheticLight(clock, seed))
+
+
+# Replay of readings recorded in a Store
+
+class Recording:
+    """Raw series of a store loaded in memory, looked up by clock time"""
+
+    def __init__(self, store, clock, start=None, end=None):
+        self.clock = clock
+        # Simulated runs may have recorded timestamps in the future
+        start = start or 0
+        end = end or 2 ** 53
+
+        self.series = {}
+        for metric in ['eco2', 'tvoc', 'baseline_eco2', 'baseline_tvoc',
+                       'temperature', 'humidity', 'pressure', 'lux']:
+            rows = np.array(store.query(metric, start, end, resolution='raw'), dtype='float64').reshape(-1, 2)
+            self.series[metric] = (rows[:, 0], rows[:, 1])
+
+        timestamps = self.series['eco2'][0]
+        if not len(timestamps):
+            raise ValueError('No readings recorded between {} and {}'.format(start, end))
+        self.start = datetime.fromtimestamp(timestamps[0], timezone.utc)
+        self.end = datetime.fromtimestamp(timestamps[-1], timezone.utc)
+
+    def value(self, metric, default=None):
+        timestamps, values = self.series[metric]
+        if not len(values):
+            return default
+        index = np.searchsorted(timestamps, self.clock.timestamp(), side='right') - 1
+        return values[max(index, 0)]
+
+
+class ReplayAirQuality:
+    def __init__(self, recording):
+        self.recording = recording
+
+    def measure(self):
+        return int(self.recording.value('eco2')), int(self.recording.value('tvoc'))
+
+    def get_baseline(self):
+        return (int(self.recording.value('baseline_eco2', 0)),
+            int(self.recording.value('baseline_tvoc', 0)))
+
+    def set_baseline(self, eCO2, TVOC):
+        pass
+
+
+class ReplayEnvironment:
+    def __init__(self, recording):
+        self.recording = recording
+
+    def read(self):
+        return (self.recording.value('temperature'),
+            self.recording.value('humidity'),
+            self.recording.value('pressure'))
+
+
+class ReplayLight:
+    def __init__(self, recording):
+        self.recording = recording
+
+    def read(self):
+        # Proximity is not recorded
+        return self.recording.value('lux', 0.0), 0
+
+
+def replay_sensors(recording):
+    return ReplayAirQuality(recording), ReplayEnvironment(recording), ReplayLight(recording)
+
+
+# Headless displays
+
+class MemoryDisplay:
+    """Keeps the RGB565 framebuffer in memory instead of sending it to a panel"""
+
+    def __init__(self, width=240, height=240, rotation=90):
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.backlight = 0
+        self.frames = 0
+        self.bytes_sent = 0
+        # Panel space, two bytes per pixel
+        self.framebuffer = np.zeros((height, width * 2), dtype='uint8')
+        self.set_window()
+
+    def begin(self):
+        pass
+
+    def set_backlight(self, value):
+        self.backlight = value
+
+    def set_window(self, x0=0, y0=0, x1=None, y1=None):
+        self._window = (x0, y0,
+            self.width - 1 if x1 is None else x1,
+            self.height - 1 if y1 is None else y1)
+        self._pending = bytearray()
+        self._row = 0
+
+    def data(self, data):
+        x0, y0, x1, y1 = self._window
+        row_bytes = (x1 - x0 + 1) * 2
+        self._pending += bytes(data)
+        self.bytes_sent += len(data)
+
+        # Copy the complete rows received so far into the window
+        rows = min(len(self._pending) // row_bytes, y1 - y0 + 1 - self._row)
+        if rows > 0:
+            block = np.frombuffer(bytes(self._pending[:rows * row_bytes]), dtype='uint8')
+            top = y0 + self._row
+            self.framebuffer[top:top + rows, x0 * 2:(x1 + 1) * 2] = block.reshape(rows, row_bytes)
+            del self._pending[:rows * row_bytes]
+            self._row += rows
+
+            if self._row == y1 - y0 + 1:
+                self.frames += 1
+
+    def display(self, image):
+        from inc.display import image_to_rgb565
+        self.set_window()
+        self.data(image_to_rgb565(image, self.rotation))
+
+    def image(self):
+        """The framebuffer as a PIL image, as it would look on the panel"""
+        color = self.framebuffer.view('>u2').astype('uint16')
+        rgb = np.dstack((
+            (color >> 8) & 0xF8,
+            (color >> 3) & 0xFC,
+            (color << 3) & 0xF8)).astype('uint8')
+        return Image.fromarray(np.rot90(rgb, -(self.rotation // 90)))
+
+
+class PNGDisplay(MemoryDisplay):
+    """Memory display that also writes every nth complete frame to a PNG"""
+
+    def __init__(self, path, every=1, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.every = every
+        os.makedirs(path, exist_ok=True)
+
+    def data(self, data):
+        frames = self.frames
+        super().data(data)
+        if self.frames != frames and self.frames % self.every == 0:
+            self.image().save(os.path.join(self.path, 'frame-{:06d}.png'.format(self.frames)))
+
+
+def create_clock(config):
+    """Clock for the configured speed, and the recording to replay if the
+    sensors backend is 'replay', else None.
+
+    A replay runs in the time of the recording, so it is opened here, before
+    anything reads the clock, rather than along with the sensors.
+    """
+    clock = Clock(config.get('speed') or 1)
+    if config.get('sensors') != 'replay':
+        return clock, None
+
+    # Replay from a temporary copy, so the recording is left as it was:
+    # opening a store sets it up and switches it to WAL
+    from inc.store import Store
+
+    replay = config.get('replay') or {}
+    directory = tempfile.mkdtemp(prefix='calcifair-replay-')
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    path = os.path.join(directory, os.path.basename(replay['path']))
+    shutil.copy(replay['path'], path)
+    # Readings not checkpointed into the database yet
+    if os.path.exists(replay['path'] + '-wal'):
+        shutil.copy(replay['path'] + '-wal', path + '-wal')
+    store = Store(path)
+    recording = Recording(store, clock, replay.get('start'), replay.get('end'))
+
+    # Simulated time runs from the start of the recording
+    clock.realtime = False
+    clock.reset(recording.start)
+    return clock, recording
+
+
+def create_sensors(config, clock, recording=None):
+    """Air quality, environment and light sensors for the configured
+    backend. Replay needs the recording from create_clock()."""
+    backend = config.get('sensors') or 'real'
+
+    if backend == 'real':
+        return real_sensors()
+    elif backend == 'synthetic':
+        return synthetic_sensors(clock, config.get('seed'))
+    elif backend == 'replay':
+        return replay_sensors(recording)
+
+    raise ValueError('Unknown sensors backend: {}'.format(backend))
+
+
+def create_display(config, rotation, dir_path):
+    backend = config.get('display') or 'real'
+
+    if backend == 'real':
+        return real_display(rotation)
+    elif backend == 'memory':
+        return MemoryDisplay(rotation=rotation)
+    elif backend == 'png':
+        return PNGDisplay(
+            os.path.join(dir_path, config.get('png_path') or 'logs/frames'),
+            every=config.get('png_every') or 1,
+            rotation=rotation)
+
+    raise ValueError('Unknown display backend: {}'.format(backend))
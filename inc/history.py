@@ -0,0 +1,263 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from inc.display import DISPLAY_ROTATION, image_to_panel
+from inc.limits import *
+from inc.screen import FONT_REGULAR, FONT_BOLD, COLOR_TEXT, COLOR_BACKGROUND
+from inc.registry import MEASUREMENTS
+
+# Charts on the history page, top to bottom: sensors with a scale for it
+HISTORY_CHARTS = [sensor for sensor in MEASUREMENTS if sensor.scale]
+
+HEADER_HEIGHT = 30
+CHART_MARGIN = 10
+
+COLOR_GUIDE = (70, 70, 70)
+
+
+def _dim(color, amount=0.45):
+    return tuple(int(c * amount) for c in color)
+
+
+class RingBuffer:
+    """Last `size` samples of a few values, in preallocated NumPy arrays"""
+
+    def __init__(self, size, fields):
+        self.size = size
+        self.times = np.full(size, np.nan)
+        self.values = np.full((size, fields), np.nan, dtype=np.float32)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts, values):
+        self.times[self.head] = ts
+        self.values[self.head] = values
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def since(self, start):
+        """(times, values) of the samples from Unix time start on, oldest first"""
+        order = np.roll(np.arange(self.size), -self.head)
+        times = self.times[order]
+        keep = times >= start
+        return times[keep], self.values[order][keep]
+
+
+class Sparkline:
+    """Chart of one value, a column per time step, drawn straight into an
+    RGB view of the page.
+
+    The scale is fixed, so a new column only shifts the chart left and
+    draws the newest one; old columns never need drawing again. Columns
+    are coloured by the limits of the value, with faint guides at them.
+    """
+
+    def __init__(self, pixels, limit_medium, limit_bad, low, high):
+        self.pixels = pixels
+        self.height, self.width = pixels.shape[:2]
+        self.limits = (limit_medium, limit_bad)
+        self.low = low
+        self.high = high
+
+        # Empty column with the guides, copied under every column drawn
+        self.empty = np.zeros((self.height, 3), dtype=np.uint8)
+        self.empty[:] = COLOR_BACKGROUND
+        for limit in self.limits:
+            self.empty[self._y(limit)] = COLOR_GUIDE
+        self.pixels[:] = self.empty[:, None]
+        self._column = self.empty.copy()
+
+    def _y(self, value):
+        ratio = (min(max(value, self.low), self.high) - self.low) / (self.high - self.low)
+        return self.height - 1 - int(round(ratio * (self.height - 1)))
+
+    def draw(self, x, value):
+        """Draw one column, returns whether any of its pixels changed"""
+        column = self._column
+        column[:] = self.empty
+        if value is not None and not np.isnan(value):
+            # Plain floats, NumPy scalars make the comparisons several times slower
+            value = float(value)
+            color = traffic_light(value, *self.limits)
+            top = self._y(value)
+            column[top:] = _dim(color)
+            column[top:top + 2] = color
+
+        # A new mean mostly lands on the same pixel as the one before
+        if np.array_equal(self.pixels[:, x], column):
+            return False
+        self.pixels[:, x] = column
+        return True
+
+    def shift(self, columns=1):
+        """Move the chart left, leaving the newest columns empty"""
+        columns = min(columns, self.width)
+        if columns < self.width:
+            self.pixels[:, :-columns] = self.pixels[:, columns:]
+        self.pixels[:, self.width - columns:] = self.empty[:, None]
+
+    def redraw(self, values):
+        """Draw the whole chart from a value per column, oldest first"""
+        for x, value in enumerate(values):
+            self.draw(x, value)
+
+
+class HistoryPage:
+    """Page with the last minutes of CO2 and VOC as sparklines.
+
+    Readings go into a ring buffer as they come, roughly once a second.
+    Each chart column averages `minutes * 60 / width` seconds of them, and
+    only the newest column is drawn again as readings arrive; when time
+    moves on to the next column the chart shifts by one. The page is kept
+    as a NumPy array, and `version` changes whenever its pixels do, so
+    the RGB565 frame for the panel is only converted again then.
+    """
+
+    def __init__(self, width, height, minutes=30, charts=HISTORY_CHARTS, rotation=DISPLAY_ROTATION):
+        self.width = width
+        self.height = height
+        self.seconds = minutes * 60
+        self.charts = charts
+        self.rotation = rotation
+
+        self.buffer = RingBuffer(self.seconds, len(charts))
+        self.columns = width - 2 * CHART_MARGIN
+        self.step = self.seconds / self.columns
+
+        self.font = ImageFont.truetype(FONT_REGULAR, 20)
+        self.font_bold = ImageFont.truetype(FONT_BOLD, 20)
+        self.font_small = ImageFont.truetype(FONT_REGULAR, 14)
+
+        self.page = np.zeros((height, width, 3), dtype=np.uint8)
+        self.page[:] = COLOR_BACKGROUND
+
+        # Each chart gets a header with its label and latest value, then the chart
+        band = height // len(charts)
+        self.headers = []
+        self.sparklines = []
+        for i, sensor in enumerate(charts):
+            top = i * band
+            self.headers.append((0, top, width, top + HEADER_HEIGHT))
+            self.sparklines.append(Sparkline(
+                self.page[top + HEADER_HEIGHT:top + band - CHART_MARGIN, CHART_MARGIN:width - CHART_MARGIN],
+                *sensor.limits, *sensor.scale))
+
+        self.updates = 0
+        self.redraws = 0
+        self.version = 0
+        self.conversions = 0
+
+        self._panel = None
+        self._panel_version = None
+
+        self._column = None
+        self._sums = np.zeros(len(charts))
+        self._counts = np.zeros(len(charts))
+        self._shown = [()] * len(charts)
+
+    def add_reading(self, reading):
+        self.add(reading.timestamp.timestamp(),
+            [getattr(reading, sensor.field) for sensor in self.charts])
+
+    def add(self, ts, values):
+        values = np.array([np.nan if value is None else value for value in values], dtype=float)
+        self.buffer.append(ts, values)
+
+        column = int(ts // self.step)
+        if self._column is None or column < self._column:
+            # Clock went back, or nothing drawn yet
+            self.redraw(ts)
+            return
+
+        changed = False
+        if column > self._column:
+            for sparkline in self.sparklines:
+                sparkline.shift(column - self._column)
+            self._column = column
+            self._sums[:] = 0
+            self._counts[:] = 0
+            changed = True
+
+        valid = ~np.isnan(values)
+        self._sums[valid] += values[valid]
+        self._counts[valid] += 1
+        for sparkline, total, count in zip(self.sparklines, self._sums, self._counts):
+            changed |= sparkline.draw(sparkline.width - 1, total / count if count else None)
+        self.updates += 1
+        if changed:
+            self.version += 1
+
+    def redraw(self, now):
+        """Draw every column again from the ring buffer"""
+        self.redraws += 1
+        self.version += 1
+        self._column = int(now // self.step)
+        first = self._column - self.columns + 1
+
+        times, values = self.buffer.since(first * self.step)
+        columns = (times // self.step).astype(int) - first
+        keep = (columns >= 0) & (columns < self.columns)
+        columns, values = columns[keep], values[keep]
+
+        for i, sparkline in enumerate(self.sparklines):
+            valid = ~np.isnan(values[:, i])
+            counts = np.bincount(columns[valid], minlength=self.columns)
+            sums = np.bincount(columns[valid], weights=values[valid, i], minlength=self.columns)
+            with np.errstate(invalid='ignore'):
+                sparkline.redraw(sums / counts)
+            self._sums[i] = sums[-1]
+            self._counts[i] = counts[-1]
+
+    def seed(self, store, now):
+        """Fill the buffer from the store, e.g. after a restart"""
+        samples = {}
+        for i, sensor in enumerate(self.charts):
+            for ts, value in store.query(sensor.key, now - self.seconds, now, resolution='raw'):
+                samples.setdefault(ts, [None] * len(self.charts))[i] = value
+
+        for ts in sorted(samples)[-self.buffer.size:]:
+            self.buffer.append(ts, [np.nan if value is None else value for value in samples[ts]])
+        self.redraw(now)
+        return len(samples)
+
+    def _draw_header(self, i, value):
+        sensor = self.charts[i]
+        x0, y0, x1, y1 = self.headers[i]
+
+        img = Image.new('RGB', (x1 - x0, y1 - y0), COLOR_BACKGROUND)
+        draw = ImageDraw.Draw(img)
+        draw.text((CHART_MARGIN, 4), sensor.name, font=self.font, fill=COLOR_TEXT)
+        if value is not None:
+            text = '<400' if sensor.key == 'eco2' and value <= 400 else str(value)
+            draw.text((62, 4), '{} {}'.format(text, sensor.unit), font=self.font_bold, fill=COLOR_TEXT)
+        if i == 0:
+            draw.text((x1 - x0 - CHART_MARGIN, 9), '{} min'.format(self.seconds // 60),
+                font=self.font_small, fill=COLOR_TEXT, anchor='ra')
+        self.page[y0:y1, x0:x1] = np.asarray(img)
+        self.version += 1
+
+    def render(self, values=None):
+        """Page as an RGB array, with the given values in the headers.
+
+        This is the page itself, not a copy, ready for Animator.show().
+        Headers are only drawn again when their value changes.
+        """
+        values = values or [None] * len(self.charts)
+        for i, value in enumerate(values):
+            if self._shown[i] != (value,):
+                self._shown[i] = (value,)
+                self._draw_header(i, value)
+        return self.page
+
+    def panel(self, values=None):
+        """The page as a (rows, columns) RGB565 frame in panel space, ready
+        for Animator.show_frame(). It is only converted again when the page
+        changed since the last time, otherwise the same frame comes back."""
+        page = self.render(values)
+        if self._panel_version != self.version:
+            self._panel = image_to_panel(page, self.rotation)
+            self._panel_version = self.version
+            self.conversions += 1
+        return self._panel
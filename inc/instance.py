@@ -0,0 +1,24 @@
+import fcntl
+import os
+
+
+def acquire_instance_lock(path):
+    """Take an exclusive lock on path so only one Calcifair runs at a time.
+
+    Returns the open lock file, which must be kept open for as long as the
+    process runs, or None if another process holds the lock. The kernel
+    drops the lock when the process dies, so a stale file is harmless.
+    """
+    lock_file = open(path, 'a+')
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write('{}\n'.format(os.getpid()))
+    lock_file.flush()
+    return lock_file
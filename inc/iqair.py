@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import dateutil.parser
+import requests
+from datetime import datetime, timezone
+from inc.metrics import NULL_METRICS
+from inc.tracing import tracer
+
+# External air quality provided by AirVisual (IQAir)
+# Based on US EPA National Ambient Air Quality Standards https://support.airvisual.com/en/articles/3029425-what-is-aqi
+# <50, Good; 51-100, Moderate (ventilation is discouraged); >101, Unhealthy
+
+IQAIR_URL = 'https://api.airvisual.com/v2'
+
+
+def parse_nearest_city(response):
+    """Turn a nearest_city response into the values we show and log"""
+    current = response['data']['current']
+
+    return {
+        'temp': current['weather']['tp'],
+        'pressure': current['weather']['pr'],
+        'humidity': current['weather']['hu'],
+        'weather_timestamp': dateutil.parser.parse(current['weather']['ts']),
+        'aqi': current['pollution']['aqius'],
+        'pollution_timestamp': dateutil.parser.parse(current['pollution']['ts']),
+    }
+
+
+class IQAirClient:
+    """AirVisual nearest_city client with an on-disk cache.
+
+    The last good response is kept in cache_path and served straight away
+    on startup. Data counts as fresh for ttl seconds after its own
+    timestamp. Stale data keeps being served while a refresh runs in the
+    background, and the API is never called more than once every
+    min_interval seconds to save the rate-limited quota. Requests are
+    timed into `metrics` when given.
+    """
+
+    def __init__(self, latitude, longitude, token, cache_path,
+                 ttl=3600, min_interval=1800, timeout=(5, 15), base_url=IQAIR_URL,
+                 metrics=None):
+        self.params = {'lat': latitude, 'lon': longitude, 'key': token}
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.url = base_url.rstrip('/') + '/nearest_city'
+        self.metrics = metrics or NULL_METRICS
+
+        # Called with the parsed values every time new data arrives
+        self.on_update = None
+
+        self.requests = 0
+        self.errors = 0
+        self.last_success = None
+
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=1))
+
+        self._current = None
+        self._last_request = None
+        self._refreshing = threading.Lock()
+
+        self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as file:
+                cached = json.load(file)
+            self._current = parse_nearest_city(cached)
+        except (OSError, ValueError, KeyError) as e:
+            print("No IQAir cache available: {}".format(e))
+
+    def _save_cache(self, response):
+        """Write the response to the cache, returns False if it couldn't.
+        The new data is served from memory anyway."""
+        directory = os.path.dirname(self.cache_path) or '.'
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.iqair-')
+            with os.fdopen(fd, 'w') as file:
+                json.dump(response, file)
+            os.replace(tmp_path, self.cache_path)
+            return True
+        except OSError as e:
+            print("Could not save IQAir cache: {}".format(e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def current(self):
+        """Latest outdoor values, possibly stale, or None if there are none"""
+        return self._current
+
+    def is_fresh(self):
+        if self._current is None:
+            return False
+        age = datetime.now(timezone.utc) - self._current['pollution_timestamp']
+        return age.total_seconds() < self.ttl
+
+    def refresh(self):
+        """Fetch new data now. Returns True if it succeeded."""
+        with self._refreshing:
+            self._last_request = time.monotonic()
+            self.requests += 1
+
+            try:
+                with self.metrics.timer('api_request', api='iqair'), tracer.span('iqair.request'):
+                    result = self.session.get(self.url, params=self.params, timeout=self.timeout)
+                response = result.json()
+            except (requests.RequestException, ValueError) as e:
+                self.errors += 1
+                # The exception text would include the URL with the token
+                print("AirVisual API request failed: {}".format(type(e).__name__))
+                return False
+
+            if response.get('status') != 'success':
+                self.errors += 1
+                print("AirVisual API error: {}".format(response.get('status')))
+                return False
+
+            try:
+                current = parse_nearest_city(response)
+            except (KeyError, ValueError) as e:
+                self.errors += 1
+                print("Unexpected AirVisual API response: {}".format(e))
+                return False
+
+            self.last_success = time.time()
+
+            previous = self._current
+            self._current = current
+            self._save_cache(response)
+
+        if previous is None or previous['pollution_timestamp'] != current['pollution_timestamp']:
+            if self.on_update:
+                self.on_update(current)
+
+        return True
+
+    def refresh_if_stale(self):
+        """Refresh when the data is stale and the quota allows it"""
+        if self.is_fresh():
+            return False
+        if self._last_request is not None and time.monotonic() - self._last_request < self.min_interval:
+            return False
+        return self.refresh()
+
+    def refresh_in_background(self):
+        """Stale-while-revalidate: keep serving the cache while refreshing"""
+        if self._refreshing.locked():
+            return
+        threading.Thread(target=self.refresh_if_stale, name='iqair-refresh', daemon=True).start()
@@ -0,0 +1,32 @@
+# Air quality levels
+# From Hong Kong Indoor Air Quality Management Group
+# https://www.iaq.gov.hk/media/65346/new-iaq-guide_eng.pdf
+
+# CO2 levels in ppm
+LIMIT_ECO2_BAD = 1000
+LIMIT_ECO2_MEDIUM = 800
+
+# VOC levels in ppb
+LIMIT_TVOC_BAD = 261
+LIMIT_TVOC_MEDIUM = 87
+
+# AQI levels
+LIMIT_AQI_BAD = 100
+LIMIT_AQI_MEDIUM = 50
+
+# Rather accessible traffic lights from https://uxdesign.cc/beautiful-accessible-traffic-light-colors-b2b14a102a38
+COLOR_GREEN = (125, 142, 40)
+COLOR_YELLOW = (252, 202, 67)
+COLOR_RED = (171, 7, 48)
+TRAFFIC_LIGHTS = [COLOR_GREEN, COLOR_YELLOW, COLOR_RED]
+
+
+def level(value, limit_medium, limit_bad):
+    """0 for good, 1 for medium and 2 for bad, a value at a limit already
+    counting as past it. Works on NumPy arrays too."""
+    return (value >= limit_medium) * 1 + (value >= limit_bad)
+
+
+def traffic_light(value, limit_medium, limit_bad):
+    """Return the traffic light colour for a reading and its limits"""
+    return TRAFFIC_LIGHTS[level(value, limit_medium, limit_bad)]
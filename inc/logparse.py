@@ -0,0 +1,537 @@
+"""Converter for the human readable logs into columnar NumPy arrays.
+
+Parses logs/sgp30-result.txt, logs/sgp30-baseline.txt and logs/iqair.txt,
+rotated and gzipped copies included, into one structured array per log
+saved as .npy. Files are memory-mapped and parsed a chunk at a time with
+NumPy over the raw bytes, without a Python step per line. Malformed lines
+are skipped and counted. The byte offset reached in each file is kept,
+so running it again only parses what was appended since:
+
+    python3 -m inc.logparse
+    python3 -m inc.logparse --store logs/calcifair.sqlite   # also import them
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import mmap
+import os
+import tempfile
+import time
+from collections import namedtuple
+import numpy as np
+
+# Part of a line to be read into a field of the records. kind is one of
+# 'decimal', 'hex', 'date' and 'time', and date and time fields with the
+# same name are added up into a timestamp. prefix and suffix are literal
+# bytes in the same token.
+Field = namedtuple('Field', ['name', 'kind', 'prefix', 'suffix'], defaults=[b'', b''])
+
+# Layout of a line as space separated tokens, each literal bytes or a
+# Field. head tokens are counted from the start of the line and tail
+# tokens from its end, with any number of tokens in between if gap is
+# set. A line starting with flag has it stripped and flag_name set.
+LineFormat = namedtuple('LineFormat', ['head', 'tail', 'gap', 'flag', 'flag_name'],
+    defaults=[(), False, None, None])
+
+DEGREES = '°C'.encode()
+
+# CO2: 812 ppm, VOC: 90 ppb, Lux: 123.5 lx | 21.4°C, 1013 hPa, 44.8% RH | 2026-10-18 10:00:00
+RESULT = LineFormat(head=[
+    b'CO2:', Field('eco2', 'decimal'), b'ppm,',
+    b'VOC:', Field('tvoc', 'decimal'), b'ppb,',
+    b'Lux:', Field('lux', 'decimal'), b'lx', b'|',
+    Field('temperature', 'decimal', suffix=DEGREES + b','),
+    Field('pressure', 'decimal'), b'hPa,',
+    Field('humidity', 'decimal', suffix=b'%'), b'RH', b'|',
+    Field('ts', 'date'), Field('ts', 'time'),
+])
+
+# [Valid: ]CO2: 35187 0x8973, VOC: 35502 0x8aae | 2026-10-18 10:00:00
+BASELINE = LineFormat(head=[
+    b'CO2:', Field('baseline_eco2', 'decimal'), Field('baseline_eco2_hex', 'hex', b'0x', b','),
+    b'VOC:', Field('baseline_tvoc', 'decimal'), Field('baseline_tvoc_hex', 'hex', b'0x'),
+    b'|', Field('ts', 'date'), Field('ts', 'time'),
+], flag=b'Valid: ', flag_name='valid')
+
+# Outdoors: 15°C, 1020 hPa, 60% RH, AQI 42 | Data time: 2026-10-18 09:00:00, 1 hour ago | Log time: 2026-10-18 10:00:00
+# The relative age after the data time ("1 hour ago", "hace 1 hora") says
+# nothing the log time doesn't, so it goes in the gap
+IQAIR = LineFormat(head=[
+    b'Outdoors:', Field('temperature', 'decimal', suffix=DEGREES + b','),
+    Field('pressure', 'decimal'), b'hPa,',
+    Field('humidity', 'decimal', suffix=b'%'), b'RH,',
+    b'AQI', Field('aqi', 'decimal'), b'|',
+    b'Data', b'time:', Field('data_ts', 'date'), Field('data_ts', 'time', suffix=b','),
+], tail=[
+    b'|', b'Log', b'time:', Field('ts', 'date'), Field('ts', 'time'),
+], gap=True)
+
+RESULT_DTYPE = np.dtype([
+    ('ts', 'f8'),
+    ('eco2', 'u2'),
+    ('tvoc', 'u2'),
+    ('lux', 'f4'),
+    ('temperature', 'f4'),
+    ('pressure', 'f4'),
+    ('humidity', 'f4'),
+])
+
+BASELINE_DTYPE = np.dtype([
+    ('ts', 'f8'),
+    ('baseline_eco2', 'u2'),
+    ('baseline_tvoc', 'u2'),
+    ('valid', '?'),
+])
+
+IQAIR_DTYPE = np.dtype([
+    ('ts', 'f8'),
+    ('data_ts', 'f8'),
+    ('temperature', 'f4'),
+    ('pressure', 'f4'),
+    ('humidity', 'f4'),
+    ('aqi', 'f4'),
+])
+
+
+def _check_baseline(values):
+    # The hex copy doubles as a checksum of the decimal one
+    return ((values['baseline_eco2'] == values['baseline_eco2_hex']) &
+        (values['baseline_tvoc'] == values['baseline_tvoc_hex']))
+
+
+# Log name: line format, dtype, extra check, and the store metric of each field
+LOGS = {
+    'sgp30-result': (RESULT, RESULT_DTYPE, None, {
+        'eco2': 'eco2', 'tvoc': 'tvoc', 'lux': 'lux',
+        'temperature': 'temperature', 'pressure': 'pressure', 'humidity': 'humidity'}),
+    'sgp30-baseline': (BASELINE, BASELINE_DTYPE, _check_baseline, {
+        'baseline_eco2': 'baseline_eco2', 'baseline_tvoc': 'baseline_tvoc'}),
+    'iqair': (IQAIR, IQAIR_DTYPE, None, {
+        'temperature': 'outdoor_temperature', 'pressure': 'outdoor_pressure',
+        'humidity': 'outdoor_humidity', 'aqi': 'outdoor_aqi'}),
+}
+
+# Parse this much at a time, cut at the last full line, to keep the
+# temporary arrays small and in cache
+CHUNK_BYTES = 2 * 1024 * 1024
+
+# Longest number read, in characters, one 64-bit word
+NUMBER_WIDTH = 8
+
+
+def local_to_utc(naive):
+    """Unix times from seconds since 1970 in local time"""
+    # Local time offsets only change on the hour, so ask once per hour
+    hours, inverse = np.unique(naive // 3600, return_inverse=True)
+    offsets = np.array([
+        time.mktime(time.gmtime(hour * 3600)[:8] + (-1,)) - hour * 3600 for hour in hours.tolist()])
+    return (naive + offsets[inverse.reshape(-1)]).astype('float64')
+
+
+class _Chunk:
+    """Bytes of a chunk of a log, readable 8 at a time as one word.
+
+    A copy with newlines around it, so the padding reads as empty lines
+    and a word can be read from any position in the lines. The word
+    starting at each byte is precomputed, eight times the chunk size.
+    """
+
+    PADDING = 8
+
+    def __init__(self, data):
+        self.bytes = np.full(len(data) + 2 * self.PADDING, ord('\n'), dtype='uint8')
+        self.bytes[self.PADDING:self.PADDING + len(data)] = data
+        # Reading from an unaligned view is slow, an aligned copy pays off
+        self.words = np.ndarray((len(self.bytes) - 7,), dtype='<u8', buffer=self.bytes, strides=(1,)).copy()
+
+    # Indexes are out of range only on lines that are malformed anyway
+
+    def byte(self, index):
+        return self.bytes.take(index, mode='clip')
+
+    def word(self, index):
+        return self.words.take(index, mode='clip')
+
+    def columns(self, starts, length):
+        """The bytes at starts + 0 to length - 1, a column each"""
+        columns = []
+        for offset in range(0, length, 8):
+            # The last word is read overlapping the one before
+            base = max(0, min(offset, length - 8))
+            word = self.word(starts + base)
+            for position in range(offset, min(offset + 8, length)):
+                columns.append(_byte_of(word, position - base))
+        return columns
+
+    def equals(self, starts, ends, literal):
+        equal = ends - starts == len(literal)
+        for offset in range(0, len(literal), 8):
+            piece = literal[offset:offset + 8]
+            mask = np.uint64((1 << 8 * len(piece)) - 1)
+            equal &= (self.word(starts + offset) & mask) == np.uint64(int.from_bytes(piece, 'little'))
+        return equal
+
+
+def _byte_of(word, position):
+    return ((word >> np.uint64(8 * position)) & np.uint64(0xFF)).astype('uint8')
+
+
+def _parse_number(chunk, starts, ends, base=10):
+    """Numbers in the [starts, ends) spans, read right aligned from one word"""
+    negative = (ends > starts) & (chunk.byte(starts) == ord('-'))
+    starts = starts + negative
+    lengths = ends - starts
+
+    valid = (lengths > 0) & (lengths <= NUMBER_WIDTH)
+    number = np.zeros(len(starts))
+    decimals = np.zeros(len(starts), dtype='int64')
+    dots = np.zeros(len(starts), dtype='int64')
+
+    word = chunk.word(ends - NUMBER_WIDTH)
+    width = int(min(lengths.max(initial=1), NUMBER_WIDTH))
+    for position in range(NUMBER_WIDTH - width, NUMBER_WIDTH):
+        chars = _byte_of(word, position)
+        inside = position >= NUMBER_WIDTH - lengths
+        # Bytes below '0' wrap around and fail the comparison
+        value = chars - np.uint8(ord('0'))
+        digit = value < 10
+        if base == 16:
+            lower = chars | np.uint8(0x20)
+            letter = lower - np.uint8(ord('a')) < 6
+            value = np.where(letter, lower - np.uint8(ord('a') - 10), value)
+            digit |= letter
+        digit &= inside
+        dot = inside & (chars == ord('.')) if base == 10 else False
+
+        valid &= ~inside | digit | dot
+        number = np.where(digit, number * base + value, number)
+        decimals += digit & (dots > 0)
+        dots += dot
+
+    valid &= dots <= 1
+    number = number / 10.0 ** decimals
+    return np.where(negative, -number, number), valid
+
+
+def _parse_fixed(chunk, starts, ends, layout):
+    """Digits of fixed width fields like dates, layout like b'dddd-dd-dd'"""
+    columns = chunk.columns(starts, len(layout))
+    valid = ends - starts == len(layout)
+    for column, expected in zip(columns, layout):
+        if expected == ord('d'):
+            valid &= column - np.uint8(ord('0')) < 10
+        else:
+            valid &= column == expected
+    return columns, valid
+
+
+def _digits(columns, positions):
+    """Integer from the digit columns at positions"""
+    number = np.zeros(len(columns[0]), dtype='int64')
+    for position in positions:
+        number = number * 10 + columns[position] - ord('0')
+    return number
+
+
+def _parse_date(chunk, starts, ends):
+    """Days since 1970-01-01, in seconds"""
+    columns, valid = _parse_fixed(chunk, starts, ends, b'dddd-dd-dd')
+    year, month, day = _digits(columns, [0, 1, 2, 3]), _digits(columns, [5, 6]), _digits(columns, [8, 9])
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+
+    months = ((year - 1970) * 12 + np.clip(month, 1, 12) - 1).astype('timedelta64[M]')
+    days = (np.datetime64('1970-01', 'M') + months).astype('datetime64[D]').astype('int64')
+    return (days + day - 1) * 86400, valid
+
+
+def _parse_time(chunk, starts, ends):
+    """Seconds since midnight"""
+    columns, valid = _parse_fixed(chunk, starts, ends, b'dd:dd:dd')
+    hours, minutes, seconds = _digits(columns, [0, 1]), _digits(columns, [3, 4]), _digits(columns, [6, 7])
+    valid &= (hours < 24) & (minutes < 60) & (seconds < 61)
+    return hours * 3600 + minutes * 60 + seconds, valid
+
+
+PARSERS = {
+    'decimal': _parse_number,
+    'hex': lambda chunk, starts, ends: _parse_number(chunk, starts, ends, base=16),
+    'date': _parse_date,
+    'time': _parse_time,
+}
+
+
+def parse_lines(data, line_format):
+    """Parse the complete lines in data, a uint8 array.
+
+    Returns a {field: array} dict with a value per line, the mask of
+    lines that matched the format, and the count of non-empty lines.
+    """
+    chunk = _Chunk(data)
+    view = chunk.bytes
+
+    ends = np.flatnonzero(view == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # Lines written on Windows
+    ends = ends - ((ends > starts) & (chunk.byte(ends - 1) == ord('\r')))
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+
+    values = {}
+    if line_format.flag:
+        flagged = chunk.equals(starts, starts + len(line_format.flag), line_format.flag)
+        starts = starts + flagged * len(line_format.flag)
+        values[line_format.flag_name] = flagged
+
+    spaces = np.flatnonzero(view == ord(' '))
+    head, tail = line_format.head, line_format.tail
+    tokens = len(head) + len(tail)
+    if not len(spaces) or not len(starts):
+        return values, np.zeros(len(starts), dtype=bool), len(starts)
+
+    # Spaces before the start and before the end of each line
+    first = np.searchsorted(spaces, starts)
+    last = np.searchsorted(spaces, ends)
+    count = last - first
+    valid = count >= tokens - 1 if line_format.gap else count == tokens - 1
+
+    def space(index):
+        return spaces.take(index, mode='clip')
+
+    bounds = []
+    for i, token in enumerate(head):
+        token_start = starts if i == 0 else space(first + i - 1) + 1
+        token_end = np.where(i < count, space(first + i), ends)
+        bounds.append((token, token_start, token_end))
+    for j, token in enumerate(reversed(tail)):
+        token_end = ends if j == 0 else space(last - j)
+        token_start = np.where(j < count, space(last - j - 1) + 1, starts)
+        bounds.append((token, token_start, token_end))
+
+    for token, token_start, token_end in bounds:
+        if isinstance(token, bytes):
+            valid &= chunk.equals(token_start, token_end, token)
+            continue
+
+        valid &= chunk.equals(token_start, token_start + len(token.prefix), token.prefix)
+        valid &= chunk.equals(token_end - len(token.suffix), token_end, token.suffix)
+        value, good = PARSERS[token.kind](chunk, token_start + len(token.prefix), token_end - len(token.suffix))
+        valid &= good
+        values[token.name] = values[token.name] + value if token.name in values else value
+
+    return values, valid, len(starts)
+
+
+def parse_buffer(buffer, name, start=0, end=None):
+    """Parse the lines of buffer[start:end], returns (records, malformed)"""
+    line_format, dtype, check = LOGS[name][:3]
+    end = len(buffer) if end is None else end
+    parts, malformed = [], 0
+
+    position = start
+    while position < end:
+        chunk_end = min(position + CHUNK_BYTES, end)
+        if chunk_end < end:
+            # Never split a line between chunks
+            chunk_end = buffer.rfind(b'\n', position, chunk_end) + 1 or chunk_end
+
+        # Copied into the chunk, nothing keeps pointing into an mmap
+        data = np.frombuffer(buffer, dtype='uint8', count=chunk_end - position, offset=position)
+        values, valid, lines = parse_lines(data, line_format)
+        del data
+
+        if check is not None and valid.any():
+            valid &= check(values)
+        malformed += lines - int(valid.sum())
+
+        records = np.empty(int(valid.sum()), dtype=dtype)
+        for field in dtype.names:
+            column = values[field][valid]
+            records[field] = local_to_utc(column) if field.endswith('ts') else column
+        parts.append(records)
+        position = chunk_end
+
+    records = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+    return records, malformed
+
+
+def parse_file(path, name, offset=0):
+    """Parse a log from a byte offset, returns (records, malformed, new offset).
+
+    Only complete lines are parsed, so a line being written is picked up
+    on the next run.
+    """
+    dtype = LOGS[name][1]
+
+    if path.endswith('.gz'):
+        # Rotated logs are small and never change, parse them whole
+        with gzip.open(path, 'rb') as file:
+            buffer = file.read()
+        if not buffer.endswith(b'\n'):
+            buffer += b'\n'
+        records, malformed = parse_buffer(buffer, name)
+        return records, malformed, len(buffer)
+
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= offset:
+            return np.empty(0, dtype=dtype), 0, offset
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            end = buffer.rfind(b'\n', offset, size) + 1
+            if end <= offset:
+                return np.empty(0, dtype=dtype), 0, offset
+            records, malformed = parse_buffer(buffer, name, offset, end)
+            return records, malformed, end
+
+
+class LogConverter:
+    """Converts the logs in logs_path into .npy arrays in out_path.
+
+    Progress is kept in out_path/progress.json: the byte offset reached in
+    each log, and its inode and size so a rotated or truncated log is
+    parsed again from the start. Records are merged with the ones already
+    converted, sorted by time and without repeated timestamps, as rotation
+    puts the same lines in another file.
+    """
+
+    def __init__(self, logs_path, out_path):
+        self.logs_path = logs_path
+        self.out_path = out_path
+        self.progress_path = os.path.join(out_path, 'progress.json')
+        os.makedirs(out_path, exist_ok=True)
+
+        try:
+            with open(self.progress_path) as file:
+                self.progress = json.load(file)
+        except (OSError, ValueError):
+            self.progress = {}
+
+    def array_path(self, name):
+        return os.path.join(self.out_path, name + '.npy')
+
+    def load(self, name):
+        """Converted records of a log, memory-mapped"""
+        try:
+            return np.load(self.array_path(name), mmap_mode='r')
+        except FileNotFoundError:
+            return np.empty(0, dtype=LOGS[name][1])
+
+    def files(self, name):
+        # Rotated logs (name-YYYYmmdd-HHMMSS.txt.gz) sort before the live one
+        return sorted(glob.glob(os.path.join(self.logs_path, name + '-*.txt*'))) + \
+            sorted(glob.glob(os.path.join(self.logs_path, name + '.txt')))
+
+    def convert(self, name):
+        """Parse what is new in a log, returns (new records, malformed lines, bytes read)"""
+        parts, malformed, read = [], 0, 0
+        files = self.files(name)
+
+        # Forget rotated logs that were deleted since
+        for path in [path for path in self.progress if os.path.basename(path).startswith(name)]:
+            if path not in files:
+                del self.progress[path]
+
+        for path in files:
+            stat = os.stat(path)
+            done = self.progress.get(path)
+            offset = 0
+            if done and done['inode'] == stat.st_ino and done['size'] <= stat.st_size:
+                offset = done['offset']
+                if path.endswith('.gz'):
+                    continue
+
+            records, bad, end = parse_file(path, name, offset)
+            parts.append(records)
+            malformed += bad
+            read += end - offset if not path.endswith('.gz') else stat.st_size
+            self.progress[path] = {'inode': stat.st_ino, 'size': stat.st_size, 'offset': end}
+
+        new = np.concatenate(parts) if parts else np.empty(0, dtype=LOGS[name][1])
+        if not len(new):
+            return new, malformed, read
+
+        # One record per timestamp, keeping the first seen
+        timestamps, first = np.unique(new['ts'], return_index=True)
+        new = new[first]
+        existing = self.load(name)
+        if len(existing):
+            new = new[~np.isin(timestamps, existing['ts'])]
+
+        if len(new):
+            records = np.concatenate([existing, new])
+            if len(existing) and new['ts'][0] < existing['ts'][-1]:
+                records = records[np.argsort(records['ts'], kind='stable')]
+            self._save(self.array_path(name), records)
+        return new, malformed, read
+
+    def _save(self, path, records):
+        fd, tmp_path = tempfile.mkstemp(dir=self.out_path, prefix='.logparse-', suffix='.npy')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, records)
+        os.replace(tmp_path, path)
+
+    def save_progress(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.out_path, prefix='.progress-')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(self.progress, file, indent=2)
+        os.replace(tmp_path, self.progress_path)
+
+
+def import_to_store(store, name, records):
+    """Add converted records to the readings store, returns how many values
+    were added.
+
+    Calcifair stores its readings as it logs them, so only records older
+    than what the store has of each metric are added, not the same
+    readings again.
+    """
+    metrics = LOGS[name][3]
+    firsts = {metric: store.first(metric) for metric in metrics.values()}
+
+    added = 0
+    for record in records.tolist():
+        values = dict(zip(records.dtype.names, record))
+        ts = values['ts']
+        older = {metric: values[field] for field, metric in metrics.items()
+            if firsts[metric] is None or ts < firsts[metric]}
+        if older:
+            added += store.add(ts, older)
+    store.commit()
+    return added
+
+
+def main():
+    dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    parser = argparse.ArgumentParser(description='Convert the text logs into NumPy arrays')
+    parser.add_argument('--logs', default=os.path.join(dir_path, 'logs'), help='folder with the logs')
+    parser.add_argument('--out', default=os.path.join(dir_path, 'logs/arrays'), help='folder for the arrays')
+    parser.add_argument('--store', help='also add the new records to this readings store')
+    args = parser.parse_args()
+
+    converter = LogConverter(args.logs, args.out)
+    store = None
+    if args.store:
+        from inc.store import Store
+        store = Store(args.store, commit_interval=None)
+
+    for name in LOGS:
+        started = time.perf_counter()
+        records, malformed, read = converter.convert(name)
+        elapsed = time.perf_counter() - started
+        print('{}: {} new records, {} malformed lines, {:.1f} MB in {:.2f}s'.format(
+            name, len(records), malformed, read / 1024 / 1024, elapsed))
+
+        if store is not None and len(records):
+            print('{}: {} values added to the store'.format(name, import_to_store(store, name, records)))
+
+    # Only once the arrays are safely written
+    converter.save_progress()
+    if store is not None:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
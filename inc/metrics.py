@@ -0,0 +1,204 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from a quick I2C read to a slow API call
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = 'calcifair_'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ('metrics', 'key', 'started')
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.key, time.perf_counter() - self.started)
+
+
+class Metrics:
+    """Latency histograms plus counters and gauges read when asked for.
+
+    Histograms are filled with timer() or observe(). Counters and gauges
+    are functions registered once and only called when the metrics are
+    collected, so they cost nothing in between.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._help = {}
+        self._counters = []
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help):
+        self._help[name] = help
+
+    def timer(self, name, **labels):
+        """Context manager observing how long its block took"""
+        return _Timer(self, (name, tuple(sorted(labels.items()))))
+
+    def observe(self, name, seconds, **labels):
+        self._observe((name, tuple(sorted(labels.items()))), seconds)
+
+    def _observe(self, key, seconds):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def counter(self, name, help, function):
+        self._counters.append((name, help, function))
+
+    def gauge(self, name, help, function):
+        self._gauges.append((name, help, function))
+
+    def _read(self, functions):
+        values = []
+        for name, help, function in functions:
+            try:
+                value = function()
+            except Exception as e:
+                print("Metric {} failed: {}".format(name, e))
+                continue
+            if value is not None:
+                values.append((name, help, value))
+        return values
+
+    def snapshot(self):
+        """All metrics as a dict, e.g. to publish as JSON"""
+        with self._lock:
+            histograms = {
+                _series(name, labels): {'count': histogram.count, 'sum': round(histogram.sum, 6),
+                    'buckets': dict(zip([str(bucket) for bucket in histogram.buckets] + ['+Inf'], histogram.counts))}
+                for (name, labels), histogram in sorted(self._histograms.items())}
+        return {
+            'histograms': histograms,
+            'counters': {name: value for name, help, value in self._read(self._counters)},
+            'gauges': {name: value for name, help, value in self._read(self._gauges)},
+        }
+
+    def prometheus(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+
+        with self._lock:
+            histograms = [(name, labels, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                for (name, labels), histogram in sorted(self._histograms.items())]
+
+        described = set()
+        for name, labels, buckets, counts, total, count in histograms:
+            metric = PREFIX + name + '_seconds'
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(metric, self._help.get(name, name)))
+                lines.append('# TYPE {} histogram'.format(metric))
+            cumulative = 0
+            for bucket, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(metric, _labels(labels + (('le', bucket),)), cumulative))
+            lines.append('{}_sum{} {}'.format(metric, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(metric, _labels(labels), count))
+
+        for kind, functions in [('counter', self._counters), ('gauge', self._gauges)]:
+            for name, help, value in self._read(functions):
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, help))
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                lines.append('{}{} {}'.format(PREFIX, name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9108):
+        """Serve /metrics over HTTP from a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        print("Metrics served on http://{}:{}/metrics".format(host, port))
+        return server
+
+
+class NullMetrics:
+    """Stands in for Metrics when they are off, doing nothing"""
+
+    class _NullTimer:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    _timer = _NullTimer()
+
+    def describe(self, name, help):
+        pass
+
+    def timer(self, name, **labels):
+        return self._timer
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def counter(self, name, help, function):
+        pass
+
+    def gauge(self, name, help, function):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+
+def _series(name, labels):
+    return name + _labels(labels)
+
+
+def rss_bytes():
+    """Resident memory of this process"""
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import threading
+from collections import deque
+from paho.mqtt import client as mqtt_client
+from inc.registry import MEASUREMENTS, SENSORS, rounded, sensor_id
+from inc.sensors import Reading
+
+# Topics before each unit had its own, emptied along with the next discovery
+# so Home Assistant drops the entities set up from them
+LEGACY_TOPICS = ['sensor/calcifair/{}/config'.format(sensor.key) for sensor in MEASUREMENTS] + [
+    'sensor/calcifair/availability', 'sensor/calcifair/metrics']
+
+
+def unit_topic(node):
+    """Topic the state, availability and metrics of a unit go under,
+    relative to the discovery prefix. Each unit has its own, so several
+    can share a broker without mixing up their entities"""
+    return 'sensor/calcifair/{}'.format(node)
+
+# Reading field index of every sensor, looked up once rather than per message
+_STATE_FIELDS = [(sensor, Reading._fields.index(sensor.field)) for sensor in SENSORS]
+
+
+def state_payload(reading, node=None):
+    """State message for Home Assistant from a sensor Reading"""
+    payload = {
+        "node": node,
+        "timestamp": reading.timestamp.astimezone().isoformat(),
+    }
+    for sensor, index in _STATE_FIELDS:
+        payload[sensor.key] = rounded(sensor, reading[index])
+    return payload
+
+
+# json.dumps() builds an encoder per call when given any options, keep one
+_compact_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def compact_json(payload):
+    return _compact_encoder.encode(payload)
+
+
+def state_message(reading, node=None):
+    """State payload as compact JSON, numbers as numbers"""
+    return compact_json(state_payload(reading, node))
+
+
+def discovery_configs(prefix, device_id, availability_topic):
+    """Home Assistant discovery as (topic, config) pairs, one per sensor.
+    Topics are relative to the discovery prefix, with the device as node
+    ID so the configs of several units don't overwrite each other."""
+    configs = []
+    for sensor in MEASUREMENTS:
+        configs.append(("sensor/calcifair_{}/{}/config".format(device_id, sensor.key), {
+            "uniq_id": "{}_{}".format(device_id, sensor_id(sensor)),
+            "name": sensor.name,
+            "device_class": sensor.device_class,
+            "state_topic": "{}/{}/state".format(prefix, unit_topic(device_id)),
+            "unit_of_measurement": sensor.unit,
+            "suggested_display_precision": sensor.precision,
+            "value_template": "{{{{ value_json.{} }}}}".format(sensor.key),
+            "avty_t": availability_topic,
+            "pl_avail": "online",
+            "pl_not_avail": "offline",
+            "dev": {
+                "identifiers": [device_id],
+                "name": "Calcifair"
+            }
+        }))
+    return configs
+
+
+def config_hash(configs, *extra):
+    """Hash of the discovery configs, and anything else that should make
+    them go out again when it changes, like the broker"""
+    data = json.dumps([configs, extra], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+class MqttPublisher:
+    """MQTT publisher that keeps messages while the broker is away.
+
+    Messages published while disconnected, or while older ones are still
+    waiting, go to a bounded queue that drops the oldest messages when
+    full. Once connected again the queue is replayed in order, in
+    batches. The availability topic is set as Last Will, so it turns to
+    payload_not_available when the connection is lost.
+
+    Retained messages that must get there, like the Home Assistant
+    discovery, go through publish_confirmed() instead. They are never
+    dropped, go out before the queue and again on every reconnection
+    until the broker acknowledges them, see unconfirmed().
+    """
+
+    def __init__(self, host, port, client_id, availability_topic,
+                 username=None, password=None,
+                 payload_available='online', payload_not_available='offline',
+                 max_queue=2880, batch_size=50, min_backoff=1, max_backoff=300,
+                 client_factory=mqtt_client.Client):
+        self.host = host
+        self.port = port
+        self.availability_topic = availability_topic
+        self.payload_available = payload_available
+        self.payload_not_available = payload_not_available
+        self.batch_size = batch_size
+
+        self.connected = False
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self._queue = deque(maxlen=max_queue)
+        # topic: [payload, message info of the last send, connection it was sent on]
+        self._confirmed = {}
+        self._connections = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+        self.client = client_factory(client_id)
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        self.client.will_set(availability_topic, payload_not_available, retain=True)
+        self.client.reconnect_delay_set(min_delay=min_backoff, max_delay=max_backoff)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+        self._replayer = threading.Thread(target=self._replay, name='mqtt-replay', daemon=True)
+
+    def start(self):
+        # Connecting asynchronously lets the network loop retry with backoff
+        # even if the broker is not there yet
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+        self._replayer.start()
+
+    def stop(self):
+        self.client.publish(self.availability_topic, self.payload_not_available, retain=True)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print("Connected to MQTT broker")
+            self.connected = True
+            self._connections += 1
+            client.publish(self.availability_topic, self.payload_available, retain=True)
+            self._wake.set()
+        else:
+            print("Failed to connect to MQTT broker, return code {}".format(rc))
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            print("Lost connection to MQTT broker, return code {}".format(rc))
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'queue_depth': self.queue_depth(),
+            'published': self.published,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+    def publish(self, topic, payload, retain=False):
+        """Publish now if possible, otherwise queue for replay"""
+        with self._lock:
+            if self.connected and not self._queue and self._send(topic, payload, retain):
+                return True
+            self._enqueue((topic, payload, retain))
+
+        self._wake.set()
+        return False
+
+    def publish_confirmed(self, topic, payload):
+        """Publish a retained message with QoS 1 and keep it until the
+        broker acknowledges it. A newer payload for the topic replaces it."""
+        with self._lock:
+            self._confirmed[topic] = [payload, None, None]
+            if self.connected:
+                self._send_confirmed(topic)
+
+        self._wake.set()
+
+    def unconfirmed(self):
+        """Number of publish_confirmed() messages the broker hasn't acknowledged"""
+        with self._lock:
+            for topic, (payload, info, connection) in list(self._confirmed.items()):
+                if info is not None and info.is_published():
+                    del self._confirmed[topic]
+            return len(self._confirmed)
+
+    def _send_confirmed(self, topic):
+        message = self._confirmed[topic]
+        info = self.client.publish(topic, message[0], qos=1, retain=True)
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            self.failed += 1
+            return False
+        self.published += 1
+        message[1:] = [info, self._connections]
+        return True
+
+    def _replay_confirmed(self):
+        """Send the confirmed messages not sent on this connection yet"""
+        for topic, (payload, info, connection) in list(self._confirmed.items()):
+            if info is not None and (info.is_published() or connection == self._connections):
+                continue
+            if not self._send_confirmed(topic):
+                return False
+        return True
+
+    def _enqueue(self, message):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(message)
+
+    def _send(self, topic, payload, retain):
+        result = self.client.publish(topic, payload, retain=retain)
+        if result[0] == mqtt_client.MQTT_ERR_SUCCESS:
+            self.published += 1
+            return True
+        self.failed += 1
+        return False
+
+    def _replay(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+
+            while self.connected:
+                with self._lock:
+                    if not self._replay_confirmed():
+                        break
+                    if not self._queue:
+                        break
+
+                    sent = 0
+                    while self._queue and sent < self.batch_size:
+                        if not self._send(*self._queue[0]):
+                            break
+                        self._queue.popleft()
+                        sent += 1
+
+                if sent == 0:
+                    # Wait for the next reconnection
+                    break
+
+                if not self._queue:
+                    print("MQTT backlog replayed")
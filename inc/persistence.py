@@ -0,0 +1,155 @@
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import yaml
+from collections import defaultdict
+from datetime import datetime
+from inc.tracing import tracer
+
+
+class LogWriter(threading.Thread):
+    """Background writer that batches log appends.
+
+    append() only queues the line. Pending lines are written in one go per
+    file when flush_bytes are buffered or flush_interval seconds have
+    passed. Logs larger than rotate_bytes are gzipped next to the log,
+    keeping the newest `keep` archives.
+    """
+
+    def __init__(self, flush_interval=300.0, flush_bytes=64 * 1024,
+                 rotate_bytes=1024 * 1024, keep=12):
+        super().__init__(name='log-writer', daemon=True)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+
+        # Called from the writer thread after every flush, e.g. Store.commit
+        self.on_flush = []
+
+        self.flushes = 0
+        self.bytes_written = 0
+
+        self._pending = defaultdict(list)
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def append(self, path, line):
+        with self._lock:
+            self._pending[path].append(line + '\n')
+            self._pending_bytes += len(line) + 1
+            full = self._pending_bytes >= self.flush_bytes
+
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(list)
+            self._pending_bytes = 0
+
+        for path, lines in pending.items():
+            data = ''.join(lines)
+            try:
+                with tracer.span('log.write', file=os.path.basename(path)):
+                    with open(path, 'a') as file:
+                        file.write(data)
+                    self.bytes_written += len(data)
+                    self._rotate(path)
+            except OSError as e:
+                print("Failed to write {}: {}".format(path, e))
+
+        for callback in self.on_flush:
+            try:
+                with tracer.span('log.on_flush', callback=getattr(callback, '__name__', '')):
+                    callback()
+            except Exception as e:
+                print("Flush callback failed: {}".format(e))
+
+        self.flushes += 1
+
+    def _rotate(self, path):
+        if os.path.getsize(path) < self.rotate_bytes:
+            return
+
+        root, ext = os.path.splitext(path)
+        rotated = '{}-{}{}'.format(root, datetime.now().strftime('%Y%m%d-%H%M%S'), ext)
+        os.replace(path, rotated)
+
+        with open(rotated, 'rb') as source, gzip.open(rotated + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(rotated)
+
+        archives = sorted(glob.glob('{}-*{}.gz'.format(root, ext)))
+        for archive in archives[:-self.keep]:
+            os.remove(archive)
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        self.join()
+
+
+class StateFile:
+    """Small YAML file for runtime state, written atomically so a power
+    cut leaves either the old or the new version on disk. Safe to set
+    from several threads, each write has every change made before it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.state = yaml.full_load(file) or {}
+        except FileNotFoundError:
+            self.state = {}
+        return self.state
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.state[key] = value
+        self.save()
+
+    def save(self):
+        # Not while another thread changes the state or writes it out
+        with tracer.span('state.save'), self._lock:
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                yaml.dump(self.state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        # Make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
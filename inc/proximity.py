@@ -0,0 +1,116 @@
+import threading
+import time
+
+
+class ProximityWatcher(threading.Thread):
+    """Watches the proximity sensor and tells when someone comes close.
+
+    Polls fast for a while after anything was near and backs off to
+    `slow_interval` when nobody is around, so an idle unit reads the
+    sensor twice a second. Wake fires after `wake_samples` near readings
+    in a row, and sleep once nothing has been near for `sleep_after`
+    seconds. The first near reading switches to the fast rate, so waking
+    up from idle takes up to slow_interval plus (wake_samples - 1) *
+    fast_interval, about half a second. Reads share the sampler lock, since the light
+    sensor is on the same I2C bus. Times follow `clock` when given, so
+    the watcher can run faster than real time along with the sampler.
+    """
+
+    def __init__(self, light, lock, clock=None, threshold=5,
+                 fast_interval=0.02, slow_interval=0.5, active_seconds=10,
+                 wake_samples=2, sleep_after=10):
+        super().__init__(name='proximity-watcher', daemon=True)
+        self.light = light
+        self.lock = lock
+        self.clock = clock
+        self.threshold = threshold
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.active_seconds = active_seconds
+        self.wake_samples = wake_samples
+        self.sleep_after = sleep_after
+
+        # Called from this thread, keep them short
+        self.on_wake = []
+        self.on_sleep = []
+
+        self.near = False
+        self.awake = False
+        self.polls = 0
+        self.errors = 0
+        self.wakes = 0
+
+        self._hits = 0
+        self._near_since = None
+        self._last_near = None
+        self._interval = slow_interval
+        self._woke = threading.Event()
+        self._stopping = threading.Event()
+
+    def _now(self):
+        return self.clock.timestamp() if self.clock else time.monotonic()
+
+    def _real(self, seconds):
+        return self.clock.interval(seconds) if self.clock else seconds
+
+    def near_for(self):
+        """Seconds something has been near without a break, 0 if nothing is"""
+        near_since = self._near_since
+        if near_since is None:
+            return 0
+        return self._now() - near_since
+
+    def wait_for_wake(self, timeout=None):
+        """Sleep for timeout seconds, or less if someone comes close.
+
+        Returns True if it was cut short by a wake event.
+        """
+        woke = self._woke.wait(timeout)
+        self._woke.clear()
+        return woke
+
+    def stop(self):
+        self._stopping.set()
+
+    def poll(self):
+        with self.lock:
+            lux, proximity = self.light.read()
+        self.polls += 1
+        now = self._now()
+
+        if proximity >= self.threshold:
+            self._hits += 1
+            self._last_near = now
+            if self._near_since is None:
+                self._near_since = now
+        else:
+            self._hits = 0
+            self._near_since = None
+        self.near = self._near_since is not None
+
+        if not self.awake and self._hits >= self.wake_samples:
+            self.awake = True
+            self.wakes += 1
+            self._woke.set()
+            for callback in self.on_wake:
+                callback()
+        elif self.awake and not self.near and now - self._last_near >= self.sleep_after:
+            self.awake = False
+            for callback in self.on_sleep:
+                callback()
+
+        # Fast while someone is or was just around, backing off otherwise
+        if self._last_near is not None and now - self._last_near < self.active_seconds:
+            self._interval = self.fast_interval
+        else:
+            self._interval = min(self._interval * 2, self.slow_interval)
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.poll()
+            except OSError as e:
+                self.errors += 1
+                print("Proximity read failed: {}".format(e))
+                self._interval = self.slow_interval
+            self._stopping.wait(self._real(self._interval))
@@ -0,0 +1,51 @@
+from collections import namedtuple
+from inc.limits import *
+
+Sensor = namedtuple('Sensor', [
+    'key',           # name in the state message, the store and config.yaml
+    'field',         # Reading field it comes from
+    'name',          # shown in Home Assistant, charts and the history page
+    'unit',
+    'device_class',  # Home Assistant device class
+    'precision',     # decimals kept, in the filters and the state message
+    'filter',        # default filter settings, see inc/filters.py
+    'id',            # Home Assistant unique ID suffix and chart name, key by default
+    'limits',        # (medium, bad) for traffic lights and chart colours
+    'scale',         # fixed (low, high) range on the history page, None to leave it out
+    'diagnostic',    # only sent in the state message, not filtered, stored or discovered
+], defaults=(None, None, None, False))
+
+# Every value a Reading sends out, in state message order. Everything
+# else, from Home Assistant discovery to the charts, follows from here
+SENSORS = [
+    Sensor('eco2', 'eCO2', 'CO2', 'ppm', 'carbon_dioxide', 0,
+        {'filter': 'median', 'window': 5, 'spike': 2000, 'deadband': 10},
+        id='co2', limits=(LIMIT_ECO2_MEDIUM, LIMIT_ECO2_BAD), scale=(400, 1500)),
+    Sensor('tvoc', 'TVOC', 'VOC', 'ppb', 'volatile_organic_compounds', 0,
+        {'filter': 'median', 'window': 5, 'spike': 5000, 'deadband': 5},
+        id='voc', limits=(LIMIT_TVOC_MEDIUM, LIMIT_TVOC_BAD), scale=(0, 400)),
+    Sensor('temperature', 'temperature', 'Temperature', '°C', 'temperature', 1, {'filter': 'ema', 'alpha': 0.2, 'spike': 5, 'deadband': 0.1}),
+    Sensor('humidity', 'humidity', 'Humidity', '%', 'humidity', 0, {'filter': 'ema', 'alpha': 0.2, 'spike': 10, 'deadband': 1}),
+    Sensor('pressure', 'pressure', 'Pressure', 'hPa', 'atmospheric_pressure', 0, {'filter': 'ema', 'alpha': 0.1, 'spike': 20, 'deadband': 1}),
+    Sensor('lux', 'lux', 'Light', 'lx', 'illuminance', 1, {'filter': 'ema', 'alpha': 0.3, 'deadband': 5}),
+    Sensor('baseline_eco2', 'baseline_eCO2', 'CO2 baseline', None, None, 0, None, diagnostic=True),
+    Sensor('baseline_tvoc', 'baseline_TVOC', 'VOC baseline', None, None, 0, None, diagnostic=True),
+]
+
+REGISTRY = {sensor.key: sensor for sensor in SENSORS}
+
+# Sensors proper, leaving out the diagnostic values
+MEASUREMENTS = [sensor for sensor in SENSORS if not sensor.diagnostic]
+
+
+def sensor_id(sensor):
+    return sensor.id or sensor.key
+
+
+def rounded(sensor, value):
+    """Value with the precision of the sensor, an int if it has no decimals"""
+    if value is None:
+        return None
+    if not sensor.precision:
+        return int(round(value))
+    return round(value, sensor.precision)
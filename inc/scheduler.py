@@ -0,0 +1,198 @@
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from inc.tracing import tracer
+
+
+class Job:
+    """A periodic job and its timing stats"""
+
+    def __init__(self, name, function, interval, delay=0, jitter=0, timeout=None):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.delay = delay
+        self.jitter = jitter
+        self.timeout = timeout
+
+        self.runs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+        self.last_lateness = None
+        self.max_lateness = 0
+        self.running = False
+        # Set while a run is waiting for a worker or running
+        self.future = None
+        self.due = None
+        self.started = None
+        self.stuck = False
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'mean_duration': self.total_duration / self.runs if self.runs else None,
+            'max_duration': self.max_duration,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+            'stuck': self.stuck,
+        }
+
+    def timeout_at(self):
+        """When the current run goes past its timeout, None if it can't"""
+        if self.timeout is None or not self.running or self.stuck:
+            return None
+        return (self.started or self.due) + self.timeout
+
+
+class Scheduler(threading.Thread):
+    """Runs periodic jobs at fixed absolute deadlines.
+
+    Deadlines are kept in a heap and each one is computed from the
+    previous deadline, not from when the job finished, so periods don't
+    drift. Jitter only moves each run within its period, never the
+    deadlines. Jobs run on a small fixed pool of workers. A job that is
+    still running when its next deadline comes is counted as an overrun
+    and that tick is skipped.
+
+    A run that goes past its timeout is flagged as stuck. If it is still
+    waiting for a worker it is cancelled; if it is running it can't be
+    stopped, but as its later ticks are skipped it only ever holds one
+    worker, and the others keep running the rest of the jobs.
+    """
+
+    def __init__(self, workers=4):
+        super().__init__(name='scheduler', daemon=True)
+        self.jobs = {}
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def every(self, name, interval, function, delay=None, jitter=0, timeout=None):
+        """Run function every interval seconds, the first time after delay
+        seconds (one interval by default). Each run is moved by up to
+        jitter seconds, and flagged as stuck after timeout seconds.
+        """
+        job = Job(name, function, interval,
+            delay=interval if delay is None else delay, jitter=jitter, timeout=timeout)
+
+        with self._lock:
+            self.jobs[name] = job
+            self._push(job, time.monotonic() + job.delay)
+        self._wake.set()
+        return job
+
+    def _push(self, job, deadline):
+        # Entries are (when to run, name, deadline), the run moved by the jitter
+        start = deadline + random.uniform(0, job.jitter) if job.jitter else deadline
+        heapq.heappush(self._heap, (start, job.name, deadline))
+
+    def cancel(self, name):
+        with self._lock:
+            self.jobs.pop(name, None)
+
+    def stats(self):
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        self._pool.shutdown(wait=False)
+
+    def _check_timeouts(self, now):
+        """Flag runs past their timeout, returns when the next one is due"""
+        next_timeout = None
+        for job in list(self.jobs.values()):
+            timeout_at = job.timeout_at()
+            if timeout_at is None:
+                continue
+            if timeout_at > now:
+                next_timeout = timeout_at if next_timeout is None else min(next_timeout, timeout_at)
+                continue
+
+            job.timeouts += 1
+            if job.started is None and job.future.cancel():
+                job.running = False
+                print("Job {} waited {:.1f}s for a worker, cancelled".format(job.name, now - job.due))
+            else:
+                job.stuck = True
+                print("Job {} has been running for {:.1f}s, over its {:.1f}s timeout".format(
+                    job.name, now - (job.started or job.due), job.timeout))
+        return next_timeout
+
+    def run(self):
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            next_timeout = self._check_timeouts(now)
+            with self._lock:
+                start, name, deadline = self._heap[0] if self._heap else (None, None, None)
+
+            if start is None or start > now:
+                # Woken up early when a new job is added
+                wake_at = min(t for t in (start, next_timeout, now + 3600) if t is not None)
+                self._wake.wait(wake_at - now)
+                self._wake.clear()
+                continue
+
+            with self._lock:
+                heapq.heappop(self._heap)
+                job = self.jobs.get(name)
+                if job is None:
+                    continue
+
+                # Next deadline, skipping any that were missed altogether
+                next_deadline = deadline + job.interval
+                while next_deadline <= time.monotonic():
+                    next_deadline += job.interval
+                    job.skipped += 1
+                self._push(job, next_deadline)
+
+            if job.running:
+                job.overruns += 1
+                print("Job {} is still running, skipping this run".format(name))
+                continue
+
+            job.running = True
+            job.due = start
+            job.started = None
+            try:
+                job.future = self._pool.submit(self._run_job, job, start)
+            except RuntimeError:
+                # The pool is shut down when the interpreter exits
+                break
+
+    def _run_job(self, job, start):
+        started = job.started = time.monotonic()
+        job.last_lateness = started - start
+        job.max_lateness = max(job.max_lateness, job.last_lateness)
+
+        try:
+            with tracer.span('job.' + job.name, lateness=round(job.last_lateness, 3)):
+                job.function()
+        except Exception as e:
+            job.errors += 1
+            print("Job {} failed: {}".format(job.name, e))
+        finally:
+            duration = time.monotonic() - started
+            job.runs += 1
+            job.last_duration = duration
+            job.total_duration += duration
+            job.max_duration = max(job.max_duration, duration)
+
+            if job.stuck:
+                print("Job {} finished after {:.1f}s".format(job.name, duration))
+            job.stuck = False
+            job.running = False
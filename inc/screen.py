@@ -0,0 +1,205 @@
+import os.path
+from collections import OrderedDict
+import numpy as np
+from PIL import ImageFont, ImageDraw, Image
+from inc.display import DISPLAY_ROTATION, image_to_panel
+from inc.limits import *
+from inc.registry import REGISTRY
+
+FONT_REGULAR = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+FONT_BOLD = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+BACKGROUNDS = ['background.png', 'background-alt.png']
+
+COLOR_TEXT = (255, 255, 255)
+COLOR_BACKGROUND = (0, 0, 0)
+
+# Characters rasterized up front per font, anything else is added on first use
+ATLAS_CHARS = {
+    'regular': '●',
+    'bold': '0123456789<-',
+    'small': '0123456789.- ■AQI°C%RH',
+}
+
+
+def _blend(region, alpha, color):
+    """RGB565 pixels with colour laid over them through alpha, from 0 to 256"""
+    red, green, blue = color[0] >> 3, color[1] >> 2, color[2] >> 3
+    inverse = 256 - alpha
+    # Channels times 256 stay below 2**16, so this all fits in uint16
+    r = ((region >> 11) * inverse + red * alpha) >> 8
+    g = (((region >> 5) & 0x3F) * inverse + green * alpha) >> 8
+    b = ((region & 0x1F) * inverse + blue * alpha) >> 8
+    return (r << 11) | (g << 5) | b
+
+
+class GlyphAtlas:
+    """Glyphs of a font rasterized once, ready to blit into RGB565 frames.
+
+    Each character is kept as an alpha tile with its offset from the pen
+    and its advance, so drawing text is only laying tiles side by side and
+    blending them into the frame, with no PIL text layout per frame.
+    """
+
+    def __init__(self, font, chars=''):
+        self.font = font
+        self.glyphs = {}
+        for char in chars:
+            self.glyph(char)
+
+    def glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            left, top, right, bottom = self.font.getbbox(char)
+            mask = Image.new('L', (max(right - left, 0), max(bottom - top, 0)), 0)
+            ImageDraw.Draw(mask).text((-left, -top), char, font=self.font, fill=255)
+            alpha = np.asarray(mask, dtype=np.uint16)
+            # 0 to 256 rather than 255, so blending divides with a shift
+            alpha = alpha + (alpha >> 7)
+            glyph = self.glyphs[char] = (alpha, left, top, self.font.getlength(char))
+        return glyph
+
+    def draw(self, frame, xy, text, color):
+        """Blend text into a (rows, columns) RGB565 frame, where
+        ImageDraw.text() would draw it"""
+        placed = []
+        pen = float(xy[0])
+        for char in text:
+            alpha, left, top, advance = self.glyph(char)
+            if alpha.size:
+                placed.append((alpha, int(round(pen)) + left, xy[1] + top))
+            pen += advance
+        if not placed:
+            return
+
+        # Tiles go into one mask for the whole text, blended in one go
+        x0 = min(x for alpha, x, y in placed)
+        y0 = min(y for alpha, x, y in placed)
+        x1 = max(x + alpha.shape[1] for alpha, x, y in placed)
+        y1 = max(y + alpha.shape[0] for alpha, x, y in placed)
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint16)
+        for alpha, x, y in placed:
+            tile = mask[y - y0:y - y0 + alpha.shape[0], x - x0:x - x0 + alpha.shape[1]]
+            np.maximum(tile, alpha, out=tile)
+
+        # Clip to the frame
+        height, width = frame.shape
+        mask = mask[max(-y0, 0):max(height - y0, 0), max(-x0, 0):max(width - x0, 0)]
+        x0, y0 = max(x0, 0), max(y0, 0)
+        if not mask.size:
+            return
+
+        region = frame[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]]
+        region[...] = _blend(region, mask, color)
+
+
+class Screen:
+    """Info screen compositor.
+
+    Fonts and backgrounds are loaded once and the static labels are drawn
+    on a layer per background, kept ready in RGB565 panel space. A frame
+    is a copy of a layer with the readings blitted from glyph atlases, so
+    it goes to the panel as it is. Frames for the same readings come from
+    a small LRU cache, and the buffer of the frame it drops is reused for
+    the next one. The frame on screen is always the newest, never the one
+    reused, as long as the cache holds at least two.
+    """
+
+    def __init__(self, dir_path, width, height, cache_size=16, rotation=DISPLAY_ROTATION):
+        self.width = width
+        self.height = height
+        self.cache_size = max(cache_size, 2)
+        self.rotation = rotation
+
+        # Band with the CO2 and VOC readings, kept on screen over expressions
+        self.readings_box = (0, 0, width, 80)
+
+        self.font = ImageFont.truetype(FONT_REGULAR, 30)
+        self.font_bold = ImageFont.truetype(FONT_BOLD, 30)
+        self.font_small = ImageFont.truetype(FONT_REGULAR, 20)
+        self.fonts = {'regular': self.font, 'bold': self.font_bold, 'small': self.font_small}
+        self.atlases = {name: GlyphAtlas(font, ATLAS_CHARS[name]) for name, font in self.fonts.items()}
+
+        self.layers = {}
+        self.panel_layers = {}
+        for background in BACKGROUNDS:
+            image_path = os.path.join(dir_path, 'assets/', background)
+            with Image.open(image_path) as img:
+                self.layers[background] = self._static_layer(img.convert('RGB'))
+            self.panel_layers[background] = image_to_panel(self.layers[background], rotation)
+
+        self._frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _static_layer(self, img):
+        draw = ImageDraw.Draw(img)
+
+        draw.rectangle((0, 0, self.width, 80), COLOR_BACKGROUND)
+
+        draw.text((10, 10), 'CO2', font=self.font, fill=COLOR_TEXT)
+        draw.text((10, 80), 'ppm', font=self.font, fill=COLOR_TEXT)
+
+        draw.text((125, 10), 'VOC', font=self.font, fill=COLOR_TEXT)
+        draw.text((125, 80), 'ppb', font=self.font, fill=COLOR_TEXT)
+
+        return img
+
+    def _layout(self, eCO2, TVOC, aqi, temp, humidity):
+        """Text drawn over the static layer, as (xy, text, font, colour)"""
+        items = [
+            ((10, 45), '<400' if eCO2 <= 400 else str(eCO2), 'bold', COLOR_TEXT),
+            ((125, 45), str(TVOC), 'bold', COLOR_TEXT),
+            # Traffic lights
+            ((10, 120), '●', 'regular', traffic_light(eCO2, *REGISTRY['eco2'].limits)),
+            ((125, 120), '●', 'regular', traffic_light(TVOC, *REGISTRY['tvoc'].limits)),
+        ]
+
+        # Outdoor data may not be there yet if IQAir was never reached
+        if aqi is not None:
+            items.append(((125, 160), '■', 'small', traffic_light(aqi, LIMIT_AQI_MEDIUM, LIMIT_AQI_BAD)))
+            items.append(((148, 160), 'AQI ' + str(aqi), 'small', COLOR_TEXT))
+
+        if temp is not None:
+            items.append(((125, 185), str(temp) + '°C', 'small', COLOR_TEXT))
+        if humidity is not None:
+            items.append(((125, 210), str(humidity) + '% RH', 'small', COLOR_TEXT))
+
+        return items
+
+    def render(self, background, eCO2, TVOC, aqi, temp, humidity):
+        """Frame for the readings as a (rows, columns) RGB565 array in
+        panel space, ready for Animator.show_frame()"""
+        key = (background, eCO2, TVOC, aqi, temp, humidity)
+
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+        self.misses += 1
+        if len(self._frames) >= self.cache_size:
+            frame = self._frames.popitem(last=False)[1]
+        else:
+            frame = np.empty_like(self.panel_layers[background])
+        self._compose(frame, *key)
+
+        self._frames[key] = frame
+        return frame
+
+    def _compose(self, frame, background, eCO2, TVOC, aqi, temp, humidity):
+        np.copyto(frame, self.panel_layers[background])
+
+        # Same pixels seen the way the screen is held, writes land in frame
+        view = np.rot90(frame, -(self.rotation // 90))
+        for xy, text, font, color in self._layout(eCO2, TVOC, aqi, temp, humidity):
+            self.atlases[font].draw(view, xy, text, color)
+
+    def image(self, background, eCO2, TVOC, aqi, temp, humidity):
+        """The same frame as a PIL image, drawn with PIL, e.g. for tools"""
+        img = self.layers[background].copy()
+        draw = ImageDraw.Draw(img)
+        for xy, text, font, color in self._layout(eCO2, TVOC, aqi, temp, humidity):
+            draw.text(xy, text, font=self.fonts[font], fill=color)
+        return img
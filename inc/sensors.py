@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from inc.metrics import NULL_METRICS
+from inc.tracing import tracer
+
+# One immutable snapshot of every sensor, taken in a single pass over the bus
+Reading = namedtuple('Reading', [
+    'timestamp',
+    'eCO2',
+    'TVOC',
+    'baseline_eCO2',
+    'baseline_TVOC',
+    'temperature',
+    'humidity',
+    'pressure',
+    'lux',
+    'proximity',
+])
+
+# What the SGP30 reports for about 15 seconds after it is initialised
+WARMUP_READING = (400, 0)
+
+# Fields a seed stands in for while the SGP30 warms up
+SEEDED_FIELDS = ('eCO2', 'TVOC')
+
+
+class SensorSampler(threading.Thread):
+    """Reads all sensors at a fixed cadence and keeps the latest Reading.
+
+    This is the only place that talks to the I2C sensors once it is
+    running. Anyone else needing the bus must hold `lock`. Sensors are the
+    backends from inc.hardware, and timestamps and intervals follow `clock`
+    so the sampler can run faster than real time. Each read is timed into
+    `metrics` when given, and readings go through `filters` when given.
+    """
+
+    def __init__(self, air_quality, environment, light, clock=None,
+                 interval=1.0, baseline_interval=60.0, metrics=None, filters=None):
+        super().__init__(name='sensor-sampler', daemon=True)
+        self.air_quality = air_quality
+        self.environment = environment
+        self.light = light
+        self.clock = clock
+        self.interval = interval
+        self.baseline_interval = baseline_interval
+        self.metrics = metrics or NULL_METRICS
+        self.filters = filters
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.errors = 0
+
+        self._reading = None
+        self._seed = None
+        self._seed_until = 0
+        self._seeding = False
+        self._seeded_reading = None
+        self._baseline = (None, None)
+        self._baseline_next = 0
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+
+    def latest(self):
+        """Latest Reading, or None before the first sample"""
+        return self._reading
+
+    def wait(self, timeout=None):
+        """Wait for the first sample and return it"""
+        self._ready.wait(timeout)
+        return self._reading
+
+    def stop(self):
+        self._stopping.set()
+
+    def seed(self, reading, warmup=30.0):
+        """Start from a reading kept from the previous run.
+
+        It is served at once, and its eCO2 and TVOC stand in for the fixed
+        values the SGP30 gives while it warms up, for up to warmup seconds.
+        Readings with them are only for showing, see is_seeded().
+        """
+        self._seed = reading
+        self._seed_until = time.monotonic() + self._interval(warmup)
+        self._reading = self._seeded_reading = reading
+        self._ready.set()
+
+    def is_seeded(self, reading):
+        """Whether a reading has eCO2 and TVOC from the seed rather than the
+        sensor, so it is not to be stored or published as a measurement"""
+        return reading is not None and reading is self._seeded_reading
+
+    def sample(self):
+        with self.lock:
+            with self.metrics.timer('sensor_read', sensor='air_quality'):
+                eCO2, TVOC = self.air_quality.measure()
+
+            self._seeding = False
+            if self._seed is not None:
+                if (eCO2, TVOC) == WARMUP_READING and time.monotonic() < self._seed_until:
+                    eCO2, TVOC = self._seed.eCO2, self._seed.TVOC
+                    self._seeding = True
+                else:
+                    self._seed = None
+                    # What the filters took in from the seed was no measurement
+                    if self.filters is not None:
+                        self.filters.restart(SEEDED_FIELDS)
+
+            if time.monotonic() >= self._baseline_next:
+                self._baseline_next = time.monotonic() + self._interval(self.baseline_interval)
+                with self.metrics.timer('sensor_read', sensor='baseline'):
+                    self._baseline = self.air_quality.get_baseline()
+
+            with self.metrics.timer('sensor_read', sensor='environment'):
+                temperature, humidity, pressure = self.environment.read()
+            with self.metrics.timer('sensor_read', sensor='light'):
+                lux, proximity = self.light.read()
+
+        return Reading(
+            timestamp=self.clock.now() if self.clock else datetime.now(timezone.utc),
+            eCO2=eCO2,
+            TVOC=TVOC,
+            baseline_eCO2=self._baseline[0],
+            baseline_TVOC=self._baseline[1],
+            temperature=temperature,
+            humidity=humidity,
+            pressure=pressure,
+            lux=lux,
+            proximity=proximity)
+
+    def _interval(self, seconds):
+        return self.clock.interval(seconds) if self.clock else seconds
+
+    def run(self):
+        next_sample = time.monotonic()
+
+        while not self._stopping.is_set():
+            try:
+                with tracer.span('sample'):
+                    reading = self.sample()
+                    if self.filters is not None:
+                        reading = self.filters.update(reading)
+                if self._seeding:
+                    self._seeded_reading = reading
+                self._reading = reading
+                self.samples += 1
+                self._ready.set()
+            except OSError as e:
+                self.errors += 1
+                print("Sensor read failed: {}".format(e))
+
+            # Keep a fixed cadence regardless of how long the reads took
+            next_sample += self._interval(self.interval)
+            delay = next_sample - time.monotonic()
+            if delay < 0:
+                next_sample = time.monotonic()
+                delay = 0
+            self._stopping.wait(delay)
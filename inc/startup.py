@@ -0,0 +1,35 @@
+import os
+import time
+from inc.tracing import tracer
+
+
+def process_age():
+    """Seconds since the process was started, including interpreter startup"""
+    try:
+        with open('/proc/self/stat') as file:
+            # The process name may contain spaces, fields start after it
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimer:
+    """Records how long startup milestones took since the process started"""
+
+    def __init__(self):
+        self.start = time.monotonic() - process_age()
+        self.marks = {}
+
+    def mark(self, name):
+        """Record a milestone the first time it is reached"""
+        if name in self.marks:
+            return
+        self.marks[name] = time.monotonic() - self.start
+        tracer.instant(name)
+        print("Startup: {} after {:.2f}s".format(name, self.marks[name]))
+
+    def report(self):
+        return dict(self.marks)
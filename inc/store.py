@@ -0,0 +1,220 @@
+import sqlite3
+import threading
+import time
+from inc.registry import MEASUREMENTS
+
+# Rollup tables and the size of their buckets in seconds
+ROLLUPS = {
+    'minute': 60,
+    'hour': 3600,
+}
+
+# Default retention in days per resolution
+RETENTION_DAYS = {
+    'raw': 7,
+    'minute': 90,
+    'hour': 5 * 365,
+}
+
+# Metrics taken from each sensor Reading, as {metric: Reading field}
+READING_METRICS = {sensor.key: sensor.field for sensor in MEASUREMENTS}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metrics (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS raw (
+    metric INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (metric, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS minute (
+    metric INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (metric, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hour (
+    metric INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (metric, ts)
+) WITHOUT ROWID;
+'''
+
+ROLLUP_UPSERT = '''
+INSERT INTO {table} (metric, ts, count, sum, min, max) VALUES (?, ?, 1, ?, ?, ?)
+ON CONFLICT (metric, ts) DO UPDATE SET
+    count = count + 1,
+    sum = sum + excluded.sum,
+    min = min(min, excluded.min),
+    max = max(max, excluded.max)
+'''
+
+
+class Store:
+    """Local time-series store for readings, backed by SQLite.
+
+    Raw samples are kept together with minute and hour rollups that are
+    updated on every insert. Timestamps are Unix seconds in UTC. Writes go
+    into an open transaction that is committed every commit_interval
+    seconds, so the SD card is not written on every sample. With
+    commit_interval=None the owner is expected to call maintain().
+    """
+
+    def __init__(self, path, retention_days=None, commit_interval=60.0, prune_interval=3600.0):
+        self.path = path
+        self.retention_days = dict(RETENTION_DAYS, **(retention_days or {}))
+        self.commit_interval = commit_interval
+        self.prune_interval = prune_interval
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+        self._metrics = dict(self._db.execute('SELECT name, id FROM metrics'))
+        self._last_commit = time.monotonic()
+        self._next_prune = time.monotonic()
+
+    def _metric_id(self, name):
+        metric = self._metrics.get(name)
+        if metric is None:
+            cursor = self._db.execute('INSERT INTO metrics (name) VALUES (?)', (name,))
+            metric = self._metrics[name] = cursor.lastrowid
+        return metric
+
+    def add(self, ts, values):
+        """Store a {metric: value} dict sampled at Unix time ts.
+
+        A metric that already has a sample at ts keeps it, so rollups
+        never count the same second twice. Returns how many were added.
+        """
+        ts = int(ts)
+        added = 0
+
+        with self._lock:
+            for name, value in values.items():
+                if value is None:
+                    continue
+                metric = self._metric_id(name)
+                value = float(value)
+
+                cursor = self._db.execute(
+                    'INSERT OR IGNORE INTO raw (metric, ts, value) VALUES (?, ?, ?)',
+                    (metric, ts, value))
+                if cursor.rowcount != 1:
+                    continue
+                added += 1
+                for table, bucket in ROLLUPS.items():
+                    self._db.execute(
+                        ROLLUP_UPSERT.format(table=table),
+                        (metric, ts - ts % bucket, value, value, value))
+
+            self._maybe_commit()
+        return added
+
+    def add_reading(self, reading):
+        """Store the sensor values of a Reading snapshot"""
+        self.add(reading.timestamp.timestamp(), {
+            name: getattr(reading, field) for name, field in READING_METRICS.items()})
+
+    def _maybe_commit(self):
+        if self.commit_interval is None:
+            return
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self.maintain()
+
+    def maintain(self):
+        """Commit pending writes and prune old data when it is due"""
+        self.commit()
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + self.prune_interval
+            self.prune()
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._last_commit = time.monotonic()
+
+    def prune(self, now=None):
+        """Delete data older than the retention of each resolution"""
+        now = now or time.time()
+
+        with self._lock:
+            for table, days in self.retention_days.items():
+                self._db.execute('DELETE FROM {} WHERE ts < ?'.format(table), (int(now - days * 86400),))
+            self._db.commit()
+            self._last_commit = time.monotonic()
+
+    def metrics(self):
+        return sorted(self._metrics)
+
+    def first(self, metric):
+        """Unix time the data of a metric starts at, in any resolution,
+        None if there is none"""
+        with self._lock:
+            metric_id = self._metrics.get(metric)
+            if metric_id is None:
+                return None
+            starts = [self._db.execute(
+                'SELECT min(ts) FROM {} WHERE metric = ?'.format(table), (metric_id,)).fetchone()[0]
+                for table in ['raw'] + list(ROLLUPS)]
+
+        starts = [ts for ts in starts if ts is not None]
+        return min(starts) if starts else None
+
+    def query(self, metric, start, end=None, resolution=None):
+        """Values of a metric between Unix times start and end.
+
+        Raw data comes back as (ts, value) and rollups as
+        (ts, mean, min, max). When no resolution is given it is picked
+        from the length of the range.
+        """
+        end = end or time.time()
+        if resolution is None:
+            resolution = self.resolution_for(end - start)
+
+        with self._lock:
+            metric_id = self._metrics.get(metric)
+            if metric_id is None:
+                return []
+
+            if resolution == 'raw':
+                return self._db.execute(
+                    'SELECT ts, value FROM raw WHERE metric = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                    (metric_id, int(start), int(end))).fetchall()
+
+            if resolution not in ROLLUPS:
+                raise ValueError('Unknown resolution: {}'.format(resolution))
+
+            bucket = ROLLUPS[resolution]
+            return self._db.execute(
+                'SELECT ts, sum / count, min, max FROM {} WHERE metric = ? AND ts >= ? AND ts < ? ORDER BY ts'.format(resolution),
+                (metric_id, int(start) - int(start) % bucket, int(end))).fetchall()
+
+    def resolution_for(self, seconds):
+        if seconds <= 6 * 3600:
+            return 'raw'
+        elif seconds <= 14 * 86400:
+            return 'minute'
+        return 'hour'
+
+    def last(self, metric, hours=24, resolution=None):
+        """Shortcut for queries like "last 24h" """
+        return self.query(metric, time.time() - hours * 3600, resolution=resolution)
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
@@ -0,0 +1,130 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'started')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._record('X', self.name, self.started, time.perf_counter_ns() - self.started, self.args)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Records nested spans from any thread into a ring buffer.
+
+    Off by default, and span() costs a single check until start() is
+    called. The newest `capacity` events are kept, and dump() writes them
+    in the Chrome trace format, which chrome://tracing and Perfetto open.
+    """
+
+    def __init__(self, capacity=50000):
+        self.enabled = False
+        self._events = deque(maxlen=capacity)
+        self._threads = {}
+        self._origin = time.perf_counter_ns()
+
+    def start(self, capacity=None):
+        if capacity and capacity != self._events.maxlen:
+            self._events = deque(self._events, maxlen=capacity)
+        self.enabled = True
+        print("Tracing started")
+
+    def stop(self):
+        self.enabled = False
+        print("Tracing stopped")
+
+    def span(self, name, **args):
+        """Context manager recording its block as a span"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def complete(self, name, started, **args):
+        """Record a span that began at time.perf_counter() `started` and ends now"""
+        if self.enabled:
+            started = int(started * 1e9)
+            self._record('X', name, started, time.perf_counter_ns() - started, args)
+
+    def instant(self, name, **args):
+        """Record a point in time, e.g. a startup milestone"""
+        if self.enabled:
+            self._record('i', name, time.perf_counter_ns(), 0, args)
+
+    def _record(self, phase, name, started, duration, args):
+        thread = threading.current_thread()
+        self._threads[thread.ident] = thread.name
+        # Appending to a deque is atomic, no lock needed
+        self._events.append((phase, name, started, duration, thread.ident, args))
+
+    def events(self):
+        """Recorded events as Chrome trace events, times in microseconds"""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in list(self._threads.items())]
+
+        for phase, name, started, duration, tid, args in list(self._events):
+            event = {'name': name, 'ph': phase, 'pid': pid, 'tid': tid,
+                'ts': (started - self._origin) / 1000}
+            if phase == 'X':
+                event['dur'] = duration / 1000
+            else:
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            events.append(event)
+        return events
+
+    def dump(self, path):
+        """Write the trace to path, returns the number of events"""
+        events = self.events()
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.trace-')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        print("Trace with {} events written to {}".format(len(events), path))
+        return len(events)
+
+    def toggle(self, directory):
+        """Start tracing, or stop and dump the trace into directory"""
+        if not self.enabled:
+            self.start()
+            return None
+        self.stop()
+        path = os.path.join(directory, time.strftime('trace-%Y%m%d-%H%M%S.json'))
+        self.dump(path)
+        return path
+
+
+# Shared by every module, like the logging module's root logger
+tracer = Tracer()